@@ -32,6 +32,7 @@ else
                 libpng-dev \
                 libopenblas-dev \
                 graphviz \
+                pigz \
                 libgraphviz-dev \
                 curl && \
               conda install -y -q --name dwi_preproc -c mrtrix3 mrtrix3 && \
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+#####
+# Time the input hashing a rerun does before dispatching any job, for each
+# hash_method, over the nodes of an existing working directory where
+# nothing has changed:
+#
+#   python3 dev/bench_hashing.py output/dwi_ss3t_preproc_wf
+#
+# Every node's saved inputs (_inputs.pklz) are hashed the way nipype does
+# on startup. "fingerprint cold" starts from an empty store, "fingerprint
+# warm" is a second rerun. Drop the page cache between runs (or use a cohort
+# bigger than RAM) to see the cost of reading from Lustre under "content".
+#####
+
+import sys
+import glob
+import time
+import shutil
+import tempfile
+import os.path as op
+from nipype.interfaces.base import specs
+from nipype.interfaces.base.specs import BaseTraitedSpec
+from nipype.utils.filemanip import loadpkl
+
+sys.path.insert(0, op.join(op.dirname(op.abspath(__file__)), ".."))
+from src import fingerprint  # noqa: E402
+
+
+def hash_nodes(inputs, hash_method):
+    spec = BaseTraitedSpec()
+    start = time.time()
+    for node_inputs in inputs:
+        spec._get_sorteddict(node_inputs, hash_method=hash_method)
+    return time.time() - start
+
+
+if __name__ == "__main__":
+    wf_dir = sys.argv[1]
+    inputs = [loadpkl(f) for f in
+              glob.glob(op.join(wf_dir, "**", "_inputs.pklz"), recursive=True)]
+    files = {v for i in inputs for v in i.values()
+             if isinstance(v, str) and op.isfile(v)}
+    size_gb = sum(op.getsize(f) for f in files) / 1024 ** 3
+    print("%d nodes, %d input files, %.2f GB" % (len(inputs), len(files),
+                                                size_gb))
+
+    nipype_hash_infile = specs.hash_infile
+    print("  %-18s %8.2f s" % ("timestamp", hash_nodes(inputs, "timestamp")))
+    print("  %-18s %8.2f s" % ("content", hash_nodes(inputs, "content")))
+
+    store_dir = tempfile.mkdtemp(prefix="fingerprints_")
+    try:
+        fingerprint.install(store_dir)
+        print("  %-18s %8.2f s" % ("fingerprint cold",
+                                   hash_nodes(inputs, "content")))
+        print("  %-18s %8.2f s" % ("fingerprint warm",
+                                   hash_nodes(inputs, "content")))
+    finally:
+        specs.hash_infile = nipype_hash_infile
+        shutil.rmtree(store_dir)
@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+
+#####
+# Stand-in for the external tools the pipeline runs, for
+# dev/bench_workflow.py. Linked under each tool's name (hd-bet,
+# dwifslpreproc, pipeline.sh or the tools of its steps, ss3t_csd_beta1, the
+# MRtrix commands, ...), it writes the outputs the real tool would, with the
+# shapes, voxel grids and formats that follow from its inputs, then takes the
+# time and memory set for the tool in the profile:
+#
+#   BENCH_PROFILE  json file of {tool: {"seconds": s, "mem_gb": m,
+#                  "busy": fraction of the time spent computing on the
+#                  tool's -nthreads cores instead of sleeping}}, merged
+#                  into default_profile
+#   BENCH_SCALE    factor on the seconds (default 1)
+#   BENCH_LOG      file each call appends a json line to (tool, start, end)
+#
+# Image contents are synthetic, only the shapes and sizes are meaningful.
+#####
+
+import os
+import sys
+import json
+import time
+import random
+import os.path as op
+import numpy as np
+import nibabel as nb
+
+sys.path.insert(0, op.join(op.dirname(op.realpath(__file__)), ".."))
+from src.image_io import (  # noqa: E402
+    load_image,
+    save_mif,
+    save_nifti,
+    read_bvals
+)
+
+# Seconds per call, from node_runtimes in run.py
+default_profile = {
+    "hd-bet": {"seconds": 120},
+    "pipeline.sh": {"seconds": 3600, "mem_gb": 0.5},
+    "mri_nu_correct.mni": {"seconds": 600},
+    "mri_normalize": {"seconds": 300},
+    "epi_reg": {"seconds": 600},
+    "antsRegistrationSyNQuick.sh": {"seconds": 900},
+    "antsApplyTransforms": {"seconds": 10},
+    "fslmaths": {"seconds": 5},
+    "inference.py": {"seconds": 300, "mem_gb": 0.5},
+    "dwifslpreproc": {"seconds": 5400, "mem_gb": 0.5},
+    "dwibiascorrect": {"seconds": 300},
+    "dwi2response": {"seconds": 300},
+    "mrgrid": {"seconds": 300},
+    "ss3t_csd_beta1": {"seconds": 3600, "mem_gb": 0.5},
+    "mtnormalise": {"seconds": 300},
+}
+
+# Options taking values, and how many
+option_values = {"-fslgrad": 2, "-export_grad_fsl": 2}
+option_flags = {"-bzero", "-rpe_pair", "-rpe_none", "-rpe_all",
+                "-align_seepi", "-force", "-quiet", "--notopup", "--version",
+                "-mprage", "-fsl2ras", "--noclean"}
+
+# Largest b-value counted as b=0, as MRtrix's BZeroThreshold
+bzero_threshold = 10
+
+
+def parse_args(args):
+    """Positional arguments and {option: values} of a command line."""
+    positional, options = [], {}
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg.startswith("--") and "=" in arg:
+            # --option=value (FSL scripts)
+            name, value = arg.split("=", 1)
+            options[name] = [value]
+            i += 1
+        elif arg.startswith("-") and arg not in option_flags:
+            n = option_values.get(arg, 1)
+            options[arg] = args[i + 1:i + 1 + n]
+            i += 1 + n
+        elif arg.startswith("-"):
+            options[arg] = []
+            i += 1
+        else:
+            positional.append(arg)
+            i += 1
+    return positional, options
+
+
+def load(path):
+    data, affine, scaling = load_image(path)
+    data = np.asarray(data)
+    if scaling != (0.0, 1.0):
+        data = scaling[0] + scaling[1] * data
+    return data, affine
+
+
+def save(data, affine, path):
+    if path.endswith((".mif", ".mif.gz")):
+        save_mif(data, affine, path)
+    elif path.endswith(".mgz"):
+        nb.MGHImage(data, affine).to_filename(path)
+    else:
+        save_nifti(data, affine, path)
+
+
+def brain_mask(shape):
+    """Ellipsoid filling most of the field of view."""
+    axes = np.ogrid[tuple(slice(0, n) for n in shape[:3])]
+    radius = sum(((a - (n - 1) / 2) / (0.4 * n)) ** 2
+                 for a, n in zip(axes, shape[:3]))
+    return radius <= 1
+
+
+def regrid(data, affine, shape, target_affine):
+    """Nearest neighbour resampling onto another grid, for grids aligned
+    with each other's axes."""
+    # Voxel indices of the target grid's centres in the source grid
+    to_source = np.linalg.inv(affine) @ target_affine
+    axes = []
+    for axis, n in enumerate(shape[:3]):
+        coord = to_source[axis, axis] * np.arange(n) + to_source[axis, 3]
+        axes.append(np.clip(np.rint(coord).astype(int), 0,
+                            data.shape[axis] - 1))
+    return data[np.ix_(*axes)]
+
+
+def grad_files(options):
+    """bvec and bval files given with -fslgrad."""
+    bvec, bval = options["-fslgrad"]
+    return bvec, bval
+
+
+def hd_bet(positional, options):
+    in_path, out_path = options["-i"][0], options["-o"][0]
+    if op.isdir(in_path):
+        os.makedirs(out_path, exist_ok=True)
+        pairs = [(op.join(in_path, f), op.join(out_path, f))
+                 for f in sorted(os.listdir(in_path))
+                 if f.endswith(".nii.gz")]
+    else:
+        pairs = [(in_path, out_path)]
+    for in_file, out_file in pairs:
+        data, affine = load(in_file)
+        mask = brain_mask(data.shape)
+        save(np.where(mask, data, 0).astype(np.float32), affine, out_file)
+        save(mask.astype(np.uint8), affine,
+             out_file[:-len(".nii.gz")] + "_mask.nii.gz")
+
+
+def synb0(positional, options):
+    # Distorted and synthesised undistorted b0, in the working directory
+    b0, affine = load(positional[0])
+    save(np.stack([b0, b0], axis=-1).astype(np.float32), affine,
+         "b0_all.nii.gz")
+
+
+def mri_nu_correct(positional, options):
+    copy_image(options["--i"][0], options["--o"][0])
+
+
+def mri_normalize(positional, options):
+    copy_image(*positional[-2:])
+
+
+def write_transform(path):
+    # Identity, in the text format of the tool
+    with open(path, "w") as f:
+        if path.endswith(".mat"):
+            f.write("1 0 0 0\n0 1 0 0\n0 0 1 0\n0 0 0 1\n")
+        else:
+            f.write("#Insight Transform File V1.0\n#Transform 0\n"
+                    "Transform: MatrixOffsetTransformBase_double_3_3\n"
+                    "Parameters: 1 0 0 0 1 0 0 0 1 0 0 0\n"
+                    "FixedParameters: 0 0 0\n")
+
+
+def onto(in_file, reference, out_file):
+    """in_file resampled onto the grid of reference."""
+    data, affine = load(in_file)
+    ref, ref_affine = load(reference)
+    save(regrid(data, affine, ref.shape, ref_affine).astype(np.float32),
+         ref_affine, out_file)
+
+
+def epi_reg(positional, options):
+    out = options["--out"][0]
+    t1 = options["--t1"][0]
+    onto(options["--epi"][0], t1, out + ".nii.gz")
+    write_transform(out + ".mat")
+    data, affine = load(options["--t1brain"][0])
+    for suffix in ["_fast_wmseg", "_fast_wmedge", "_fast_seg"]:
+        save((data > 0).astype(np.uint8), affine, out + suffix + ".nii.gz")
+
+
+def c3d_affine_tool(positional, options):
+    write_transform(options["-oitk"][0])
+
+
+def ants_registration(positional, options):
+    prefix = options["-o"][0]
+    fixed, moving = options["-f"][0], options["-m"][0]
+    # Written by the real tool in binary ITK format
+    write_transform(prefix + "0GenericAffine.mat")
+    onto(moving, fixed, prefix + "Warped.nii.gz")
+    onto(fixed, moving, prefix + "InverseWarped.nii.gz")
+
+
+def ants_apply_transforms(positional, options):
+    onto(options["--input"][0], options["--reference-image"][0],
+         options["--output"][0])
+
+
+def fslmaths(positional, options):
+    copy_image(*positional[-2:])
+
+
+def synb0_inference(positional, options):
+    # Undistorted b0 in atlas space from the T1 and distorted b0
+    t1, b0, out_file = positional[:3]
+    copy_image(b0, out_file)
+
+
+def dwifslpreproc(positional, options):
+    in_file, out_file = positional[:2]
+    data, affine = load(in_file)
+    save(data.astype(np.float32), affine, out_file)
+    bvec, bval = grad_files(options)
+    out_bvec, out_bval = options["-export_grad_fsl"]
+    for src, dst in [(bvec, out_bvec), (bval, out_bval)]:
+        with open(src) as f_in, open(dst, "w") as f_out:
+            f_out.write(f_in.read())
+    if "-eddyqc_text" in options:
+        # Motion (absolute and relative RMS, mm) and an outlier map with
+        # a few outlier slices
+        qc_dir = options["-eddyqc_text"][0]
+        os.makedirs(qc_dir, exist_ok=True)
+        rng = np.random.default_rng(random.Random(in_file).getrandbits(32))
+        n_volumes = data.shape[3] if data.ndim > 3 else 1
+        rms = np.abs(rng.normal(0, [0.5, 0.2], size=(n_volumes, 2)))
+        rms[0, 1] = 0
+        np.savetxt(op.join(qc_dir, "eddy_movement_rms"), rms, fmt="%.4f")
+        outliers = rng.random((n_volumes, data.shape[2])) < 0.01
+        with open(op.join(qc_dir, "eddy_outlier_map"), "w") as f:
+            f.write("One row per scan, one column per slice. Outlier: 1\n")
+            np.savetxt(f, outliers, fmt="%d")
+
+
+def copy_image(in_file, out_file):
+    data, affine = load(in_file)
+    save(data.astype(np.float32), affine, out_file)
+
+
+def dwibiascorrect(positional, options):
+    copy_image(*positional[-2:])
+
+
+def dwi2response(positional, options):
+    in_file, wm, gm, csf = positional[-4:]
+    bvals = read_bvals(grad_files(options)[1])
+    shells = sorted({0 if b <= bzero_threshold else int(round(b, -2))
+                     for b in bvals})
+    rng = random.Random(in_file)
+    header = "# Shells: %s\n" % ",".join(str(s) for s in shells)
+    wm_rows = []
+    for shell in shells:
+        attenuation = np.exp(-shell / 3000)
+        row = [rng.uniform(2000, 3000) * attenuation, 0, 0, 0, 0]
+        if shell:
+            row[1:] = [-rng.uniform(500, 1000) * attenuation,
+                       rng.uniform(100, 200) * attenuation,
+                       -rng.uniform(10, 30) * attenuation,
+                       rng.uniform(1, 5) * attenuation]
+        wm_rows.append(row)
+    for path, rows in [
+            (wm, wm_rows),
+            (gm, [[rng.uniform(1000, 2000) * np.exp(-s / 1500)]
+                  for s in shells]),
+            (csf, [[rng.uniform(3000, 5000) * np.exp(-s / 300)]
+                   for s in shells])]:
+        with open(path, "w") as f:
+            f.write(header)
+            for row in rows:
+                f.write(" ".join("%.6g" % v for v in row) + "\n")
+
+
+def responsemean(positional, options):
+    *in_files, out_file = positional
+    with open(in_files[0]) as f:
+        header = [line for line in f if line.startswith("#")]
+    mean = np.mean([np.atleast_2d(np.loadtxt(f)) for f in in_files], axis=0)
+    with open(out_file, "w") as f:
+        f.writelines(header)
+        for row in mean:
+            f.write(" ".join("%.6g" % v for v in row) + "\n")
+
+
+def mrgrid(positional, options):
+    in_file, operation, out_file = positional[:3]
+    data, affine = load(in_file)
+    if operation == "regrid":
+        if "-template" in options:
+            template, target = load(options["-template"][0])
+            shape = template.shape[:3]
+        else:
+            vox = float(options["-vox"][0])
+            in_vox = np.linalg.norm(affine[:3, :3], axis=0)
+            shape = tuple(int(round(n * v / vox))
+                          for n, v in zip(data.shape[:3], in_vox))
+            directions = affine[:3, :3] / in_vox
+            target = affine.copy()
+            target[:3, :3] = directions * vox
+            # Same field of view: the first voxel's corner stays put
+            target[:3, 3] += directions @ ((vox - in_vox) / 2)
+        out = regrid(data, affine, shape, target)
+    elif operation == "crop":
+        mask = load(options["-mask"][0])[0] if "-mask" in options else data
+        margin = -int(options.get("-uniform", ["0"])[0])
+        nonzero = np.argwhere(mask.reshape(mask.shape[:3] + (-1,))
+                              .any(axis=-1))
+        if len(nonzero):
+            lower = np.maximum(nonzero.min(axis=0) - margin, 0)
+            upper = np.minimum(nonzero.max(axis=0) + 1 + margin,
+                               data.shape[:3])
+        else:
+            lower, upper = np.zeros(3, int), np.array(data.shape[:3])
+        out = data[tuple(slice(a, b) for a, b in zip(lower, upper))]
+        target = affine.copy()
+        target[:3, 3] += affine[:3, :3] @ lower
+    elif operation == "pad":
+        template, target = load(options["-as"][0])
+        # Where the input's first voxel sits in the template grid
+        start = np.rint(np.linalg.solve(target[:3, :3],
+                                        affine[:3, 3] - target[:3, 3])
+                        ).astype(int)
+        out = np.zeros(template.shape[:3] + data.shape[3:], data.dtype)
+        region = tuple(slice(s, s + n) for s, n in zip(start, data.shape))
+        out[region] = data
+    else:
+        raise ValueError("mrgrid stub: unsupported operation %s" % operation)
+    save(out, target, out_file)
+
+
+def dwi2mask(positional, options):
+    in_file, out_file = positional[-2:]
+    data, affine = load(in_file)
+    save(brain_mask(data.shape).astype(np.uint8), affine, out_file)
+
+
+def dwiextract(positional, options):
+    in_file, out_file = positional[-2:]
+    data, affine = load(in_file)
+    bvals = read_bvals(grad_files(options)[1])
+    save(data[..., bvals <= bzero_threshold].astype(np.float32), affine,
+         out_file)
+
+
+def mrmath(positional, options):
+    in_file, operation, out_file = positional[-3:]
+    data, affine = load(in_file)
+    axis = int(options.get("-axis", ["3"])[0])
+    save(getattr(np, operation)(data, axis=axis).astype(np.float32), affine,
+         out_file)
+
+
+def mrconvert(positional, options):
+    if "--version" in options:
+        print("== mrconvert 3.0.4 ==")
+        return
+    copy_image(*positional[-2:])
+
+
+def ss3t(positional, options):
+    in_file, _, wmfod, _, gm, _, csf = positional[:7]
+    data, affine = load(in_file)
+    shape = data.shape[:3]
+    # lmax 8 for the WM FOD, a single volume for GM and CSF
+    save(np.zeros(shape + (45,), np.float32), affine, wmfod)
+    save(np.zeros(shape, np.float32), affine, gm)
+    save(np.zeros(shape, np.float32), affine, csf)
+
+
+def mtnormalise(positional, options):
+    for in_file, out_file in zip(positional[0::2], positional[1::2]):
+        copy_image(in_file, out_file)
+
+
+def dot(positional, options):
+    # Empty graph image for write_graph
+    out_file = [a[2:] for a in sys.argv[1:] if a.startswith("-o")][0]
+    open(out_file, "wb").close()
+
+
+tools = {
+    "hd-bet": hd_bet,
+    "pipeline.sh": synb0,
+    "mri_nu_correct.mni": mri_nu_correct,
+    "mri_normalize": mri_normalize,
+    "epi_reg": epi_reg,
+    "c3d_affine_tool": c3d_affine_tool,
+    "antsRegistrationSyNQuick.sh": ants_registration,
+    "antsApplyTransforms": ants_apply_transforms,
+    "fslmaths": fslmaths,
+    "inference.py": synb0_inference,
+    "dwifslpreproc": dwifslpreproc,
+    "dwibiascorrect": dwibiascorrect,
+    "dwi2response": dwi2response,
+    "responsemean": responsemean,
+    "mrgrid": mrgrid,
+    "dwi2mask": dwi2mask,
+    "dwiextract": dwiextract,
+    "mrmath": mrmath,
+    "mrconvert": mrconvert,
+    "ss3t_csd_beta1": ss3t,
+    "mtnormalise": mtnormalise,
+    "dot": dot,
+}
+
+
+def tool_profile(tool):
+    profile = {name: dict(values) for name, values in default_profile.items()}
+    if os.environ.get("BENCH_PROFILE"):
+        with open(os.environ["BENCH_PROFILE"]) as f:
+            for name, values in json.load(f).items():
+                profile.setdefault(name, {}).update(values)
+    values = profile.get(tool, {})
+    return (values.get("seconds", 0) * float(os.environ.get("BENCH_SCALE", 1)),
+            values.get("mem_gb", 0), values.get("busy", 0))
+
+
+def spend(seconds, mem_gb, busy, n_threads):
+    """Hold mem_gb of memory for seconds, computing on n_threads cores for
+    busy of the time."""
+    ballast = b"\1" * int(mem_gb * 1024 ** 3)  # noqa: F841, touches pages
+    end = time.time() + seconds
+    busy_end = time.time() + seconds * busy
+    children = []
+    for _ in range(n_threads - 1 if busy else 0):
+        pid = os.fork()
+        if pid == 0:
+            while time.time() < busy_end:
+                pass
+            os._exit(0)
+        children.append(pid)
+    while time.time() < busy_end:
+        pass
+    for pid in children:
+        os.waitpid(pid, 0)
+    time.sleep(max(end - time.time(), 0))
+
+
+if __name__ == "__main__":
+    tool = op.basename(sys.argv[0])
+    if tool not in tools:
+        sys.exit("bench_stub.py: run it through a link named after a tool "
+                 "(%s)" % ", ".join(sorted(tools)))
+    start = time.time()
+    positional, options = parse_args(sys.argv[1:])
+    tools[tool](positional, options)
+    seconds, mem_gb, busy = tool_profile(tool)
+    n_threads = int(options.get("-nthreads", ["1"])[0])
+    spend(seconds, mem_gb, busy, n_threads)
+    if os.environ.get("BENCH_LOG"):
+        # Short lines in append mode, so concurrent tools do not interleave
+        with open(os.environ["BENCH_LOG"], "a") as f:
+            f.write(json.dumps({"tool": tool, "start": start,
+                                "end": time.time()}) + "\n")
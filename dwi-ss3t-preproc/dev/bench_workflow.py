@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+
+#####
+# Run run.py's real workflow graph on a synthetic BIDS cohort, with every
+# external tool replaced by dev/bench_stub.py, to measure the pipeline's
+# own overheads without FreeSurfer, eddy or SS3T:
+#
+#   python3 dev/bench_workflow.py --subjects 100 --n-procs 16
+#   python3 dev/bench_workflow.py --subjects 1000 --scale 0 --json bench.jsonl
+#
+# The stubs write images shaped as the real tools' outputs and take the
+# node_runtimes of run.py times --scale (or a --profile, see
+# dev/bench_stub.py). run.py runs as it is, with the options set in it,
+# against a fresh base directory (BASE_DIR). Reported:
+#
+#   startup     launch to the first job starting (imports, graph expansion,
+#               hashing)
+#   throughput  subjects per hour of wall time
+#   tools       time the stubs took, summed
+#   per job     job wall time beyond the tool's, nipype's own work per node
+#   dispatch    median wait from a job's inputs being ready to it starting,
+#               while cores were free
+#   busy        share of the cores' time booked by running jobs
+#   I/O         bytes read from and written to disk by the run, and the
+#               size of the output tree
+#
+# A rerun over the finished tree (--rerun) times the startup of a run with
+# nothing left to do. --json appends the results to a file, to compare
+# commits.
+#####
+
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+import os.path as op
+import numpy as np
+
+code_dir = op.join(op.dirname(op.abspath(__file__)), "..")
+sys.path.insert(0, code_dir)
+from src.image_io import save_nifti  # noqa: E402
+from src.profiling import io_bytes  # noqa: E402
+
+stub = op.join(op.dirname(op.abspath(__file__)), "bench_stub.py")
+stub_tools = ["hd-bet", "pipeline.sh", "dwifslpreproc", "dwibiascorrect",
+              "dwi2response", "responsemean", "mrgrid", "dwi2mask",
+              "dwiextract", "mrmath", "mrconvert", "ss3t_csd_beta1",
+              "mtnormalise", "dot", "mri_nu_correct.mni", "mri_normalize",
+              "epi_reg", "c3d_affine_tool", "antsRegistrationSyNQuick.sh",
+              "antsApplyTransforms", "fslmaths", "inference.py"]
+
+
+def parse_shape(value):
+    return tuple(int(n) for n in value.split(","))
+
+
+def make_subject(subject_dir, subject, dwi_shape, t1_shape, seed=0):
+    """Write a subject's T1w and DWI (every 8th volume a b0) in BIDS
+    layout."""
+    rng = np.random.default_rng(seed)
+    anat_dir = op.join(subject_dir, "anat")
+    dwi_dir = op.join(subject_dir, "dwi")
+    os.makedirs(anat_dir)
+    os.makedirs(dwi_dir)
+
+    def phantom(shape, vox, signal):
+        """Noisy ellipsoid of signal (per volume for 4D shapes)."""
+        axes = np.ogrid[tuple(slice(0, n) for n in shape[:3])]
+        brain = sum(((a - (n - 1) / 2) / (0.4 * n)) ** 2
+                    for a, n in zip(axes, shape[:3])) <= 1
+        if len(shape) > 3:
+            brain = brain[..., None]
+        data = brain * signal + rng.normal(0, 10, shape)
+        affine = np.diag([vox, vox, vox, 1.0])
+        affine[:3, 3] = -np.array(shape[:3]) * vox / 2
+        return np.clip(data, 0, None).astype(np.int16), affine
+
+    t1, affine = phantom(t1_shape, 1.0, 500)
+    save_nifti(t1, affine, op.join(anat_dir, "%s_T1w.nii.gz" % subject))
+
+    n_volumes = dwi_shape[3]
+    bvals = np.where(np.arange(n_volumes) % 8 == 0, 0, 1000)
+    bvecs = rng.normal(size=(3, n_volumes))
+    bvecs /= np.linalg.norm(bvecs, axis=0)
+    bvecs[:, bvals == 0] = 0
+    dwi, affine = phantom(dwi_shape, 2.5, np.where(bvals == 0, 1000, 300))
+    prefix = op.join(dwi_dir, "%s_dwi" % subject)
+    save_nifti(dwi, affine, prefix + ".nii.gz")
+    np.savetxt(prefix + ".bval", bvals[None], fmt="%d")
+    np.savetxt(prefix + ".bvec", bvecs, fmt="%.6f")
+
+
+def make_cohort(input_dir, n_subjects, dwi_shape, t1_shape):
+    """Cohort of n_subjects, hard links of the first subject's files."""
+    subjects = ["sub-%04d" % (i + 1) for i in range(n_subjects)]
+    first = op.join(input_dir, subjects[0])
+    make_subject(first, subjects[0], dwi_shape, t1_shape)
+    for subject in subjects[1:]:
+        for root, _, files in os.walk(first):
+            dest = op.join(input_dir, subject, op.relpath(root, first))
+            os.makedirs(dest, exist_ok=True)
+            for name in files:
+                target = op.join(dest, name.replace(subjects[0], subject))
+                try:
+                    os.link(op.join(root, name), target)
+                except OSError:
+                    shutil.copy2(op.join(root, name), target)
+    return subjects
+
+
+def make_synb0_dir(synb0_dir, t1_shape, num_folds=5):
+    """Atlases and (empty) model files laid out as in /opt/Synb0-DISCO, for
+    run.py with split_synb0."""
+    atlas_dir = op.join(synb0_dir, "atlases")
+    model_dir = op.join(synb0_dir, "src", "train_lin")
+    os.makedirs(atlas_dir)
+    os.makedirs(model_dir)
+    for vox, suffix in [(1.0, ""), (2.5, "_2_5")]:
+        shape = tuple(int(round(n / vox)) for n in t1_shape)
+        affine = np.diag([vox, vox, vox, 1.0])
+        affine[:3, 3] = -np.array(shape) * vox / 2
+        save_nifti(np.zeros(shape, np.float32), affine, op.join(
+            atlas_dir, "mni_icbm152_t1_tal_nlin_asym_09c%s.nii.gz" % suffix))
+    for fold in range(1, num_folds + 1):
+        open(op.join(model_dir, "num_fold_%d_total_folds_%d_seed_1_"
+                     "num_epoch_100.pth" % (fold, num_folds)), "w").close()
+
+
+def tree_bytes(path):
+    """Disk used under path, counting hard linked files once."""
+    seen, total = set(), 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            st = os.lstat(op.join(root, name))
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                total += st.st_blocks * 512
+    return total
+
+
+def run_pipeline(env, log_path):
+    """Run run.py, returning its start and end times and the bytes it read
+    and wrote."""
+    read_start, write_start = io_bytes()
+    start = time.time()
+    with open(log_path, "a") as log:
+        result = subprocess.run([sys.executable, op.join(code_dir, "run.py")],
+                                cwd=code_dir, env=env, stdout=log,
+                                stderr=subprocess.STDOUT)
+    end = time.time()
+    if result.returncode:
+        raise RuntimeError("run.py failed (exit %d), see %s"
+                           % (result.returncode, log_path))
+    # Reaped children are counted in this process's I/O (Linux only)
+    read_end, write_end = io_bytes()
+    io = (None, None)
+    if read_end is not None:
+        io = (read_end - read_start, write_end - write_start)
+    return start, end, io
+
+
+def job_stats(db_path, start, n_procs):
+    """Startup, dispatch delay and core use from the profile database, for
+    the jobs of runs started after start."""
+    if not op.exists(db_path):
+        return {}
+    db = sqlite3.connect(db_path)
+    runs = db.execute("SELECT run_id, edges FROM runs WHERE start >= ?",
+                      (start,)).fetchall()
+    if not runs:
+        return {}
+    marks = ",".join("?" * len(runs))
+    jobs = db.execute("SELECT subject, node, n_procs, start, end FROM jobs "
+                      "WHERE run_id IN (%s) ORDER BY start" % marks,
+                      [r[0] for r in runs]).fetchall()
+    db.close()
+    if not jobs:
+        return {}
+
+    predecessors = {}
+    for run in runs:
+        for u, v in json.loads(run[1] or "[]"):
+            predecessors.setdefault(v, set()).add(u)
+    ends = {(s, n): e for s, n, _, _, e in jobs}
+    delays = []
+    for subject, node, n, job_start, _ in jobs:
+        # Inputs from the same subject's nodes or from group nodes
+        ready = [ends.get((subject, p), ends.get(("", p)))
+                 for p in predecessors.get(node, ())]
+        ready = [r for r in ready if r is not None]
+        if not ready:
+            continue
+        ready = max(ready)
+        running = sum(j[2] for j in jobs if j[3] <= ready < j[4])
+        if running + n <= n_procs:
+            delays.append(job_start - ready)
+
+    first, last = jobs[0][3], max(j[4] for j in jobs)
+    booked = sum(min(n, n_procs) * (e - s) for _, _, n, s, e in jobs)
+    return {"jobs": len(jobs), "startup_s": first - start,
+            "job_s": sum(e - s for _, _, _, s, e in jobs),
+            "dispatch_s": float(np.median(delays)) if delays else None,
+            "busy": booked / (n_procs * max(last - first, 1e-9))}
+
+
+def tool_seconds(log_path, start):
+    if not op.exists(log_path):
+        return 0
+    with open(log_path) as f:
+        calls = [json.loads(line) for line in f]
+    return sum(c["end"] - c["start"] for c in calls if c["start"] >= start)
+
+
+def report(label, results):
+    print(label)
+    for name, value, unit in results:
+        if value is not None:
+            print("  %-12s %10.2f %s" % (name, value, unit))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline "
+                                     "with stub tools")
+    parser.add_argument("--subjects", type=int, default=10)
+    parser.add_argument("--n-procs", type=int, default=8,
+                        help="NCPUS for run.py (default 8)")
+    parser.add_argument("--mem-gb", type=float, default=32,
+                        help="MEM_GB for run.py (default 32)")
+    parser.add_argument("--scale", type=float, default=0.001,
+                        help="Factor on the stub tools' seconds "
+                        "(default 0.001)")
+    parser.add_argument("--profile",
+                        help="json of tool seconds/mem_gb/busy, see "
+                        "dev/bench_stub.py")
+    parser.add_argument("--dwi-shape", type=parse_shape,
+                        default=(24, 28, 20, 17),
+                        help="DWI dimensions at 2.5 mm (default "
+                        "24,28,20,17)")
+    parser.add_argument("--t1-shape", type=parse_shape,
+                        default=(48, 56, 48),
+                        help="T1w dimensions at 1 mm (default 48,56,48)")
+    parser.add_argument("--base-dir",
+                        help="Base directory to run in (default: a "
+                        "temporary directory, removed afterwards)")
+    parser.add_argument("--rerun", action="store_true",
+                        help="Also time a rerun over the finished tree")
+    parser.add_argument("--json",
+                        help="Append the results as a json line to this file")
+    args = parser.parse_args()
+
+    base_dir = args.base_dir or tempfile.mkdtemp(prefix="bench_workflow_")
+    input_dir = op.join(base_dir, "imaging_data", "input")
+    deriv_dir = op.join(base_dir, "imaging_data", "output")
+    bin_dir = op.join(base_dir, "bin")
+    try:
+        start = time.time()
+        make_cohort(input_dir, args.subjects, args.dwi_shape, args.t1_shape)
+        print("%d subjects written in %.1f s, %.1f MB each"
+              % (args.subjects, time.time() - start,
+                 tree_bytes(op.join(input_dir, "sub-0001")) / 1024 ** 2))
+
+        os.makedirs(bin_dir)
+        for tool in stub_tools:
+            os.symlink(stub, op.join(bin_dir, tool))
+        make_synb0_dir(op.join(base_dir, "synb0"), args.t1_shape)
+        env = dict(os.environ,
+                   PATH=bin_dir + os.pathsep + os.environ["PATH"],
+                   BASE_DIR=base_dir,
+                   SYNB0_CMD=op.join(bin_dir, "pipeline.sh"),
+                   SYNB0_DIR=op.join(base_dir, "synb0"),
+                   SYNB0_INFERENCE_CMD=op.join(bin_dir, "inference.py"),
+                   FSLOUTPUTTYPE="NIFTI_GZ",
+                   SS3T_CMD=op.join(bin_dir, "ss3t_csd_beta1"),
+                   NCPUS=str(args.n_procs), MEM_GB=str(args.mem_gb),
+                   BENCH_SCALE=str(args.scale),
+                   BENCH_LOG=op.join(base_dir, "stub_calls.jsonl"))
+        env.pop("WALLTIME", None)
+        if args.profile:
+            env["BENCH_PROFILE"] = op.abspath(args.profile)
+        log_path = op.join(base_dir, "run.log")
+
+        start, end, (read, written) = run_pipeline(env, log_path)
+        wall = end - start
+        stats = job_stats(op.join(deriv_dir, "profile.sqlite"), start,
+                          args.n_procs)
+        tools = tool_seconds(env["BENCH_LOG"], start)
+        results = {
+            "wall_s": wall,
+            "startup_s": stats.get("startup_s"),
+            "subjects_per_h": args.subjects / wall * 3600,
+            "tool_s": tools,
+            "per_job_s": ((stats["job_s"] - tools) / stats["jobs"]
+                          if stats else None),
+            "dispatch_s": stats.get("dispatch_s"),
+            "busy": stats.get("busy"),
+            "read_gb": read and read / 1024 ** 3,
+            "written_gb": written and written / 1024 ** 3,
+            "output_gb": tree_bytes(deriv_dir) / 1024 ** 3,
+        }
+        report("Run (%d subjects, %d jobs)" % (args.subjects,
+                                               stats.get("jobs", 0)), [
+            ("wall", wall, "s"),
+            ("startup", results["startup_s"], "s"),
+            ("throughput", results["subjects_per_h"], "subjects/h"),
+            ("tools", tools, "s"),
+            ("per job", results["per_job_s"], "s"),
+            ("dispatch", results["dispatch_s"], "s"),
+            ("busy", results["busy"] and 100 * results["busy"], "%"),
+            ("read", results["read_gb"], "GB"),
+            ("written", results["written_gb"], "GB"),
+            ("output", results["output_gb"], "GB"),
+        ])
+
+        if args.rerun:
+            start, end, _ = run_pipeline(env, log_path)
+            results["rerun_s"] = end - start
+            report("Rerun, nothing to do", [("wall", end - start, "s")])
+
+        if args.json:
+            commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                                    cwd=code_dir, stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL,
+                                    universal_newlines=True).stdout.strip()
+            with open(args.json, "a") as f:
+                f.write(json.dumps(dict(
+                    results, time=time.time(), commit=commit,
+                    subjects=args.subjects, n_procs=args.n_procs,
+                    scale=args.scale, profile=args.profile,
+                    dwi_shape=args.dwi_shape)) + "\n")
+    finally:
+        if not args.base_dir:
+            shutil.rmtree(base_dir, ignore_errors=True)
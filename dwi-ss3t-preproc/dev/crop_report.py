@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+#####
+# Compare voxel counts, wall time and peak memory of the upsampled stages
+# between working directories, e.g. runs with and without crop_to_brain:
+#
+#   python3 dev/crop_report.py output/dwi_ss3t_preproc_wf other/dwi_ss3t_preproc_wf
+#
+# Peak memory is only recorded when the run had resource_monitor enabled
+# in the nipype config.
+#####
+
+import sys
+import glob
+import os.path as op
+import numpy as np
+from nipype.utils.filemanip import loadpkl
+
+sys.path.insert(0, op.join(op.dirname(op.abspath(__file__)), ".."))
+from src.image_io import load_image  # noqa: E402
+
+nodes = ["upsample", "hdbet_dwi_upsamp", "ss3t", "mtnormalise"]
+
+
+def node_stats(node_dir):
+    results = glob.glob(op.join(node_dir, "result_*.pklz"))
+    if not results:
+        return None
+    result = loadpkl(results[0])
+    stats = {"duration": getattr(result.runtime, "duration", np.nan),
+             "mem_peak_gb": getattr(result.runtime, "mem_peak_gb", np.nan)}
+    if op.basename(node_dir) == "upsample":
+        data, _, _ = load_image(result.outputs.out_file)
+        stats["voxels"] = int(np.prod(data.shape[:3]))
+    return stats
+
+
+if __name__ == "__main__":
+    for wf_dir in sys.argv[1:]:
+        print(wf_dir)
+        print("  %-18s %8s %12s %12s %14s" % ("node", "subjects", "voxels",
+                                            "wall (s)", "peak RSS (GB)"))
+        for node in nodes:
+            stats = [node_stats(d) for d in
+                     sorted(glob.glob(op.join(wf_dir, "_subject_id_*", node)))]
+            stats = [s for s in stats if s]
+            if not stats:
+                continue
+            voxels = ("%d" % np.mean([s["voxels"] for s in stats])
+                      if "voxels" in stats[0] else "")
+            peaks = [s["mem_peak_gb"] for s in stats
+                     if not np.isnan(s["mem_peak_gb"])]
+            print("  %-18s %8d %12s %12.1f %14s" % (
+                node, len(stats), voxels,
+                np.mean([s["duration"] for s in stats]),
+                "%.2f" % max(peaks) if peaks else "n/a"))
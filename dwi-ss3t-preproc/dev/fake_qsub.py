@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+#####
+# Local stand-in for PBS qsub
+#
+# Runs the job script straight away with bash, once per array index, with
+# the -v variables and PBS_ARRAY_INDEX/PBS_JOBID set. Jobs run in submission
+# order, so afterok dependencies are honoured by skipping any job whose
+# dependency failed. A job submitting another (a walltime continuation)
+# runs it before carrying on. Job output goes to <script>.o<id>[.<index>] in the
+# current directory, like PBS -j oe. Submissions are appended to
+# $FAKE_QSUB_LOG (JSON lines) if it is set.
+#
+#   QSUB=dev/fake_qsub.py python3 src/pbs.py --n-shards 2 dev/local_run.sh
+#####
+
+import os
+import sys
+import json
+import time
+import fcntl
+import argparse
+import subprocess
+from pathlib import Path
+from contextlib import contextmanager
+
+state_file = Path(os.environ.get("FAKE_QSUB_STATE", "/tmp/fake_qsub_state.json"))
+
+
+@contextmanager
+def locked_state():
+    """The state, written back on exit. Jobs can be submitted at the same
+    time, e.g. continuations of array sub jobs."""
+    with open("%s.lock" % state_file, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = {"next_id": 1, "failed": []}
+        if state_file.exists():
+            state = json.loads(state_file.read_text())
+        yield state
+        state_file.write_text(json.dumps(state))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-J", dest="array")
+    parser.add_argument("-W", dest="attrs", action="append", default=[])
+    parser.add_argument("-v", dest="variables", default="")
+    parser.add_argument("-l", dest="resources", action="append", default=[])
+    parser.add_argument("-N", dest="name")
+    parser.add_argument("script")
+    args = parser.parse_args()
+
+    # Saved now for jobs submitted from within this one
+    with locked_state() as state:
+        job_id = "%d%s.fake" % (state["next_id"], "[]" if args.array else "")
+        state["next_id"] += 1
+        failed = list(state["failed"])
+
+    env = dict(os.environ)
+    for item in filter(None, args.variables.split(",")):
+        key, _, value = item.partition("=")
+        env[key] = value
+
+    depends = [d for a in args.attrs if a.startswith("depend=afterok:")
+               for d in a.split(":")[1:]]
+    skip = any(d in failed for d in depends)
+
+    indices = [None]
+    if args.array:
+        first, last = args.array.split("-")
+        indices = range(int(first), int(last) + 1)
+
+    returncodes = []
+    for index in [] if skip else indices:
+        env["PBS_JOBID"] = job_id
+        number = job_id.split("[")[0].split(".")[0]
+        output = "%s.o%s" % (Path(args.script).name, number)
+        if index is not None:
+            env["PBS_ARRAY_INDEX"] = str(index)
+            output += ".%d" % index
+        with open(output, "w") as out:
+            returncodes.append(subprocess.call(
+                ["bash", args.script], env=env, stdout=out,
+                stderr=subprocess.STDOUT))
+
+    if skip or any(returncodes):
+        with locked_state() as state:
+            state["failed"].append(job_id)
+
+    log = os.environ.get("FAKE_QSUB_LOG")
+    if log:
+        with open(log, "a") as f:
+            f.write(json.dumps({"job_id": job_id, "argv": sys.argv[1:],
+                                "skipped": skip, "returncodes": returncodes,
+                                "time": time.time()}) + "\n")
+
+    print(job_id)
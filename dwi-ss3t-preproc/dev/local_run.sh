@@ -0,0 +1,22 @@
+#!/bin/bash
+
+# Local equivalent of submit_run.pbs (no module/singularity), for use
+# with fake_qsub.py
+
+cd "$(dirname "$0")/.." || exit
+
+# SIGTERM (the walltime limit) is passed on to run.py, see submit_run.pbs
+python3 ./run.py --phase ${PHASE:-all} --n-shards ${N_SHARDS:-1} &
+pid=$!
+trap 'kill -TERM ${pid} 2>/dev/null' TERM
+wait ${pid}
+status=$?
+while kill -0 ${pid} 2>/dev/null; do
+    wait ${pid}
+    status=$?
+done
+
+if [ ${status} -eq 75 ]; then
+    python3 ./src/pbs.py --continuation "${SUBMIT_SCRIPT:-$0}" && exit 0
+fi
+exit ${status}
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+#####
+# Compare the chunked regrid (chunked_upsample, src/regrid.py) with mrgrid
+# on a subject's bias corrected DWI, e.g. in the container:
+#
+#   python3 dev/regrid_check.py \
+#       <wf_dir>/_subject_id_sub-01/biascorrect/dwi_preproc_biascorr.mif
+#
+# Both regrid to --vox (1.5 mm as upsample), the grids must be the same and
+# the differences are reported relative to the 99th percentile of the
+# mrgrid output, with the time of each.
+#####
+
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+import os.path as op
+import numpy as np
+
+sys.path.insert(0, op.join(op.dirname(op.abspath(__file__)), ".."))
+from src.image_io import load_image  # noqa: E402
+from src.regrid import regrid  # noqa: E402
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chunked regrid against "
+                                     "mrgrid")
+    parser.add_argument("in_file", help="4D image (.mif)")
+    parser.add_argument("--vox", type=float, default=1.5)
+    parser.add_argument("--n-procs", type=int, default=4)
+    parser.add_argument("--memory-gb", type=float, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        mrgrid_file = op.join(tmp, "mrgrid.mif")
+        start = time.time()
+        subprocess.run(["mrgrid", args.in_file, "regrid", "-vox",
+                        str(args.vox), mrgrid_file, "-nthreads",
+                        str(args.n_procs), "-quiet"], check=True)
+        mrgrid_s = time.time() - start
+
+        chunked_file = op.join(tmp, "chunked.mif")
+        start = time.time()
+        regrid(args.in_file, chunked_file, vox=args.vox,
+               n_workers=args.n_procs, memory_gb=args.memory_gb)
+        chunked_s = time.time() - start
+
+        expected, expected_affine, scaling = load_image(mrgrid_file)
+        result, affine, _ = load_image(chunked_file)
+        if expected.shape != result.shape:
+            raise SystemExit("Grids differ: %s from mrgrid, %s chunked"
+                             % (expected.shape, result.shape))
+        print("grid         same shape %s, affine max diff %.2g mm"
+              % (result.shape, np.abs(affine - expected_affine).max()))
+
+        scale = None
+        diffs = []
+        for v in range(result.shape[3] if result.ndim > 3 else 1):
+            e = np.asarray(expected[..., v] if result.ndim > 3 else expected,
+                           dtype=np.float64)
+            e = scaling[0] + scaling[1] * e
+            r = np.asarray(result[..., v] if result.ndim > 3 else result)
+            if scale is None:
+                scale = np.percentile(np.abs(e), 99) or 1
+            diffs.append(np.abs(r - e) / scale)
+        diffs = np.concatenate([d.ravel() for d in diffs])
+        print("difference   median %.2g, p99 %.2g, max %.2g (of the p99 "
+              "intensity)" % (np.median(diffs), np.percentile(diffs, 99),
+                              diffs.max()))
+        print("mrgrid       %.1f s" % mrgrid_s)
+        print("chunked      %.1f s" % chunked_s)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+#####
+# How far the group responses used for the FODs (e.g. built from a subset
+# with response_subjects) are from the mean over every subject with a
+# response_func output in the working directory:
+#
+#   python3 dev/response_report.py output/dwi_ss3t_preproc_wf
+#
+# The full mean is made with responsemean when it is on the PATH (as the
+# pipeline does), otherwise by averaging the coefficients directly. Run it
+# once response_func has finished for the whole cohort.
+#####
+
+import sys
+import glob
+import shutil
+import tempfile
+import subprocess
+import os.path as op
+import numpy as np
+
+
+def read_response(path):
+    """Response coefficients, one row per b-value shell."""
+    rows = [line.split() for line in open(path)
+            if line.strip() and not line.startswith("#")]
+    return np.array(rows, dtype=float)
+
+
+def full_mean(files):
+    if shutil.which("responsemean"):
+        with tempfile.TemporaryDirectory() as tmp:
+            out = op.join(tmp, "mean.txt")
+            subprocess.run(["responsemean"] + files + [out, "-quiet"],
+                           check=True)
+            return read_response(out), "responsemean"
+    return np.mean([read_response(f) for f in files], axis=0), "average"
+
+
+if __name__ == "__main__":
+    wf_dir = sys.argv[1]
+    print("%-5s %9s %14s %14s %16s" % ("", "subjects", "rel. diff",
+                                       "max l=0 diff", "between-subj CV"))
+    method = None
+    for tissue in ["wm", "gm", "csf"]:
+        files = sorted(glob.glob(op.join(wf_dir, "_subject_id_*", "response_fuc",
+                                         "response_%s.txt" % tissue)))
+        used_file = op.join(wf_dir, "response_mean_%s" % tissue,
+                            "mean_response_%s.txt" % tissue)
+        if not files or not op.exists(used_file):
+            print("%-5s no responses found" % tissue)
+            continue
+
+        used = read_response(used_file)
+        full, method = full_mean(files)
+        l0 = np.array([read_response(f)[:, 0] for f in files])
+
+        rel_diff = np.linalg.norm(used - full) / np.linalg.norm(full)
+        l0_diff = np.max(np.abs(used[:, 0] - full[:, 0]) / np.abs(full[:, 0]))
+        cv = np.mean(l0.std(axis=0) / np.abs(l0.mean(axis=0)))
+        print("%-5s %9d %13.2f%% %13.2f%% %15.2f%%" % (
+            tissue, len(files), 100 * rel_diff, 100 * l0_diff, 100 * cv))
+    if method:
+        print("\nFull cohort mean by %s. rel. diff is the norm of the "
+              "difference over the norm of the full mean, CV is the spread of "
+              "the l=0 terms across subjects for scale." % method)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+#####
+# Compare MultiProc's default job order with critical path scheduling on a
+# copy of the pipeline's graph shape where every node just sleeps:
+#
+#   python3 dev/sched_sim.py --subjects 6 --n-procs 6 --scale 0.002
+#
+# Node durations are the node_runtimes estimates in run.py times --scale,
+# threads per node are as in run.py.
+# Each scheduler runs in a fresh temporary working directory.
+#####
+
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import os.path as op
+from nipype import Node, JoinNode, Workflow, IdentityInterface
+from nipype.interfaces.base import (
+    BaseInterfaceInputSpec,
+    SimpleInterface,
+    TraitedSpec,
+    traits
+)
+
+sys.path.insert(0, op.join(op.dirname(op.abspath(__file__)), ".."))
+from src.scheduling import CriticalPathMultiProcPlugin  # noqa: E402
+
+# Threads as declared in run.py
+node_threads = {"synb0": 4, "dwipreproc": 4, "ss3t": 4}
+
+node_runtimes = {
+    "synb0": 3600,
+    "dwipreproc": 5400,
+    "biascorrect": 300,
+    "response_fuc": 300,
+    "response_mean": 60,
+    "upsample": 300,
+    "hdbet_dwi_upsamp": 180,
+    "ss3t": 3600,
+    "mtnormalise": 300,
+}
+
+
+class SleepInputSpec(BaseInterfaceInputSpec):
+    seconds = traits.Float(mandatory=True)
+    in_value = traits.Any()
+    in_extra = traits.Any()
+
+
+class SleepOutputSpec(TraitedSpec):
+    out_value = traits.Any()
+
+
+class Sleep(SimpleInterface):
+    input_spec = SleepInputSpec
+    output_spec = SleepOutputSpec
+
+    def _run_interface(self, runtime):
+        time.sleep(self.inputs.seconds)
+        self._results["out_value"] = self.inputs.in_value
+        return runtime
+
+
+def build(subjects, scale):
+    infosource = Node(IdentityInterface(fields=["subject_id"]),
+                      name="infosource")
+    infosource.iterables = [("subject_id", subjects)]
+
+    def sleeper(name, node_cls=Node, **kwargs):
+        node = node_cls(Sleep(), name=name,
+                        n_procs=node_threads.get(name, 2), **kwargs)
+        node.inputs.seconds = node_runtimes[name] * scale
+        return node
+
+    nodes = {name: sleeper(name) for name in node_runtimes
+             if name != "response_mean"}
+    response_mean = sleeper("response_mean", JoinNode,
+                            joinsource="infosource", joinfield=["in_value"])
+
+    wf = Workflow(name="sched_sim")
+    wf.connect([
+        (infosource, nodes["synb0"], [("subject_id", "in_value")]),
+        (nodes["synb0"], nodes["dwipreproc"], [("out_value", "in_value")]),
+        (nodes["dwipreproc"], nodes["biascorrect"], [("out_value", "in_value")]),
+        (nodes["biascorrect"], nodes["response_fuc"], [("out_value", "in_value")]),
+        (nodes["response_fuc"], response_mean, [("out_value", "in_value")]),
+        (nodes["biascorrect"], nodes["upsample"], [("out_value", "in_value")]),
+        (nodes["upsample"], nodes["hdbet_dwi_upsamp"], [("out_value", "in_value")]),
+        (nodes["hdbet_dwi_upsamp"], nodes["ss3t"], [("out_value", "in_value")]),
+        (response_mean, nodes["ss3t"], [("out_value", "in_extra")]),
+        (nodes["ss3t"], nodes["mtnormalise"], [("out_value", "in_value")]),
+    ])
+    return wf
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subjects", type=int, default=6)
+    parser.add_argument("--n-procs", type=int, default=6)
+    parser.add_argument("--scale", type=float, default=0.002)
+    args = parser.parse_args()
+    subjects = ["sub-%02d" % (i + 1) for i in range(args.subjects)]
+
+    for scheduler in ["tsort", "critical_path"]:
+        wf = build(subjects, args.scale)
+        wf.base_dir = tempfile.mkdtemp(prefix="sched_sim_")
+        wf.config["execution"] = {"poll_sleep_duration": 0.1}
+        plugin = CriticalPathMultiProcPlugin(plugin_args={
+            "n_procs": args.n_procs, "memory_gb": 4, "scheduler": scheduler,
+            "runtimes": node_runtimes})
+        start = time.time()
+        wf.run(plugin=plugin)
+        print("%-14s %6.1f s" % (scheduler, time.time() - start))
+        shutil.rmtree(wf.base_dir)
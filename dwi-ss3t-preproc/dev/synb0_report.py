@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+#####
+# Per-subject Synb0 times from the profile database, for the pipeline.sh
+# wrapper (the synb0 node) against the split steps (split_synb0, the
+# synb0_* nodes):
+#
+#   python3 dev/synb0_report.py <deriv_dir>/profile.sqlite
+#
+# wall is from the first Synb0 job of a subject starting to its last one
+# finishing, CPU the CPU time of the jobs and booked the threads declared
+# times their wall time. Run the same subjects once with each setting (in
+# separate working directories, or clearing the synb0 nodes in between).
+#####
+
+import sys
+import sqlite3
+import numpy as np
+
+
+def subject_times(db_path):
+    """{mode: {(run, subject): (wall, cpu, booked)}} of the Synb0 jobs."""
+    db = sqlite3.connect(db_path)
+    rows = db.execute("SELECT run_id, subject, node, n_procs, start, end, "
+                      "wall_s, cpu_s FROM jobs WHERE ok AND (node = 'synb0' "
+                      "OR node LIKE 'synb0\\_%' ESCAPE '\\')").fetchall()
+    jobs = {}
+    for run_id, subject, node, n_procs, start, end, wall, cpu in rows:
+        mode = "wrapper" if node == "synb0" else "split"
+        jobs.setdefault(mode, {}).setdefault((run_id, subject), []).append(
+            (start, end, cpu, n_procs * wall))
+    times = {}
+    for mode, subjects in jobs.items():
+        times[mode] = {key: (max(j[1] for j in js) - min(j[0] for j in js),
+                             sum(j[2] for j in js), sum(j[3] for j in js))
+                       for key, js in subjects.items()}
+    return times
+
+
+if __name__ == "__main__":
+    times = subject_times(sys.argv[1])
+    if not times:
+        print("No Synb0 jobs recorded in %s" % sys.argv[1])
+        raise SystemExit(1)
+    print("%-8s %8s %23s %12s %15s" % ("", "subjects", "wall min (p50/p90)",
+                                       "CPU min p50", "booked min p50"))
+    medians = {}
+    for mode in ["wrapper", "split"]:
+        if mode not in times:
+            continue
+        wall, cpu, booked = np.array(list(times[mode].values())).T / 60
+        medians[mode] = np.median(wall)
+        print("%-8s %8d %11.1f %11.1f %12.1f %15.1f" % (
+            mode, len(wall), np.median(wall), np.percentile(wall, 90),
+            np.median(cpu), np.median(booked)))
+    if len(medians) == 2:
+        print("Split wall time is %.2f x the wrapper's (medians)"
+              % (medians["split"] / medians["wrapper"]))
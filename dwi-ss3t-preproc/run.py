@@ -4,20 +4,38 @@
 # SS3T DWI preprocessing
 #####
 
+import os
 import os.path as op
+import sys
+import argparse
+import subprocess
 from os import name
 from pathlib import Path
 from nipype import (
     Node,
     JoinNode,
+    Merge,
     Workflow,
     IdentityInterface,
-    SelectFiles,
-    DataSink
+    SelectFiles
 )
 import nipype.interfaces.mrtrix3 as mrt
 import nipype.interfaces.fsl as fsl
+import nipype.interfaces.ants as ants
+import nipype.interfaces.freesurfer as fs
+from nipype.interfaces.c3 import C3dAffineTool
 import src.custom_classes as custom
+import src.fingerprint as fingerprint
+import src.staging as staging
+import src.retention as retention
+import src.profiling as profiling
+import src.walltime as walltime
+import src.telemetry as telemetry
+import src.planning as planning
+import src.qc as qc
+import src.response_gate as response_gate
+from src.discovery import SubjectIndex
+from src.response_store import ResponseStore
 
 
 # ----- SETUP -----
@@ -25,6 +43,8 @@ import src.custom_classes as custom
 
 # base_dir = Path("/home")  # DOCKER
 base_dir = Path("/path/to/base/on/HPC")  # SINGULARITY on Artemis
+# BASE_DIR overrides it, e.g. for dev/bench_workflow.py
+base_dir = Path(os.environ.get("BASE_DIR", base_dir))
 input_dir = base_dir / "imaging_data" / "input"
 deriv_dir = base_dir / "imaging_data" / "output"
 code_dir = base_dir / "code"
@@ -32,12 +52,211 @@ code_dir = base_dir / "code"
 # Make derivs if not exist
 deriv_dir.mkdir(parents=True, exist_ok=True)
 
+# Resources MultiProc can allocate, set by PBS (NCPUS) and submit_run.pbs
+# (MEM_GB) to match the job's select statement
+n_cpus = int(os.environ.get("NCPUS", 10))
+mem_gb = float(os.environ.get("MEM_GB", 32))
 
-# ----- DATA SOURCES -----
 
+# Tools installed outside PATH in the container, overridable to run
+# stand-ins (see dev/bench_workflow.py)
+synb0_cmd = os.environ.get("SYNB0_CMD", "/opt/Synb0-DISCO/src/pipeline.sh")
+synb0_inference_cmd = os.environ.get(
+    "SYNB0_INFERENCE_CMD", "python3 /opt/Synb0-DISCO/src/inference.py")
+synb0_dir = Path(os.environ.get("SYNB0_DIR", "/opt/Synb0-DISCO"))
+ss3t_cmd = os.environ.get("SS3T_CMD", "/opt/MRtrix3Tissue/bin/ss3t_csd_beta1")
+
+
+def threads(n):
+    """Thread budget for a node, capped at the allocation."""
+    return min(n, n_cpus)
+
+
+# ----- OPTIONS -----
+
+
+# Run HD-BET once over all subjects for each brain extraction stage instead
+# of once per image (single job runs only, not the sharded phases)
+hdbet_batch = False
+
+# Run Synb0 as one node per step of pipeline.sh instead of a single call, so
+# the model folds run at the same time and each step is cached on its own.
+# epi_reg uses the T1 brain from hdbet_T1. The atlases and trained models
+# are looked up under synb0_dir (SYNB0_DIR).
+split_synb0 = False
+synb0_atlas_dir = synb0_dir / "atlases"
+synb0_model_dir = synb0_dir / "src" / "train_lin"
+synb0_num_folds = 5
+
+# Average the b0 volumes in one native node instead of dwiextract + mrmath,
+# so the extracted b0 series is never written to disk
+fused_mean_b0 = True
+
+# Crop the upsampled grid to the brain (plus a margin in upsampled voxels)
+# so upsampling, masking, SS3T and mtnormalise only process the brain's
+# bounding box. Outputs are padded back onto the full grid for the datasink.
+crop_to_brain = False
+crop_margin = 5
+
+# Upsample the DWI in NumPy, in groups of volumes over the node's processes
+# and into a memory mapped output, instead of mrgrid over the whole series
+# (see src/regrid.py). The groups are sized to fit upsample_memory_gb. The
+# b0 volumes of the output can be read on their own, as every volume is
+# stored in one piece.
+chunked_upsample = False
+upsample_memory_gb = 3
+
+# Check each subject after biascorrect and leave the ones that fail out of
+# the rest of the run: upsampling, masking, FODs and the group responses
+# (see src/qc.py). The checks are eddy's motion and outlier summaries, the
+# b0 SNR and the gradient table against the image and the input's.
+# dwipreproc then also exports eddy's QC files, which reruns it once in an
+# existing working tree. Thresholds are named max_<metric> or min_<metric>.
+# python3 src/qc.py <deriv_dir>/dwi_ss3t_preproc_wf lists the results.
+qc_gate = False
+qc_thresholds = {
+    "max_mean_abs_motion_mm": 2.0,
+    "max_mean_rel_motion_mm": 0.5,
+    "max_outlier_pct": 5.0,
+    "min_b0_snr": 8.0,
+    "max_bvec_rotation_deg": 10.0,
+}
+
+# Format of images passed between MRtrix commands. ".mif" is MRtrix's
+# native format and skips gzip, ".nii.gz" is the old behaviour. Images read
+# or written by HD-BET and Synb0 stay .nii.gz.
+intermediate_ext = ".mif"
+
+# gzip .mif/.nii outputs on their way to the datasink (.mif.gz is read
+# natively by MRtrix). Uses pigz with sink_compress_threads when available.
+sink_compress = True
+sink_compresslevel = 6
+sink_compress_threads = 2
+
+# How the datasink delivers files: "hardlink", "reflink" (copy-on-write
+# filesystems), "move" (leaving a symlink in the working directory) or
+# "copy". Links fall back to a copy across filesystems, e.g. when staging.
+sink_mode = "hardlink"
+
+# Shared cache for synb0 and dwipreproc outputs, keyed by input content,
+# command line and tool version, so reruns from another working directory or
+# workflow reuse them. Least recently used entries are evicted above
+# cache_limit_gb. None disables the cache.
+cache_dir = None  # e.g. base_dir / "cache"
+cache_limit_gb = 200
+
+# How a rerun decides whether node inputs changed: "timestamp" (nipype's
+# default, mtime and size), "content" (md5 of every input file, reads every
+# image in full) or "fingerprint" (content hashing from sampled blocks, kept
+# per file under deriv_dir/.fingerprints so unchanged files are not re-read)
+hash_method = "timestamp"
+
+# Run the working tree on node-local scratch ($TMPDIR on the compute node)
+# with the subjects' inputs copied there first. Finished nodes are synced
+# back to the working tree under deriv_dir every upload_interval seconds, so
+# a later run (staged or not) resumes from there.
+stage_to_scratch = False
+scratch_dir = Path(os.environ.get("TMPDIR", "/tmp")) / "dwi_ss3t_preproc"
+upload_interval = 30
+
+# Release the disk used by these nodes' outputs and scratch once every node
+# reading them, in any phase, has finished (see src/retention.py). Reruns
+# still find them cached with "timestamp" or "fingerprint" hashing.
+retain_intermediates = False
+retention_nodes = ["mean_b0", "dwiextract", "mrmath", "synb0", "dwipreproc",
+                   "biascorrect", "crop_mask", "upsample", "mean_b0_upsamp",
+                   "dwiextract_upsamp", "mrmath_upsamp", "ss3t",
+                   "mtnormalise", "synb0_t1_nu", "synb0_t1_norm",
+                   "synb0_epi_reg", "synb0_atlas_reg", "synb0_b0_all"]
+# Hold back subjects that have not started while deriv_dir uses more than
+# this, e.g. the project quota less some headroom. None for no limit.
+disk_budget_gb = None
+
+# Build the group responses from a subset of subjects instead of the whole
+# cohort: an int K takes K subjects spread evenly over the sorted cohort, a
+# list names them. FODs then only wait for the subset's preprocessing rather
+# than the slowest subject's. dev/response_report.py shows how far the
+# subset mean is from the whole cohort's. None uses every subject.
+response_subjects = None
+if isinstance(response_subjects, int) and response_subjects < 1:
+    raise ValueError("response_subjects must be at least 1 subject, or "
+                     "None for every subject, got %d" % response_subjects)
+
+# Keep every subject's responses and the running group means in
+# response_store_dir. response_mean_* then merge the responses that are new
+# or changed into the stored means in NumPy instead of running responsemean
+# over every file. Subjects that left the cohort or fail QC are taken back
+# out, so the means cover the run's subjects that passed.
+use_response_store = False
+response_store_dir = deriv_dir / "response_store"
+# Use the group responses published from the store for the FODs
+# (python3 src/response_store.py publish <response_store_dir>), so adding
+# subjects only processes the new ones instead of rerunning every subject's
+# ss3t against a changed mean. Publish again to change them.
+freeze_response = False
+
+# Order ready jobs start in: "critical_path" starts the longest chains to the
+# end of the graph first (the synb0/dwipreproc chains feeding the group
+# responses), "tsort" is MultiProc's default order
+scheduler = "critical_path"
+# Estimated seconds per node, replaced by the mean durations observed in
+# earlier runs (kept in deriv_dir/node_runtimes.json)
+node_runtimes = {
+    "synb0": 3600,
+    "synb0_t1_nu": 600,
+    "synb0_t1_norm": 300,
+    "synb0_epi_reg": 600,
+    "synb0_atlas_reg": 900,
+    **{"synb0_inference_%d" % fold: 300
+       for fold in range(1, synb0_num_folds + 1)},
+    "dwipreproc": 5400,
+    "biascorrect": 300,
+    "dwi_qc": 60,
+    "response_fuc": 300,
+    "upsample": 300,
+    "hdbet_T1": 120,
+    "hdbet_dwi_upsamp": 180,
+    "ss3t": 3600,
+    "mtnormalise": 300,
+}
+
+# Record each job's wall time, CPU time, peak RSS and I/O here, for
+# python3 src/profiling.py report <profile_db>. None to disable.
+profile_db = deriv_dir / "profile.sqlite"
+
+# In a PBS job with WALLTIME set (see submit_run.pbs), only start nodes
+# expected to finish in the walltime left less this many seconds, then exit
+# for the job script to submit a continuation (see src/walltime.py)
+walltime_margin = 600
+
+# Progress of the run (job states per node and subject, the work left
+# before the group responses, cores and memory in use, ETA) written to
+# status_dir every status_interval seconds, for python3 src/status.py
+# <status_dir>. With status_port it is also served on
+# http://127.0.0.1:<status_port>/. None to disable.
+status_dir = deriv_dir / "status"
+status_interval = 10
+status_port = None
+
+# Leave subjects whose nodes in the phase all have finished results out of
+# the workflow, so startup only expands and hash checks the rest. Not used
+# when the phase runs the group responses. Changed options or published
+# responses are not picked up for the subjects left out, turn this off to
+# rerun them.
+skip_finished = False
+
+# Job sizes python3 run.py --plan <dir> picks from when writing job scripts
+# for the work left (see src/planning.py): cpus per job, memory per cpu and
+# the longest walltime of the queue
+plan_ncpus = [2, 4, 8, 12, 16, 24, 32, 48]
+plan_gb_per_cpu = 4
+plan_max_walltime = "48:00:00"
+# Smallest share of the booked cores a job size has to keep busy
+plan_min_efficiency = 0.5
+
+
+# ----- DATA SOURCES -----
 
-subjects = [s.name for s in input_dir.iterdir() if s.is_dir()
-            and "sub-" in str(s)]
 
 templates = {
     "anat": "{subject_id}/anat/{subject_id}_T1w.nii.gz",
@@ -46,40 +265,58 @@ templates = {
     "bvec": "{subject_id}/dwi/{subject_id}_dwi.bvec"
 }
 
-# Data input
+# Subjects with every file above, checked from the headers and indexed
+# (see src/discovery.py). Found at run time with discover_subjects().
+subject_index = SubjectIndex(input_dir, templates,
+                             deriv_dir / "subject_index.json")
+
+# Data input (iterables are set in build_workflow)
 infosource = Node(IdentityInterface(fields=["subject_id"]), name="infosource")
-infosource.iterables = [("subject_id", subjects)]
 
 selectfiles = Node(SelectFiles(templates), name="selectfiles")
 selectfiles.inputs.base_directory = str(input_dir)
 
-# Data output
-substitutions = [("_subject_id_", "")]
-subjFolders = [("dwi/sub-%s" % (sub), "sub-%s" % (sub))
-               for sub in subjects]
-substitutions.extend(subjFolders)
-
-datasink = Node(DataSink(), name="datasink")
+# Data output, one rule renames _subject_id_sub-XX folders to sub-XX
+datasink = Node(custom.LinkDataSink(), name="datasink")
 datasink.inputs.base_directory = str(deriv_dir)
-datasink.inputs.substitutions = substitutions
+datasink.inputs.substitutions = [("_subject_id_", "")]
+datasink.inputs.link_mode = sink_mode
 
 
 # ----- WORKFLOW NODES -----
 
 
-# Get b0"s
-dwiextract = Node(mrt.DWIExtract(), name="dwiextract")
-dwiextract.inputs.bzero = True
-dwiextract.inputs.out_file = "b0_vols.nii.gz"
-
 # Mean b0's
-mrmath = Node(mrt.MRMath(), name="mrmath")
-mrmath.inputs.axis = 3
-mrmath.inputs.operation = "mean"
-mrmath.inputs.out_file = "b0_mean.nii.gz"
+if fused_mean_b0:
+    mean_b0 = Node(custom.MeanB0(), name="mean_b0",
+                   n_procs=threads(1), mem_gb=1)
+    mean_b0.inputs.out_file = "b0_mean.nii.gz"
+else:
+    # Get b0"s
+    dwiextract = Node(mrt.DWIExtract(), name="dwiextract",
+                      n_procs=threads(1), mem_gb=1)
+    dwiextract.inputs.bzero = True
+    dwiextract.inputs.out_file = "b0_vols" + intermediate_ext
+
+    mrmath = Node(mrt.MRMath(), name="mrmath",
+                  n_procs=threads(1), mem_gb=1)
+    mrmath.inputs.axis = 3
+    mrmath.inputs.operation = "mean"
+    mrmath.inputs.out_file = "b0_mean.nii.gz"
+    mean_b0 = mrmath
 
 # Brain extraction nodes
-hdbet_T1 = Node(custom.HDBET(), name="hdbet_T1")
+if hdbet_batch:
+    # One hd-bet process over all subjects, then each subject's outputs
+    # are picked back out of the batch
+    hdbet_T1_batch = JoinNode(custom.HDBETBatch(), name="hdbet_T1_batch",
+                              joinsource=infosource, joinfield=["in_files"],
+                              n_procs=threads(4), mem_gb=4)
+    hdbet_T1 = Node(custom.HDBETSelect(), name="hdbet_T1")
+else:
+    hdbet_T1_batch = None
+    hdbet_T1 = Node(custom.HDBET(), name="hdbet_T1",
+                    n_procs=threads(2), mem_gb=4)
 hdbet_T1.inputs.out_file = "T1_brain.nii.gz"
 hdbet_T1.inputs.mask_file = "T1_brain_mask.nii.gz"
 
@@ -87,17 +324,119 @@ hdbet_T1.inputs.mask_file = "T1_brain_mask.nii.gz"
 # hdbet_dwi.inputs.out_file = "dwi_brain.nii.gz"
 # hdbet_dwi.inputs.mask_file = "dwi_brain_mask.nii.gz"
 
-hdbet_dwi_upsamp = Node(custom.HDBET(), name="hdbet_dwi_upsamp")
+if hdbet_batch:
+    hdbet_dwi_upsamp_batch = JoinNode(custom.HDBETBatch(),
+                                      name="hdbet_dwi_upsamp_batch",
+                                      joinsource=infosource,
+                                      joinfield=["in_files"],
+                                      n_procs=threads(4), mem_gb=4)
+    hdbet_dwi_upsamp = Node(custom.HDBETSelect(), name="hdbet_dwi_upsamp")
+else:
+    hdbet_dwi_upsamp_batch = None
+    hdbet_dwi_upsamp = Node(custom.HDBET(), name="hdbet_dwi_upsamp",
+                            n_procs=threads(2), mem_gb=4)
 hdbet_dwi_upsamp.inputs.out_file = "dwi_upsamp_brain.nii.gz"
 hdbet_dwi_upsamp.inputs.mask_file = "dwi_upsamp_brain_mask.nii.gz"
 
 # Synb0
-synb0 = Node(custom.SynB0(), name="synb0")
-synb0.inputs.out_file = "b0_all.nii.gz"
-synb0.inputs.run_topup = "--notopup"
+if split_synb0:
+    # The steps of pipeline.sh (prepare_input.sh and normalize_T1.sh), up to
+    # b0_all.nii.gz as pipeline.sh --notopup writes it. FreeSurfer reads
+    # and writes NIfTI itself, so the mri_convert calls are left out.
+    synb0_t1_nu = Node(fs.MNIBiasCorrection(), name="synb0_t1_nu",
+                       n_procs=threads(1), mem_gb=2)
+    synb0_t1_nu.inputs.iterations = 2
+    synb0_t1_nu.inputs.out_file = "T1_N3.mgz"
+
+    synb0_t1_norm = Node(fs.Normalize(), name="synb0_t1_norm",
+                         n_procs=threads(1), mem_gb=2)
+    synb0_t1_norm.inputs.gradient = 1
+    synb0_t1_norm.inputs.args = "-mprage"
+    synb0_t1_norm.inputs.out_file = "T1_norm.nii.gz"
+
+    # Distorted b0 to T1, with the hdbet_T1 brain instead of bet's
+    synb0_epi_reg = Node(fsl.EpiReg(), name="synb0_epi_reg",
+                         n_procs=threads(1), mem_gb=2)
+    synb0_epi_reg.inputs.out_base = "epi_reg_d"
+
+    synb0_epi_itk = Node(C3dAffineTool(), name="synb0_epi_itk",
+                         n_procs=threads(1), mem_gb=0.5)
+    synb0_epi_itk.inputs.fsl2ras = True
+    synb0_epi_itk.inputs.itk_transform = "epi_reg_d_ANTS.txt"
+
+    # T1 to the MNI atlas (affine)
+    synb0_atlas_reg = Node(ants.RegistrationSynQuick(),
+                           name="synb0_atlas_reg",
+                           n_procs=threads(2), mem_gb=2)
+    synb0_atlas_reg.inputs.fixed_image = str(
+        synb0_atlas_dir / "mni_icbm152_t1_tal_nlin_asym_09c.nii.gz")
+    synb0_atlas_reg.inputs.transform_type = "a"
+    synb0_atlas_reg.inputs.output_prefix = "ANTS"
+
+    # Normalised T1 and distorted b0 on the 2.5 mm atlas grid
+    synb0_atlas_2_5 = str(
+        synb0_atlas_dir / "mni_icbm152_t1_tal_nlin_asym_09c_2_5.nii.gz")
+    synb0_t1_atlas = Node(ants.ApplyTransforms(), name="synb0_t1_atlas",
+                          n_procs=threads(1), mem_gb=1)
+    synb0_t1_atlas.inputs.reference_image = synb0_atlas_2_5
+    synb0_t1_atlas.inputs.output_image = "T1_norm_lin_atlas_2_5.nii.gz"
+
+    synb0_to_atlas = Node(Merge(2), name="synb0_to_atlas")
+    synb0_b0_atlas = Node(ants.ApplyTransforms(), name="synb0_b0_atlas",
+                          n_procs=threads(1), mem_gb=1)
+    synb0_b0_atlas.inputs.reference_image = synb0_atlas_2_5
+    synb0_b0_atlas.inputs.output_image = "b0_d_lin_atlas_2_5.nii.gz"
+
+    # One node per fold, so the folds run side by side
+    synb0_folds = []
+    for fold in range(1, synb0_num_folds + 1):
+        node = Node(custom.SynB0Inference(command=synb0_inference_cmd),
+                    name="synb0_inference_%d" % fold,
+                    n_procs=threads(1), mem_gb=2)
+        node.inputs.model_dir = str(synb0_model_dir)
+        node.inputs.fold = fold
+        node.inputs.num_folds = synb0_num_folds
+        node.inputs.out_file = "b0_u_lin_atlas_2_5_FOLD_%d.nii.gz" % fold
+        synb0_folds.append(node)
+    synb0_fold_files = Node(Merge(synb0_num_folds), name="synb0_fold_files")
+    synb0_mean = Node(custom.EnsembleMean(), name="synb0_mean",
+                      n_procs=threads(1), mem_gb=1)
+
+    # Undistorted b0 back onto the distorted b0's grid
+    synb0_from_atlas = Node(Merge(2), name="synb0_from_atlas")
+    synb0_b0_u = Node(ants.ApplyTransforms(), name="synb0_b0_u",
+                      n_procs=threads(1), mem_gb=1)
+    synb0_b0_u.inputs.invert_transform_flags = [True, True]
+    synb0_b0_u.inputs.output_image = "b0_u.nii.gz"
+
+    synb0_smooth = Node(fsl.IsotropicSmooth(), name="synb0_smooth",
+                        n_procs=threads(1), mem_gb=1)
+    synb0_smooth.inputs.sigma = 1.15
+    synb0_smooth.inputs.out_file = "b0_d_smooth.nii.gz"
+
+    for node in [synb0_t1_atlas, synb0_b0_atlas, synb0_b0_u]:
+        node.inputs.dimension = 3
+        node.inputs.interpolation = "BSpline"
+    for node in [synb0_atlas_reg, synb0_t1_atlas, synb0_b0_atlas,
+                 synb0_b0_u]:
+        node.inputs.num_threads = node.n_procs
+    for node in [synb0_t1_nu, synb0_t1_norm]:
+        node.inputs.environ = {
+            "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS": str(node.n_procs),
+            "OMP_NUM_THREADS": str(node.n_procs)}
+
+    synb0 = Node(custom.SynB0Stack(), name="synb0_b0_all",
+                 n_procs=threads(1), mem_gb=1)
+    synb0.inputs.out_file = "b0_all.nii.gz"
+else:
+    synb0 = Node(custom.SynB0(command=synb0_cmd), name="synb0",
+                 n_procs=threads(4), mem_gb=8)
+    synb0.inputs.out_file = "b0_all.nii.gz"
+    synb0.inputs.run_topup = "--notopup"
 
 # Topup and eddy via MRtrix preprocess
-dwipreproc = Node(custom.DWIPreproc(), name="dwipreproc")
+dwipreproc = Node(custom.DWIPreproc(), name="dwipreproc",
+                  n_procs=threads(4), mem_gb=8)
 dwipreproc.inputs.rpe_options = "pair"
 dwipreproc.inputs.pe_dir = "AP"
 dwipreproc.inputs.align_seepi = True
@@ -106,80 +445,256 @@ dwipreproc.inputs.out_grad_fsl = ("dwi_preproc.bvec", "dwi_preproc.bval")
 dwipreproc.inputs.eddy_options = " --slm=linear --repol"
 dwipreproc.inputs.out_file = "dwi_preproc.mif"
 
+if cache_dir:
+    # The split Synb0 steps are only cached in the working directory
+    for node in [dwipreproc] if split_synb0 else [synb0, dwipreproc]:
+        node.inputs.cache_dir = str(cache_dir)
+        node.inputs.cache_limit_gb = cache_limit_gb
+
 # Bias correct
-biascorrect = Node(mrt.DWIBiasCorrect(), name="biascorrect")
+biascorrect = Node(mrt.DWIBiasCorrect(), name="biascorrect",
+                   n_procs=threads(2), mem_gb=4)
 biascorrect.inputs.use_ants = True
+# Named explicitly, DWIBiasCorrect only lists out_file when it is set
+biascorrect.inputs.out_file = "dwi_preproc_biascorr" + intermediate_ext
+
+# QC, later per-subject steps read the DWI through it
+if qc_gate:
+    dwipreproc.inputs.eddyqc_text = "eddyqc"
+    dwi_qc = Node(custom.DWIQC(), name="dwi_qc",
+                  n_procs=threads(1), mem_gb=2)
+    dwi_qc.inputs.thresholds = qc_thresholds
+    gated_dwi = dwi_qc
+else:
+    gated_dwi = biascorrect
 
 # Compute response function
-response_func = Node(mrt.ResponseSD(), name="response_fuc")
+response_func = Node(mrt.ResponseSD(), name="response_fuc",
+                     n_procs=threads(2), mem_gb=2)
 response_func.inputs.algorithm = "dhollander"
 response_func.inputs.wm_file = "response_wm.txt"
 response_func.inputs.gm_file = "response_gm.txt"
 response_func.inputs.csf_file = "response_csf.txt"
 
 # Upsample
-upsample = Node(custom.MRGrid(), name="upsample")
-upsample.inputs.operation = "regrid"
-upsample.inputs.voxel_size = 1.5
+if chunked_upsample:
+    upsample = Node(custom.ChunkedRegrid(), name="upsample",
+                    n_procs=threads(4), mem_gb=upsample_memory_gb + 1)
+    upsample.inputs.memory_gb = upsample_memory_gb
+else:
+    upsample = Node(custom.MRGrid(), name="upsample",
+                    n_procs=threads(2), mem_gb=8)
+    upsample.inputs.operation = "regrid"
 upsample.inputs.out_file = "dwi_preproc_biascorrect_upsamp.mif"
 
+if crop_to_brain:
+    # Cheap native resolution mask
+    crop_mask = Node(mrt.BrainMask(), name="crop_mask",
+                     n_procs=threads(1), mem_gb=2)
+    crop_mask.inputs.out_file = "crop_mask.mif"
+
+    # Mask on the full upsampled grid, also the template to pad back onto
+    grid_full = Node(custom.MRGrid(), name="grid_full",
+                     n_procs=threads(1), mem_gb=1)
+    grid_full.inputs.operation = "regrid"
+    grid_full.inputs.voxel_size = 1.5
+    grid_full.inputs.interp = "nearest"
+    grid_full.inputs.out_file = "grid_full.mif"
+
+    # Brain bounding box on the same grid, so the cropped data lines up
+    # voxel for voxel with an uncropped upsample
+    grid_crop = Node(custom.MRGrid(), name="grid_crop",
+                     n_procs=threads(1), mem_gb=1)
+    grid_crop.inputs.operation = "crop"
+    grid_crop.inputs.uniform = -crop_margin
+    grid_crop.inputs.out_file = "grid_crop.mif"
+else:
+    upsample.inputs.voxel_size = 1.5
+
 # Mask upsampled and preprocessed DWI
-dwiextract_upsamp = Node(mrt.DWIExtract(), name="dwiextract_upsamp")
-dwiextract_upsamp.inputs.bzero = True
-dwiextract_upsamp.inputs.out_file = "b0_vols_upsamp.nii.gz"
+if fused_mean_b0:
+    mean_b0_upsamp = Node(custom.MeanB0(), name="mean_b0_upsamp",
+                          n_procs=threads(1), mem_gb=1)
+    mean_b0_upsamp.inputs.out_file = "b0_upsamp.nii.gz"
+else:
+    dwiextract_upsamp = Node(mrt.DWIExtract(), name="dwiextract_upsamp",
+                             n_procs=threads(1), mem_gb=4)
+    dwiextract_upsamp.inputs.bzero = True
+    dwiextract_upsamp.inputs.out_file = "b0_vols_upsamp" + intermediate_ext
 
-mrmath_upsamp = Node(mrt.MRMath(), name="mrmath_upsamp")
-mrmath_upsamp.inputs.axis = 3
-mrmath_upsamp.inputs.operation = "mean"
-mrmath_upsamp.inputs.out_file = "b0_upsamp.nii.gz"
+    mrmath_upsamp = Node(mrt.MRMath(), name="mrmath_upsamp",
+                         n_procs=threads(1), mem_gb=4)
+    mrmath_upsamp.inputs.axis = 3
+    mrmath_upsamp.inputs.operation = "mean"
+    mrmath_upsamp.inputs.out_file = "b0_upsamp.nii.gz"
+    mean_b0_upsamp = mrmath_upsamp
 
-# Compute group average response function
+# Compute group average response function, over the subjects that passed
+# QC with qc_gate
+response_joinfield = ["in_files", "qc_passed"] if qc_gate else ["in_files"]
 response_mean_wm = JoinNode(custom.MeanResponse(), name="response_mean_wm",
-                            joinsource=infosource, joinfield=["in_files"])
+                            joinsource=infosource,
+                            joinfield=response_joinfield)
 response_mean_wm.inputs.out_file = "mean_response_wm.txt"
 
 response_mean_gm = JoinNode(custom.MeanResponse(), name="response_mean_gm",
-                            joinsource=infosource, joinfield=["in_files"])
+                            joinsource=infosource,
+                            joinfield=response_joinfield)
 response_mean_gm.inputs.out_file = "mean_response_gm.txt"
 
 response_mean_csf = JoinNode(custom.MeanResponse(), name="response_mean_csf",
-                             joinsource=infosource, joinfield=["in_files"])
+                             joinsource=infosource,
+                             joinfield=response_joinfield)
 response_mean_csf.inputs.out_file = "mean_response_csf.txt"
 
 # # Compute FOD with ss3t
-ss3t = Node(custom.SS3T(), name="ss3t")
+ss3t = Node(custom.SS3T(command=ss3t_cmd), name="ss3t",
+            n_procs=threads(4), mem_gb=8)
 ss3t.inputs.wmfod_out = "wmfod.mif"
 ss3t.inputs.gm_out = "gm.mif"
 ss3t.inputs.csf_out = "csf.mif"
 
 # Joint intensity normalisation
-mtnormalise = Node(custom.MTNormalise(), name="mtnormalise")
+mtnormalise = Node(custom.MTNormalise(), name="mtnormalise",
+                   n_procs=threads(2), mem_gb=4)
 mtnormalise.inputs.wmfod_norm_out = "wmfod_norm.mif"
 mtnormalise.inputs.gm_norm_out = "gm_norm.mif"
 mtnormalise.inputs.csf_norm_out = "csf_norm.mif"
 
 
+# Threads and peak memory (GB) are declared on each node above. MultiProc
+# packs jobs against n_cpus/mem_gb with them, and the tools are capped at
+# the same thread count (num_threads on the custom interfaces follows
+# n_procs, the built-in MRtrix ones take nthreads)
+mrtrix_nodes = [biascorrect, response_func]
+if crop_to_brain:
+    mrtrix_nodes += [crop_mask]
+if not fused_mean_b0:
+    mrtrix_nodes += [dwiextract, mrmath, dwiextract_upsamp, mrmath_upsamp]
+for node in mrtrix_nodes:
+    node.inputs.nthreads = node.n_procs
+
+# N4 (ANTs) inside dwibiascorrect uses the ITK thread pool
+biascorrect.inputs.environ = {
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS": str(biascorrect.n_procs)}
+
+
 # ----- WORKFLOW -----
 
 
-wf = Workflow(name="dwi_ss3t_preproc_wf")
-wf.base_dir = str(deriv_dir)
+def hdbet_connections(source, field, batch, node):
+    """Connect an image to an HD-BET node, through its batch if batching."""
+    if batch is None:
+        return [(source, node, [(field, "in_file")])]
+    return [
+        (source, batch, [(field, "in_files")]),
+        (batch, node, [("out_files", "out_files"),
+                       ("mask_files", "mask_files")]),
+        (infosource, node, [("subject_id", "subject_id")]),
+    ]
+
+
+# Mean b0's, directly from the DWI or through an extracted b0 series
+if fused_mean_b0:
+    b0_connections = [
+        (selectfiles, mean_b0, [("dwi", "in_file")]),
+        (selectfiles, mean_b0, [("bval", "in_bval")]),
+    ]
+    b0_upsamp_connections = [
+        (upsample, mean_b0_upsamp, [("out_file", "in_file")]),
+        (dwipreproc, mean_b0_upsamp, [("out_fsl_bval", "in_bval")]),
+    ]
+else:
+    b0_connections = [
+        # Get b0's
+        (selectfiles, dwiextract, [("dwi", "in_file")]),
+        (selectfiles, dwiextract, [("bval", "in_bval")]),
+        (selectfiles, dwiextract, [("bvec", "in_bvec")]),
+        # Mean b0's
+        (dwiextract, mrmath, [("out_file", "in_file")]),
+    ]
+    b0_upsamp_connections = [
+        # Get upsample b0's
+        (upsample, dwiextract_upsamp, [("out_file", "in_file")]),
+        (dwipreproc, dwiextract_upsamp, [("out_fsl_bval", "in_bval")]),
+        (dwipreproc, dwiextract_upsamp, [("out_fsl_bvec", "in_bvec")]),
+        # Mean upsample b0's
+        (dwiextract_upsamp, mrmath_upsamp, [("out_file", "in_file")]),
+    ]
+
+
+# Synb0 in one call or step by step
+if split_synb0:
+    synb0_connections = [
+        # Normalise T1
+        (selectfiles, synb0_t1_nu, [("anat", "in_file")]),
+        (synb0_t1_nu, synb0_t1_norm, [("out_file", "in_file")]),
+        # Register distorted b0 to T1
+        (mean_b0, synb0_epi_reg, [("out_file", "epi")]),
+        (selectfiles, synb0_epi_reg, [("anat", "t1_head")]),
+        (hdbet_T1, synb0_epi_reg, [("out_file", "t1_brain")]),
+        (selectfiles, synb0_epi_itk, [("anat", "reference_file")]),
+        (mean_b0, synb0_epi_itk, [("out_file", "source_file")]),
+        (synb0_epi_reg, synb0_epi_itk, [("epi2str_mat", "transform_file")]),
+        # Register T1 to atlas
+        (selectfiles, synb0_atlas_reg, [("anat", "moving_image")]),
+        # T1 and b0 into atlas space
+        (synb0_t1_norm, synb0_t1_atlas, [("out_file", "input_image")]),
+        (synb0_atlas_reg, synb0_t1_atlas, [("out_matrix", "transforms")]),
+        (synb0_atlas_reg, synb0_to_atlas, [("out_matrix", "in1")]),
+        (synb0_epi_itk, synb0_to_atlas, [("itk_transform", "in2")]),
+        (mean_b0, synb0_b0_atlas, [("out_file", "input_image")]),
+        (synb0_to_atlas, synb0_b0_atlas, [("out", "transforms")]),
+        # Inference, one node per fold, and the mean over the folds
+        *[connection for k, node in enumerate(synb0_folds, 1)
+          for connection in [
+              (synb0_t1_atlas, node, [("output_image", "in_T1")]),
+              (synb0_b0_atlas, node, [("output_image", "in_b0")]),
+              (node, synb0_fold_files, [("out_file", "in%d" % k)])]],
+        (synb0_fold_files, synb0_mean, [("out", "in_files")]),
+        # Undistorted b0 back to b0 space
+        (synb0_epi_itk, synb0_from_atlas, [("itk_transform", "in1")]),
+        (synb0_atlas_reg, synb0_from_atlas, [("out_matrix", "in2")]),
+        (synb0_mean, synb0_b0_u, [("out_file", "input_image")]),
+        (mean_b0, synb0_b0_u, [("out_file", "reference_image")]),
+        (synb0_from_atlas, synb0_b0_u, [("out", "transforms")]),
+        # Smoothed distorted b0 and undistorted b0
+        (mean_b0, synb0_smooth, [("out_file", "in_file")]),
+        (synb0_smooth, synb0, [("out_file", "in_distorted")]),
+        (synb0_b0_u, synb0, [("output_image", "in_undistorted")]),
+    ]
+else:
+    synb0_connections = [
+        (selectfiles, synb0, [("anat", "in_T1")]),
+        (hdbet_T1, synb0, [("out_file", "in_T1mask")]),
+        (mean_b0, synb0, [("out_file", "in_file")]),
+    ]
 
-wf.connect([
+
+# QC of the preprocessed DWI
+if qc_gate:
+    qc_connections = [
+        (biascorrect, dwi_qc, [("out_file", "in_file")]),
+        (dwipreproc, dwi_qc, [("out_fsl_bval", "in_bval")]),
+        (dwipreproc, dwi_qc, [("out_fsl_bvec", "in_bvec")]),
+        (dwipreproc, dwi_qc, [("out_eddyqc", "eddyqc_dir")]),
+        (selectfiles, dwi_qc, [("bval", "orig_bval")]),
+        (selectfiles, dwi_qc, [("bvec", "orig_bvec")]),
+    ]
+else:
+    qc_connections = []
+
+
+# Per-subject preprocessing up to the response function
+core_connections = [
     # Get files
     (infosource, selectfiles, [("subject_id", "subject_id")]),
-    # Get b0's
-    (selectfiles, dwiextract, [("dwi", "in_file")]),
-    (selectfiles, dwiextract, [("bval", "in_bval")]),
-    (selectfiles, dwiextract, [("bvec", "in_bvec")]),
     # Mean b0's
-    (dwiextract, mrmath, [("out_file", "in_file")]),
+    *b0_connections,
     # T1 mask
-    (selectfiles, hdbet_T1, [("anat", "in_file")]),
+    *hdbet_connections(selectfiles, "anat", hdbet_T1_batch, hdbet_T1),
     # Synb0
-    (selectfiles, synb0, [("anat", "in_T1")]),
-    (hdbet_T1, synb0, [("out_file", "in_T1mask")]),
-    (mrmath, synb0, [("out_file", "in_file")]),
+    *synb0_connections,
     # Topup/eddy via mrtrix3
     (selectfiles, dwipreproc, [("dwi", "in_file")]),
     (selectfiles, dwipreproc, [("bval", "in_bval")]),
@@ -189,57 +704,480 @@ wf.connect([
     (dwipreproc, biascorrect, [("out_file", "in_file")]),
     (dwipreproc, biascorrect, [("out_fsl_bval", "in_bval")]),
     (dwipreproc, biascorrect, [("out_fsl_bvec", "in_bvec")]),
+    # QC
+    *qc_connections,
     # Compute response function
     (biascorrect, response_func, [("out_file", "in_file")]),
     (dwipreproc, response_func, [("out_fsl_bval", "in_bval")]),
     (dwipreproc, response_func, [("out_fsl_bvec", "in_bvec")]),
+]
+
+# Upsample onto the full grid or the brain's bounding box
+if crop_to_brain:
+    grid_connections = [
+        (gated_dwi, crop_mask, [("out_file", "in_file")]),
+        (crop_mask, grid_full, [("out_file", "in_file")]),
+        (grid_full, grid_crop, [("out_file", "in_file")]),
+        (grid_full, grid_crop, [("out_file", "mask")]),
+        (grid_crop, upsample, [("out_file", "template")]),
+    ]
+else:
+    grid_connections = []
+
+
+def sink_connections(source, field, dest):
+    """Connect an output image to the datasink, padded back onto the full
+    grid if it was computed on the cropped grid and compressed if
+    sink_compress is set."""
+    # Output field names match the inputs that name the files
+    out_name = getattr(source.inputs, field)
+    name = dest.split("@")[-1]
+    connections = []
+
+    if crop_to_brain and source in [upsample, hdbet_dwi_upsamp, mtnormalise]:
+        uncrop = Node(custom.MRGrid(), name="uncrop_" + name,
+                      n_procs=threads(1), mem_gb=4)
+        uncrop.inputs.operation = "pad"
+        uncrop.inputs.out_file = out_name
+        connections += [
+            (source, uncrop, [(field, "in_file")]),
+            (grid_full, uncrop, [("out_file", "as_image")]),
+        ]
+        source, field = uncrop, "out_file"
+
+    if sink_compress and out_name.endswith((".mif", ".nii")):
+        compress = Node(custom.Compress(), name="compress_" + name,
+                        n_procs=threads(sink_compress_threads), mem_gb=0.5)
+        compress.inputs.compresslevel = sink_compresslevel
+        connections += [(source, compress, [(field, "in_file")])]
+        source, field = compress, "out_file"
+
+    return connections + [(source, datasink, [(field, dest)])]
+
+
+# Per-subject upsampling and masking
+upsample_connections = [
     # Upsample
-    (biascorrect, upsample, [("out_file", "in_file")]),
-    # Get upsample b0's
-    (upsample, dwiextract_upsamp, [("out_file", "in_file")]),
-    (dwipreproc, dwiextract_upsamp, [("out_fsl_bval", "in_bval")]),
-    (dwipreproc, dwiextract_upsamp, [("out_fsl_bvec", "in_bvec")]),
+    *grid_connections,
+    (gated_dwi, upsample, [("out_file", "in_file")]),
     # Mean upsample b0's
-    (dwiextract_upsamp, mrmath_upsamp, [("out_file", "in_file")]),
+    *b0_upsamp_connections,
     # Mask upsample DWI
-    (mrmath_upsamp, hdbet_dwi_upsamp, [("out_file", "in_file")]),
-    # Compute group mean response
+    *hdbet_connections(mean_b0_upsamp, "out_file", hdbet_dwi_upsamp_batch,
+                       hdbet_dwi_upsamp),
+]
+
+# Group mean response (joins over all subjects)
+group_connections = [
     (response_func, response_mean_wm, [("wm_file", "in_files")]),
     (response_func, response_mean_gm, [("gm_file", "in_files")]),
     (response_func, response_mean_csf, [("csf_file", "in_files")]),
-    # Compute FODs w SS3T
-    (upsample, ss3t, [("out_file", "in_file")]),
-    (hdbet_dwi_upsamp, ss3t, [("out_file", "in_mask")]),
+]
+if qc_gate:
+    group_connections += [(dwi_qc, node, [("passed", "qc_passed")])
+                          for node in [response_mean_wm, response_mean_gm,
+                                       response_mean_csf]]
+
+response_connections = [
     (response_mean_wm, ss3t, [("out_file", "wm_response")]),
     (response_mean_gm, ss3t, [("out_file", "gm_response")]),
     (response_mean_csf, ss3t, [("out_file", "csf_response")]),
+]
+
+# Per-subject FODs and normalisation
+fod_connections = [
+    # Compute FODs w SS3T
+    (upsample, ss3t, [("out_file", "in_file")]),
+    (hdbet_dwi_upsamp, ss3t, [("out_file", "in_mask")]),
     # Joint intensity normalisation
     (hdbet_dwi_upsamp, mtnormalise, [("out_file", "in_mask")]),
     (ss3t, mtnormalise, [("wmfod_out", "wmfod_in")]),
     (ss3t, mtnormalise, [("gm_out", "gm_in")]),
     (ss3t, mtnormalise, [("csf_out", "csf_in")]),
-    # Save data
+]
+
+# Save data
+preproc_sink_connections = [
     (dwipreproc, datasink, [("out_fsl_bval", "dwi_ss3t_preproc.@bval")]),
     (dwipreproc, datasink, [("out_fsl_bvec", "dwi_ss3t_preproc.@bvec")]),
-    (hdbet_T1, datasink, [
-     ("mask_file", "dwi_ss3t_preproc.@T1_mask")]),
-    (upsample, datasink, [
-     ("out_file", "dwi_ss3t_preproc.@dwi_preproc_upsamp")]),
-    (hdbet_dwi_upsamp, datasink, [
-     ("mask_file", "dwi_ss3t_preproc.@dwi_preproc_upsamp_mask")]),
-    (mtnormalise, datasink, [
-     ("wmfod_norm_out", "dwi_ss3t_preproc.@wmfod_norm")]),
-    (mtnormalise, datasink, [("gm_norm_out", "dwi_ss3t_preproc.@gm_norm")]),
-    (mtnormalise, datasink, [("csf_norm_out", "dwi_ss3t_preproc.@csf_norm")])
-])
+    *sink_connections(hdbet_T1, "mask_file", "dwi_ss3t_preproc.@T1_mask"),
+    *sink_connections(upsample, "out_file",
+                      "dwi_ss3t_preproc.@dwi_preproc_upsamp"),
+    *sink_connections(hdbet_dwi_upsamp, "mask_file",
+                      "dwi_ss3t_preproc.@dwi_preproc_upsamp_mask"),
+]
+
+fod_sink_connections = [
+    *sink_connections(mtnormalise, "wmfod_norm_out",
+                      "dwi_ss3t_preproc.@wmfod_norm"),
+    *sink_connections(mtnormalise, "gm_norm_out",
+                      "dwi_ss3t_preproc.@gm_norm"),
+    *sink_connections(mtnormalise, "csf_norm_out",
+                      "dwi_ss3t_preproc.@csf_norm")
+]
+
+all_connections = (core_connections + upsample_connections +
+                   group_connections + response_connections +
+                   fod_connections + preproc_sink_connections +
+                   fod_sink_connections)
+
+phases = ["all", "preproc", "group", "fod"]
+
+
+def phase_connections(phase):
+    """Connections making up the graph of a phase (see build_workflow)."""
+    if phase == "all" and response_subjects is None and not freeze_response:
+        return all_connections
+    elif phase == "preproc":
+        return (core_connections + upsample_connections +
+                preproc_sink_connections)
+    elif phase == "group":
+        return core_connections + group_connections
+    elif phase in ["all", "fod"]:
+        return (core_connections + upsample_connections + fod_connections +
+                preproc_sink_connections + fod_sink_connections)
+    raise ValueError("Unknown phase: %s" % phase)
+
+
+def build_workflow(subject_list, phase="all"):
+    """Build the workflow for a list of subjects.
+
+    The "all" phase is the full pipeline in a single run. For sharded runs
+    the same graph is split so that "preproc" and "fod" can run on any
+    subset of subjects, while "group" runs the response JoinNodes once over
+    the response subjects. Working directories are shared between the
+    phases, so nodes finished by an earlier phase are picked up from cache.
+    With response_subjects set, "all" is the "fod" graph over every subject,
+    with ss3t held until the "group" phase has built the responses from the
+    subset (see src/response_gate.py), and "preproc" leaves out the subset.
+    With freeze_response, "all" and "fod" use the published responses and no
+    subject waits for the group.
+    """
+    infosource.iterables = [("subject_id", subject_list)]
+
+    if hdbet_batch:
+        # A batch joins over the subjects of this run, so a shard's batch
+        # would not be reused by the other phases
+        if (phase != "all" or response_subjects is not None
+                or freeze_response):
+            raise ValueError("hdbet_batch is only supported for phase 'all' "
+                             "without response_subjects or freeze_response")
+        if qc_gate:
+            # Subjects dropped by QC would leave the batch short
+            raise ValueError("hdbet_batch is not supported with qc_gate")
+        # JoinNode inputs are in the order of the iterables
+        hdbet_T1.inputs.subject_ids = subject_list
+        hdbet_dwi_upsamp.inputs.subject_ids = subject_list
+
+    if use_response_store:
+        for tissue, node in [("wm", response_mean_wm),
+                             ("gm", response_mean_gm),
+                             ("csf", response_mean_csf)]:
+            node.inputs.store_dir = str(response_store_dir)
+            node.inputs.tissue = tissue
+            node.inputs.subject_ids = subject_list
+
+    wf = Workflow(name="dwi_ss3t_preproc_wf")
+    wf.base_dir = str(deriv_dir)
+
+    connections = phase_connections(phase)
+    wf_nodes = {node for connection in connections for node in connection[:2]}
+    if (ss3t in wf_nodes and response_mean_wm not in wf_nodes
+            and (phase != "all" or freeze_response)):
+        # Group responses come from the output of the "group" phase, or
+        # those published from the response store. "all" builds them during
+        # the run and sets them then.
+        hint = ("publish the response store first" if freeze_response
+                else "run the group phase first")
+        for name, response in group_responses().items():
+            if not Path(response).exists():
+                raise FileNotFoundError("Group response not found, %s: %s"
+                                        % (hint, response))
+            setattr(ss3t.inputs, name, response)
+    wf.connect(connections)
+
+    return wf
+
+
+def group_responses(wf_dir=deriv_dir / "dwi_ss3t_preproc_wf"):
+    """ss3t's response inputs, from the output of the "group" phase in
+    wf_dir or the responses published from the response store."""
+    responses = {}
+    for tissue in ["wm", "gm", "csf"]:
+        if freeze_response:
+            response = ResponseStore(response_store_dir).published_path(tissue)
+        else:
+            response = (wf_dir / ("response_mean_%s" % tissue) /
+                        ("mean_response_%s.txt" % tissue))
+        responses["%s_response" % tissue] = str(response)
+    return responses
+
+
+class PipelinePlugin(retention.RetentionMultiProcPlugin,
+                     response_gate.ResponseGateMultiProcPlugin,
+                     walltime.WalltimeMultiProcPlugin,
+                     qc.QCGateMultiProcPlugin,
+                     telemetry.TelemetryMultiProcPlugin,
+                     profiling.ProfilingMultiProcPlugin):
+    """MultiProc with the retention, response gate, walltime, critical
+    path, QC gate, telemetry and profiling layers."""
+
+
+def retained_nodes(wf):
+    """Nodes of retention_nodes in wf whose consumers in every phase are in
+    wf too, so their outputs are no longer needed once wf has run them."""
+    consumers = {}
+    for source, dest, _ in all_connections:
+        consumers.setdefault(source.name, set()).add(dest.name)
+    if qc_gate:
+        # dwi_qc passes biascorrect's output on
+        consumers["biascorrect"] |= consumers["dwi_qc"]
+    wf_nodes = set(wf.list_node_names())
+    return [n for n in retention_nodes
+            if n in wf_nodes and consumers.get(n, set()) <= wf_nodes]
+
+
+def discover_subjects():
+    """Complete subjects in input_dir, reporting the ones left out."""
+    subject_list, problems = subject_index.refresh()
+    for subject, subject_problems in sorted(problems.items()):
+        print("Leaving out %s: %s" % (subject, "; ".join(subject_problems)))
+    return subject_list
+
+
+def unfinished(subject_list, phase):
+    """Subjects with nodes of the phase left to run, all of them if the
+    phase runs the group responses."""
+    connections = phase_connections(phase)
+    if any(response_mean_wm in connection[:2] for connection in connections):
+        return subject_list
+    jobs = planning.expand(connections, infosource, subject_list,
+                           str(deriv_dir / "dwi_ss3t_preproc_wf"),
+                           planning.Estimates())
+    # The iterables source has no node directory of its own
+    left = {subject for subject, name in jobs if name != infosource.name}
+    return [s for s in subject_list if s in left]
+
+
+def response_subset(subject_list):
+    """Subjects the group responses are built from."""
+    if response_subjects is None:
+        return subject_list
+    if isinstance(response_subjects, int):
+        k = min(response_subjects, len(subject_list))
+        return [subject_list[i * len(subject_list) // k] for i in range(k)]
+    missing = set(response_subjects) - set(subject_list)
+    if missing:
+        raise ValueError("response_subjects not found in the input "
+                         "directory: %s" % ", ".join(sorted(missing)))
+    return sorted(response_subjects)
+
+
+def plan_run(out_dir):
+    """Write job scripts sized for the work left to out_dir, as a single
+    job or a sharded chain (see src/planning.py)."""
+    estimates = planning.Estimates(profile_db,
+                                   deriv_dir / "node_runtimes.json",
+                                   node_runtimes)
+    planner = planning.Planner(str(deriv_dir / "dwi_ss3t_preproc_wf"),
+                               infosource, estimates, plan_ncpus,
+                               plan_gb_per_cpu,
+                               walltime.parse_walltime(plan_max_walltime),
+                               margin=walltime_margin,
+                               min_efficiency=plan_min_efficiency)
+    subjects = discover_subjects()
+    group_subjects = response_subset(subjects)
+    single = [(phase_connections("all"), subjects)]
+    chain = [("fod", phase_connections("fod"), None)]
+    concurrent = []
+    pbs_flag = "--frozen-response"
+    if not freeze_response:
+        chain.insert(0, ("group", phase_connections("group"),
+                         group_subjects))
+        pbs_flag = "--response-subset"
+    if response_subjects is None and not freeze_response:
+        chain.insert(0, ("preproc", phase_connections("preproc"), None))
+        pbs_flag = ""
+    elif not freeze_response:
+        # The rest of the cohort is preprocessed alongside the subset's
+        # group job. The single job is planned with the subset's group step
+        # first, as its ss3t waits for it.
+        chain.insert(1, ("preproc", phase_connections("preproc"), None))
+        concurrent.append("preproc")
+        single.insert(0, (phase_connections("group"), group_subjects))
+
+    names = sorted({n.name for c in all_connections for n in c[:2]})
+    sources = [estimates.source(n) for n in names]
+    print("Node estimates: %s" % ", ".join(
+        "%d from %s" % (sources.count(s), s)
+        for s in ["profile", "observed", "estimate", "default"]
+        if s in sources))
+
+    plans = planner.plans(single, chain, subjects, concurrent)
+    for plan in sorted(plans, key=lambda p: p["n_shards"]):
+        print("%s: %.1f h, %.0f core hours" % (
+            "Single job" if not plan["n_shards"]
+            else "%d shards" % plan["n_shards"],
+            plan["completion"] / 3600, plan["core_hours"]))
+    plan = planning.choose(plans)
+    if plan is None:
+        raise ValueError("No job size in plan_ncpus finishes in %s, raise "
+                         "plan_max_walltime" % plan_max_walltime)
+    print()
+    for phase, size in plan["sizes"].items():
+        print(planning.describe(phase, size))
+
+    template = op.join(op.dirname(op.abspath(__file__)), "submit_run.pbs")
+    os.makedirs(out_dir, exist_ok=True)
+    for phase, size in plan["sizes"].items():
+        planning.write_script(template, op.join(
+            out_dir, "submit_%s.pbs" % phase), phase, size)
+    if not plan["n_shards"]:
+        print("\nSubmit with:\n  qsub %s"
+              % op.join(out_dir, "submit_all.pbs"))
+    else:
+        print("\nSubmit with:\n  python3 code/src/pbs.py --n-shards %d %s"
+              % (plan["n_shards"], " ".join(filter(None, [pbs_flag,
+                                                            out_dir]))))
+
+
+def shard(subject_list, index, n_shards):
+    """Round-robin slice of subjects for one array task."""
+    if not 0 <= index < n_shards:
+        raise ValueError("Shard index %d out of range for %d shards"
+                         % (index, n_shards))
+    return subject_list[index::n_shards]
 
 
 # ----- RUN -----
 
 
 if __name__ == "__main__":
-    wf.write_graph(graph2use="colored", format="png", simple_form=True)
+    parser = argparse.ArgumentParser(description="SS3T DWI preprocessing")
+    parser.add_argument("--phase", choices=phases, default="all",
+                        help="Part of the pipeline to run (default: all)")
+    parser.add_argument("--n-shards", type=int, default=1,
+                        help="Number of array tasks the cohort is split "
+                        "over for the preproc and fod phases")
+    parser.add_argument("--shard-index", type=int,
+                        default=int(os.environ.get(
+                            "SHARD_INDEX",
+                            os.environ.get("PBS_ARRAY_INDEX", 0))),
+                        help="Array task index (default: $SHARD_INDEX, "
+                        "for continuations, or $PBS_ARRAY_INDEX)")
+    parser.add_argument("--no-stage", action="store_true",
+                        help="Run on the scratch tree staged by the run "
+                        "starting this one (the all phase's group step) "
+                        "without staging or uploading it again")
+    parser.add_argument("--plan", metavar="DIR",
+                        help="Write job scripts sized for the work left to "
+                        "DIR instead of running")
+    args = parser.parse_args()
+
+    if args.plan:
+        plan_run(args.plan)
+        raise SystemExit(0)
+
+    subjects = discover_subjects()
+    group_subjects = response_subset(subjects)
+    if args.phase == "preproc" and response_subjects is not None:
+        # The subset is preprocessed by the group phase, which runs at the
+        # same time
+        run_subjects = shard([s for s in subjects if s not in group_subjects],
+                             args.shard_index, args.n_shards)
+    elif args.phase in ["preproc", "fod"]:
+        run_subjects = shard(subjects, args.shard_index, args.n_shards)
+    elif args.phase == "group":
+        run_subjects = group_subjects
+    else:
+        run_subjects = subjects
+    if not run_subjects:
+        print("No subjects for shard %d of %d, nothing to do"
+              % (args.shard_index, args.n_shards))
+        raise SystemExit(0)
+    if skip_finished:
+        n_subjects = len(run_subjects)
+        run_subjects = unfinished(run_subjects, args.phase)
+        print("%d of %d subjects finished, left out"
+              % (n_subjects - len(run_subjects), n_subjects))
+        if not run_subjects:
+            raise SystemExit(0)
+
+    gate_responses = (args.phase == "all" and response_subjects is not None
+                      and not freeze_response)
+    wf = build_workflow(run_subjects, args.phase)
+    uploader = None
+    if stage_to_scratch and args.no_stage:
+        # The calling run's uploader syncs the tree
+        selectfiles.inputs.base_directory = str(scratch_dir / "input")
+        wf.base_dir = str(scratch_dir)
+    elif stage_to_scratch:
+        # The group step runs on this tree too, including finished subjects
+        stage_subjects = (sorted(set(run_subjects) | set(group_subjects))
+                          if gate_responses else run_subjects)
+        staging.stage_inputs(str(input_dir), str(scratch_dir / "input"),
+                             stage_subjects)
+        selectfiles.inputs.base_directory = str(scratch_dir / "input")
+        staging.restore_working_tree(str(deriv_dir / wf.name),
+                                     str(scratch_dir / wf.name),
+                                     stage_subjects)
+        wf.base_dir = str(scratch_dir)
+        uploader = staging.Uploader(str(scratch_dir / wf.name),
+                                    str(deriv_dir / wf.name), upload_interval)
+        uploader.start()
+
+    if args.phase == "all":
+        wf.write_graph(graph2use="colored", format="png", simple_form=True)
+    fingerprint_store = None
+    if hash_method == "fingerprint":
+        fingerprint_store = fingerprint.install(deriv_dir / ".fingerprints")
     wf.config['execution'] = {'keep_inputs': 'True',
                               'crashfile_format': 'txt',
-                              'remove_unnecessary_outputs': 'False'}
-    wf.run(plugin="MultiProc")
+                              'remove_unnecessary_outputs': 'False',
+                              'hash_method': ('content'
+                                              if hash_method == "fingerprint"
+                                              else hash_method)}
+
+    def build_responses():
+        return subprocess.Popen([sys.executable, op.abspath(__file__),
+                                 "--phase", "group"]
+                                + (["--no-stage"] if stage_to_scratch else []))
+
+    if retain_intermediates and hash_method == "content":
+        raise ValueError("retain_intermediates needs hash_method "
+                         "'timestamp' or 'fingerprint'")
+    plugin = PipelinePlugin(plugin_args={
+        "n_procs": n_cpus,
+        "memory_gb": mem_gb,
+        "scheduler": scheduler,
+        "runtimes": node_runtimes,
+        "runtime_file": str(deriv_dir / "node_runtimes.json"),
+        "retain_nodes": retained_nodes(wf) if retain_intermediates else [],
+        "fingerprint_store": fingerprint_store,
+        "qc_node": dwi_qc.name if qc_gate else None,
+        "response_nodes": [ss3t.name] if gate_responses else [],
+        "response_sources": sorted({c[0].name for c in group_connections}),
+        "response_subjects": group_subjects,
+        "response_inputs": group_responses(Path(wf.base_dir) / wf.name),
+        "build_responses": build_responses,
+        "disk_budget_gb": disk_budget_gb,
+        "disk_budget_dir": str(deriv_dir),
+        "profile_db": profile_db and str(profile_db),
+        "profile_phase": args.phase,
+        "walltime": walltime.Walltime.from_environ(),
+        "walltime_margin": walltime_margin,
+        "status_file": status_dir and str(status_dir / (
+            "%s.json" % args.phase if args.n_shards == 1
+            else "%s_%d.json" % (args.phase, args.shard_index))),
+        "status_port": status_port,
+        "status_interval": status_interval,
+        "status_phase": args.phase})
+    try:
+        wf.run(plugin=plugin)
+    except walltime.WalltimeExceeded as exc:
+        print("Stopped before the end of the walltime (%s), continue in a "
+              "new job" % exc)
+        raise SystemExit(walltime.resubmit_exit_code)
+    finally:
+        if uploader:
+            uploader.stop()
@@ -0,0 +1,187 @@
+import os
+import os.path as op
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import subprocess
+from contextlib import contextmanager
+from nipype import logging
+from nipype.interfaces.base import (
+    BaseInterfaceInputSpec,
+    Directory,
+    traits,
+    isdefined
+)
+
+iflogger = logging.getLogger("nipype.interface")
+
+
+### CONTENT ADDRESSED CACHE ###
+# Shared between workflows and runs: an entry is keyed by the content of the
+# input files, the other input values, the command and the tool version, so
+# it is found again whatever the working directory, workflow name or
+# downstream parameters are.
+#
+# <cache_dir>/<key>/         outputs, hard linked (or copied) from the run
+# <cache_dir>/<key>/.entry   json with the command, key inputs and last use
+
+
+class ContentCacheInputSpec(BaseInterfaceInputSpec):
+    cache_dir = Directory(nohash=True,
+                          desc="Shared cache directory (disabled if unset)")
+    cache_limit_gb = traits.Float(nohash=True,
+                                  desc="Evict least recently used entries "
+                                  "above this size")
+
+
+def file_digest(path, chunk_size=8 * 1024 * 1024):
+    """sha256 of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_or_copy(src, dst):
+    if op.isdir(src):
+        # Output directories, file by file
+        shutil.rmtree(dst, ignore_errors=True)
+        shutil.copytree(src, dst, copy_function=link_or_copy)
+        return
+    if op.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+@contextmanager
+def cache_lock(cache_dir):
+    with open(op.join(cache_dir, ".lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def entry_size(entry):
+    return sum(op.getsize(op.join(root, f))
+               for root, _, files in os.walk(entry) for f in files)
+
+
+def evict(cache_dir, limit_gb):
+    """Remove least recently used entries until the cache fits limit_gb."""
+    entries = []
+    for key in os.listdir(cache_dir):
+        entry = op.join(cache_dir, key)
+        if op.isfile(op.join(entry, ".entry")):
+            entries.append((op.getmtime(op.join(entry, ".entry")),
+                            entry_size(entry), entry))
+
+    total = sum(size for _, size, _ in entries)
+    limit = limit_gb * 1024 ** 3
+    for _, size, entry in sorted(entries):
+        if total <= limit:
+            break
+        iflogger.info("Evicting cache entry %s (%.1f GB)", entry,
+                      size / 1024 ** 3)
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+class ContentCacheMixin:
+    """Look outputs up in a shared content addressed cache before running.
+
+    Mix in ahead of a CommandLine whose input spec includes
+    ContentCacheInputSpec. Set ``_version_cmd`` to a command printing the
+    tool version, otherwise the content of the executable is used.
+    """
+    _version_cmd = None
+
+    def _tool_version(self):
+        if self._version_cmd:
+            out = subprocess.run(self._version_cmd, shell=True,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT,
+                                 universal_newlines=True)
+            return out.stdout.strip()
+        executable = shutil.which(self.cmd.split()[0])
+        return file_digest(executable) if executable else None
+
+    def _key_value(self, value):
+        if isinstance(value, (list, tuple)):
+            return [self._key_value(v) for v in value]
+        if isinstance(value, str) and op.isabs(value) and op.isfile(value):
+            return "sha256:" + file_digest(value)
+        return value
+
+    def _cache_key(self):
+        inputs = {}
+        for name in sorted(self.inputs.copyable_trait_names()):
+            value = getattr(self.inputs, name)
+            if self.inputs.trait(name).nohash or not isdefined(value):
+                continue
+            inputs[name] = self._key_value(value)
+        description = {"interface": type(self).__name__, "cmd": self.cmd,
+                       "version": self._tool_version(), "inputs": inputs}
+        blob = json.dumps(description, sort_keys=True, default=str)
+        return hashlib.sha256(blob.encode()).hexdigest(), description
+
+    def _output_files(self, cwd):
+        """Output files and directories written into the working
+        directory."""
+        files = []
+        for value in self._list_outputs().values():
+            for path in value if isinstance(value, (list, tuple)) else [value]:
+                if (isinstance(path, str) and op.exists(path)
+                        and op.dirname(op.abspath(path)) == cwd):
+                    files.append(op.basename(path))
+        return sorted(set(files))
+
+    def _run_interface(self, runtime):
+        if not isdefined(self.inputs.cache_dir):
+            return super()._run_interface(runtime)
+
+        cache_dir = op.abspath(self.inputs.cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+        key, description = self._cache_key()
+        entry = op.join(cache_dir, key)
+
+        with cache_lock(cache_dir):
+            hit = op.isfile(op.join(entry, ".entry"))
+            if hit:
+                for name in os.listdir(entry):
+                    if name != ".entry":
+                        link_or_copy(op.join(entry, name),
+                                     op.join(runtime.cwd, name))
+                os.utime(op.join(entry, ".entry"))
+        if hit:
+            iflogger.info("Outputs of %s linked from cache entry %s",
+                          self.cmd, entry)
+            runtime.returncode = 0
+            return runtime
+
+        runtime = super()._run_interface(runtime)
+
+        # Stage the entry next to its final location and rename it into
+        # place, so other runs never see a partial entry
+        staging = "%s.tmp-%d" % (entry, os.getpid())
+        os.makedirs(staging, exist_ok=True)
+        for name in self._output_files(runtime.cwd):
+            link_or_copy(op.join(runtime.cwd, name), op.join(staging, name))
+        with open(op.join(staging, ".entry"), "w") as f:
+            json.dump(dict(description, stored=time.time()), f, indent=2,
+                      default=str)
+        with cache_lock(cache_dir):
+            if op.exists(entry):
+                shutil.rmtree(staging)
+            else:
+                os.rename(staging, entry)
+            if isdefined(self.inputs.cache_limit_gb):
+                evict(cache_dir, self.inputs.cache_limit_gb)
+        return runtime
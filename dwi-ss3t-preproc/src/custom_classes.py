@@ -1,13 +1,68 @@
+import os
 import os.path as op
+import glob
+import gzip
+import json
+import shutil
+import subprocess
 from os import name
 from nipype.interfaces.base import (
+    BaseInterfaceInputSpec,
     CommandLineInputSpec,
     CommandLine,
+    SimpleInterface,
+    Directory,
     File,
+    InputMultiObject,
     TraitedSpec,
     Str,
-    traits
+    traits,
+    isdefined
 )
+from nipype.interfaces.io import DataSink, DataSinkInputSpec
+from nipype.utils.filemanip import ensure_list
+import numpy as np
+from .image_io import (
+    load_image,
+    save_nifti,
+    read_bvals,
+    read_bvecs,
+    mean_volumes
+)
+from .regrid import regrid
+from . import qc
+from .cache import ContentCacheInputSpec, ContentCacheMixin
+from .response_store import ResponseStore, read_response
+
+
+### THREADING ###
+
+
+# Thread pools used by the tools wrapped here (OpenMP for eddy_openmp and
+# torch, ITK for ANTs/FreeSurfer, MRtrix's own default)
+thread_env_vars = [
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+    "MRTRIX_NTHREADS"
+]
+
+
+class ThreadedCommandLine(CommandLine):
+    """CommandLine that caps the tool's thread pools at num_threads.
+
+    Node.n_procs sets num_threads, so the thread count the tool uses matches
+    what MultiProc reserves for the node.
+    """
+
+    def _get_environ(self):
+        environ = super()._get_environ()
+        if isdefined(self.inputs.num_threads):
+            environ = dict(environ)
+            for var in thread_env_vars:
+                environ[var] = str(self.inputs.num_threads)
+        return environ
 
 
 ### HD-BET ###
@@ -25,6 +80,7 @@ class HDBETInputSpec(CommandLineInputSpec):
                      default_value=0, usedefault=True)
     out_file = File(desc="Output volume", position=1, argstr="-o %s")
     mask_file = File(desc="Output mask")
+    num_threads = traits.Int(desc="Number of torch threads", nohash=True)
 
 
 class HDBETOutputSpec(TraitedSpec):
@@ -32,7 +88,7 @@ class HDBETOutputSpec(TraitedSpec):
     mask_file = File(desc="Output mask", exists=True)
 
 
-class HDBET(CommandLine):
+class HDBET(ThreadedCommandLine):
     input_spec = HDBETInputSpec
     output_spec = HDBETOutputSpec
     _cmd = "hd-bet"
@@ -44,12 +100,115 @@ class HDBET(CommandLine):
         return outputs
 
 
+### HD-BET (batch) ###
+# Runs hd-bet once over a directory of images so torch start up and model
+# loading are paid once for all subjects instead of once per image
+
+
+class HDBETBatchInputSpec(CommandLineInputSpec):
+    in_files = InputMultiObject(File(exists=True), mandatory=True,
+                                desc="Input volumes")
+    in_dir = Directory("batch_in", usedefault=True, position=0,
+                       argstr="-i %s", desc="Staging directory for inputs")
+    out_dir = Directory("batch_out", usedefault=True, position=1,
+                        argstr="-o %s", desc="Output directory")
+    device = Str(mandatory=False, argstr="-device %s",
+                 default_value="cpu", usedefault=True)
+    mode = Str(mandatory=False, argstr="-mode %s",
+               default_value="fast", usedefault=True)
+    tta = traits.Int(mandatory=False, argstr="-tta %s",
+                     default_value=0, usedefault=True)
+    num_threads = traits.Int(desc="Number of torch threads", nohash=True)
+
+
+class HDBETBatchOutputSpec(TraitedSpec):
+    out_files = traits.List(File(exists=True),
+                            desc="Output volumes, same order as in_files")
+    mask_files = traits.List(File(exists=True),
+                             desc="Output masks, same order as in_files")
+
+
+class HDBETBatch(ThreadedCommandLine):
+    input_spec = HDBETBatchInputSpec
+    output_spec = HDBETBatchOutputSpec
+    _cmd = "hd-bet"
+
+    def _staged_name(self, index):
+        # hd-bet only picks up .nii.gz files from the input directory
+        return "%04d.nii.gz" % index
+
+    def _run_interface(self, runtime):
+        in_dir = op.abspath(self.inputs.in_dir)
+        for path in [in_dir, op.abspath(self.inputs.out_dir)]:
+            if op.exists(path):
+                shutil.rmtree(path)
+        os.makedirs(in_dir)
+
+        for i, in_file in enumerate(self.inputs.in_files):
+            staged = op.join(in_dir, self._staged_name(i))
+            if in_file.endswith(".nii.gz"):
+                os.symlink(in_file, staged)
+            else:
+                with open(in_file, "rb") as f_in, gzip.open(staged, "wb") as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+
+        return super()._run_interface(runtime)
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        out_dir = op.abspath(self.inputs.out_dir)
+        names = [self._staged_name(i) for i in range(len(self.inputs.in_files))]
+        outputs["out_files"] = [op.join(out_dir, n) for n in names]
+        outputs["mask_files"] = [op.join(out_dir, n.replace(".nii.gz", "_mask.nii.gz"))
+                                 for n in names]
+        return outputs
+
+
+class HDBETSelectInputSpec(BaseInterfaceInputSpec):
+    subject_id = Str(mandatory=True, desc="Subject to select")
+    subject_ids = traits.List(Str, mandatory=True,
+                              desc="Subjects in the order of the batch")
+    out_files = traits.List(File(exists=True), mandatory=True)
+    mask_files = traits.List(File(exists=True), mandatory=True)
+    out_file = Str(mandatory=True, desc="Output volume name")
+    mask_file = Str(mandatory=True, desc="Output mask name")
+
+
+class HDBETSelectOutputSpec(TraitedSpec):
+    out_file = File(desc="Output volume", exists=True)
+    mask_file = File(desc="Output mask", exists=True)
+
+
+class HDBETSelect(SimpleInterface):
+    """Fan a subject's outputs back out of an HDBETBatch run.
+
+    Outputs are hard linked (copied across filesystems) to the same names
+    the per-image HDBET node would give them.
+    """
+    input_spec = HDBETSelectInputSpec
+    output_spec = HDBETSelectOutputSpec
+
+    def _run_interface(self, runtime):
+        index = self.inputs.subject_ids.index(self.inputs.subject_id)
+        for field in ["out_file", "mask_file"]:
+            src = getattr(self.inputs, field + "s")[index]
+            dst = op.abspath(getattr(self.inputs, field))
+            if op.exists(dst):
+                os.remove(dst)
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copy(src, dst)
+            self._results[field] = dst
+        return runtime
+
+
 ### SynB0 ###
 # Documentation: https://github.com/MASILab/Synb0-DISCO
 # Fork used here: https://github.com/jakepalmer/Synb0-DISCO
 
 
-class SynB0InputSpec(CommandLineInputSpec):
+class SynB0InputSpec(CommandLineInputSpec, ContentCacheInputSpec):
     in_file = File(exists=True, argstr="%s", mandatory=True,
                    position=0, desc="Distorted B0 image")
     in_T1 = File(exists=True, argstr="%s", mandatory=True,
@@ -59,13 +218,14 @@ class SynB0InputSpec(CommandLineInputSpec):
     run_topup = Str(mandatory=False, argstr="%s",
                     default_value="--notopup", usedefault=True)
     out_file = File(mandatory=True, desc="Undistorted b0")
+    num_threads = traits.Int(desc="Number of threads", nohash=True)
 
 
 class SynB0OutputSpec(TraitedSpec):
     out_file = File(desc="Undistorted B0")
 
 
-class SynB0(CommandLine):
+class SynB0(ContentCacheMixin, ThreadedCommandLine):
     input_spec = SynB0InputSpec
     output_spec = SynB0OutputSpec
     _cmd = "/opt/Synb0-DISCO/src/pipeline.sh"
@@ -76,6 +236,124 @@ class SynB0(CommandLine):
         return outputs
 
 
+### SynB0 (split) ###
+# The steps of pipeline.sh that are not plain FreeSurfer/FSL/ANTs commands,
+# for running Synb0 as separate nodes: the network inference of one fold,
+# the mean over the folds and the distorted/undistorted b0 pair. The
+# inference of each fold only needs the T1 and b0 in atlas space, so the
+# folds can run at the same time.
+
+
+class SynB0InferenceInputSpec(CommandLineInputSpec):
+    in_T1 = File(exists=True, argstr="%s", mandatory=True, position=0,
+                 desc="Normalised T1 in atlas space (2.5 mm)")
+    in_b0 = File(exists=True, argstr="%s", mandatory=True, position=1,
+                 desc="Distorted b0 in atlas space (2.5 mm)")
+    out_file = Str(argstr="%s", mandatory=True, position=2,
+                   desc="Undistorted b0 in atlas space")
+    model_dir = Directory(exists=True, argstr="%s", mandatory=True,
+                          position=3, desc="Directory of the trained models")
+    fold = traits.Int(mandatory=True, desc="Fold of the model to use")
+    num_folds = traits.Int(5, usedefault=True,
+                           desc="Number of folds the models were trained on")
+    num_threads = traits.Int(desc="Number of torch threads", nohash=True)
+
+
+class SynB0InferenceOutputSpec(TraitedSpec):
+    out_file = File(desc="Undistorted b0 in atlas space", exists=True)
+
+
+class SynB0Inference(ThreadedCommandLine):
+    input_spec = SynB0InferenceInputSpec
+    output_spec = SynB0InferenceOutputSpec
+    _cmd = "python3 /opt/Synb0-DISCO/src/inference.py"
+
+    def _format_arg(self, name, spec, value):
+        if name == "model_dir":
+            # Model files are named after their training parameters
+            pattern = op.join(value, "num_fold_%d_total_folds_%d_*.pth"
+                              % (self.inputs.fold, self.inputs.num_folds))
+            models = sorted(glob.glob(pattern))
+            if len(models) != 1:
+                raise ValueError("Expected one model matching %s, found %d"
+                                 % (pattern, len(models)))
+            return spec.argstr % models[0]
+        return super()._format_arg(name, spec, value)
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs["out_file"] = op.abspath(self.inputs.out_file)
+        return outputs
+
+
+class EnsembleMeanInputSpec(BaseInterfaceInputSpec):
+    in_files = InputMultiObject(File(exists=True), mandatory=True,
+                                desc="Images on the same grid")
+    out_file = Str("b0_u_lin_atlas_2_5.nii.gz", usedefault=True,
+                   desc="Mean image (NIfTI)")
+
+
+class EnsembleMeanOutputSpec(TraitedSpec):
+    out_file = File(desc="Mean image", exists=True)
+
+
+class EnsembleMean(SimpleInterface):
+    """Mean of the folds' outputs, as fslmerge -t followed by fslmaths
+    -Tmean without writing the merged series."""
+    input_spec = EnsembleMeanInputSpec
+    output_spec = EnsembleMeanOutputSpec
+
+    def _run_interface(self, runtime):
+        total, affine = None, None
+        for in_file in self.inputs.in_files:
+            data, affine, scaling = load_image(in_file)
+            image = scaling[0] + scaling[1] * np.asarray(data,
+                                                         dtype=np.float64)
+            total = image if total is None else total + image
+        out_file = op.abspath(self.inputs.out_file)
+        save_nifti((total / len(self.inputs.in_files)).astype(np.float32),
+                   affine, out_file)
+        self._results["out_file"] = out_file
+        return runtime
+
+
+class SynB0StackInputSpec(BaseInterfaceInputSpec):
+    in_distorted = File(exists=True, mandatory=True,
+                        desc="Smoothed distorted b0")
+    in_undistorted = File(exists=True, mandatory=True,
+                          desc="Synthesised undistorted b0, on the grid of "
+                          "in_distorted")
+    out_file = Str("b0_all.nii.gz", usedefault=True,
+                   desc="Distorted and undistorted b0 (NIfTI)")
+
+
+class SynB0StackOutputSpec(TraitedSpec):
+    out_file = File(desc="Distorted and undistorted b0", exists=True)
+
+
+class SynB0Stack(SimpleInterface):
+    """The b0 pair pipeline.sh writes to b0_all.nii.gz."""
+    input_spec = SynB0StackInputSpec
+    output_spec = SynB0StackOutputSpec
+
+    def _run_interface(self, runtime):
+        volumes, affine = [], None
+        for in_file in [self.inputs.in_distorted, self.inputs.in_undistorted]:
+            data, affine_in, scaling = load_image(in_file)
+            affine = affine_in if affine is None else affine
+            volume = np.asarray(data, dtype=np.float32)
+            volumes.append(scaling[0] + scaling[1] * volume.reshape(
+                volume.shape[:3]))
+        if volumes[0].shape != volumes[1].shape:
+            raise ValueError("b0 images are on different grids: %s and %s"
+                             % (volumes[0].shape, volumes[1].shape))
+        out_file = op.abspath(self.inputs.out_file)
+        save_nifti(np.stack(volumes, axis=-1).astype(np.float32), affine,
+                   out_file)
+        self._results["out_file"] = out_file
+        return runtime
+
+
 ### MRGRID ###
 # Documentation: https://mrtrix.readthedocs.io/en/latest/reference/commands/mrgrid.html#mrgrid
 
@@ -85,15 +363,28 @@ class MRGridInputSpec(CommandLineInputSpec):
                    mandatory=True, position=0, argstr="%s")
     operation = Str(mandatory=False, argstr="%s", position=1,
                     default_value="regrid", usedefault=True)
-    voxel_size = traits.Float(mandatory=True, argstr="-vox %s", position=2)
+    voxel_size = traits.Float(argstr="-vox %s", position=2,
+                              xor=["template"], desc="Regrid voxel size")
     out_file = Str(desc="Output volume", position=3, argstr="%s")
+    template = File(desc="Regrid onto the voxel grid of this image",
+                    exists=True, argstr="-template %s", xor=["voxel_size"])
+    interp = traits.Enum("cubic", "nearest", "linear", "sinc",
+                         argstr="-interp %s", desc="Regrid interpolation")
+    mask = File(desc="Crop to the extent of this mask", exists=True,
+                argstr="-mask %s")
+    uniform = traits.Int(desc="Crop (positive) or pad (negative) by this "
+                         "many voxels on all sides", argstr="-uniform %d")
+    as_image = File(desc="Crop or pad onto the voxel grid of this image",
+                    exists=True, argstr="-as %s")
+    num_threads = traits.Int(desc="Number of threads", nohash=True,
+                             argstr="-nthreads %d")
 
 
 class MRGridOutputSpec(TraitedSpec):
     out_file = File(desc="Output volume", exists=True)
 
 
-class MRGrid(CommandLine):
+class MRGrid(ThreadedCommandLine):
     input_spec = MRGridInputSpec
     output_spec = MRGridOutputSpec
     _cmd = "mrgrid"
@@ -104,6 +395,54 @@ class MRGrid(CommandLine):
         return outputs
 
 
+### CHUNKED REGRID ###
+# mrgrid regrid in groups of volumes over num_threads processes, into a
+# memory mapped output, so memory is bounded by memory_gb instead of the
+# size of the series (see src/regrid.py)
+
+
+class ChunkedRegridInputSpec(BaseInterfaceInputSpec):
+    in_file = File(desc="Input volume", exists=True, mandatory=True)
+    voxel_size = traits.Float(xor=["template"], desc="Regrid voxel size")
+    template = File(desc="Regrid onto the voxel grid of this image (same "
+                    "axes as in_file)", exists=True, xor=["voxel_size"])
+    interp = traits.Enum("cubic", "nearest", "linear", usedefault=True,
+                         desc="Regrid interpolation")
+    out_file = Str(mandatory=True, desc="Output volume (.mif)")
+    num_threads = traits.Int(1, usedefault=True, nohash=True,
+                             desc="Number of worker processes")
+    memory_gb = traits.Float(2.0, usedefault=True, nohash=True,
+                             desc="Memory budget for the volume groups")
+
+
+class ChunkedRegridOutputSpec(TraitedSpec):
+    out_file = File(desc="Output volume", exists=True)
+
+
+class ChunkedRegrid(SimpleInterface):
+    input_spec = ChunkedRegridInputSpec
+    output_spec = ChunkedRegridOutputSpec
+
+    def _run_interface(self, runtime):
+        if not self.inputs.out_file.endswith(".mif"):
+            raise ValueError("ChunkedRegrid writes .mif images, got %s"
+                             % self.inputs.out_file)
+        if not (isdefined(self.inputs.voxel_size)
+                or isdefined(self.inputs.template)):
+            raise ValueError("ChunkedRegrid needs voxel_size or template")
+        out_file = op.abspath(self.inputs.out_file)
+        regrid(self.inputs.in_file, out_file,
+               vox=(self.inputs.voxel_size
+                    if isdefined(self.inputs.voxel_size) else None),
+               template=(self.inputs.template
+                         if isdefined(self.inputs.template) else None),
+               interp=self.inputs.interp,
+               n_workers=self.inputs.num_threads,
+               memory_gb=self.inputs.memory_gb)
+        self._results["out_file"] = out_file
+        return runtime
+
+
 ### SS3T CSD ###
 # Documentation: https://3tissue.github.io/doc/
 
@@ -125,6 +464,8 @@ class SS3TInputSpec(CommandLineInputSpec):
                   mandatory=True, position=6, argstr="%s")
     in_mask = File(desc="DWI mask", exists=True, mandatory=True,
                    position=7, argstr="-mask %s")
+    num_threads = traits.Int(desc="Number of threads", nohash=True,
+                             argstr="-nthreads %d")
 
 
 class SS3TOutputSpec(TraitedSpec):
@@ -133,7 +474,7 @@ class SS3TOutputSpec(TraitedSpec):
     csf_out = Str(desc="CSF image", exists=True)
 
 
-class SS3T(CommandLine):
+class SS3T(ThreadedCommandLine):
     input_spec = SS3TInputSpec
     output_spec = SS3TOutputSpec
     _cmd = "/opt/MRtrix3Tissue/bin/ss3t_csd_beta1"
@@ -172,6 +513,8 @@ class MTNormaliseInputSpec(CommandLineInputSpec):
                        mandatory=True, position=5, argstr="%s")
     in_mask = File(desc="DWI mask", exists=True, mandatory=True,
                    position=6, argstr="-mask %s")
+    num_threads = traits.Int(desc="Number of threads", nohash=True,
+                             argstr="-nthreads %d")
 
 
 class MTNormaliseOutputSpec(TraitedSpec):
@@ -180,7 +523,7 @@ class MTNormaliseOutputSpec(TraitedSpec):
     csf_norm_out = Str(desc="CSF image", exists=True)
 
 
-class MTNormalise(CommandLine):
+class MTNormalise(ThreadedCommandLine):
     input_spec = MTNormaliseInputSpec
     output_spec = MTNormaliseOutputSpec
     _cmd = "mtnormalise"
@@ -195,6 +538,11 @@ class MTNormalise(CommandLine):
 
 ### MEAN RESPONSE ###
 # Documentation: https://mrtrix.readthedocs.io/en/latest/reference/commands/responsemean.html#responsemean
+# With store_dir set, the responses are merged into the group response store
+# (src/response_store.py) in NumPy and the mean over every subject in the
+# store is written, without calling responsemean. Subjects already in the
+# store with the same response are not merged again. Stored subjects that
+# are no longer in subject_ids, or now fail QC, are taken out of the mean.
 
 
 class MeanResponseInputSpec(CommandLineInputSpec):
@@ -202,6 +550,14 @@ class MeanResponseInputSpec(CommandLineInputSpec):
                            mandatory=True, position=0, argstr="%s")
     out_file = Str(desc="Mean response function",
                    exists=True, mandatory=True, position=-1, argstr="%s")
+    store_dir = Directory(desc="Group response store to merge into")
+    tissue = traits.Enum("wm", "gm", "csf",
+                         desc="Tissue of the responses (for store_dir)")
+    subject_ids = traits.List(Str, desc="Subject of each of in_files, in "
+                              "the same order (for store_dir)")
+    qc_passed = traits.List(traits.Bool, desc="Whether each subject passed "
+                            "QC, in the same order as in_files. Subjects "
+                            "that failed are left out of the mean.")
 
 
 class MeanResponseOutputSpec(TraitedSpec):
@@ -213,16 +569,296 @@ class MeanResponse(CommandLine):
     output_spec = MeanResponseOutputSpec
     _cmd = "responsemean"
 
+    def _passed(self, values):
+        """values of the subjects that passed QC."""
+        if not isdefined(self.inputs.qc_passed):
+            return list(values)
+        if len(self.inputs.qc_passed) != len(self.inputs.in_files):
+            raise ValueError("MeanResponse got %d qc_passed for %d in_files"
+                             % (len(self.inputs.qc_passed),
+                                len(self.inputs.in_files)))
+        passed = [v for v, ok in zip(values, self.inputs.qc_passed) if ok]
+        if not passed:
+            raise ValueError("No subject passed QC, no mean response")
+        return passed
+
+    def _format_arg(self, name, spec, value):
+        if name == "in_files":
+            value = self._passed(value)
+        return super()._format_arg(name, spec, value)
+
+    def _run_interface(self, runtime):
+        if not isdefined(self.inputs.store_dir):
+            return super()._run_interface(runtime)
+        if not isdefined(self.inputs.tissue):
+            raise ValueError("MeanResponse needs tissue with store_dir")
+        if len(self.inputs.subject_ids) != len(self.inputs.in_files):
+            raise ValueError("MeanResponse got %d subject_ids for %d in_files"
+                             % (len(self.inputs.subject_ids),
+                                len(self.inputs.in_files)))
+        passed = self._passed(zip(self.inputs.subject_ids,
+                                  self.inputs.in_files))
+        with ResponseStore(self.inputs.store_dir).open() as store:
+            current = {subject for subject, _ in passed}
+            for subject in store.subjects(self.inputs.tissue):
+                if subject not in current:
+                    store.remove(subject, self.inputs.tissue)
+            for subject, in_file in passed:
+                store.add(subject, self.inputs.tissue, *read_response(in_file))
+            store.write_mean(self.inputs.tissue,
+                             op.abspath(self.inputs.out_file))
+        runtime.returncode = 0
+        return runtime
+
     def _list_outputs(self):
         outputs = self.output_spec().get()
         outputs["out_file"] = op.abspath(self.inputs.out_file)
         return outputs
 
 
+### MEAN B0 ###
+# Same result as dwiextract -bzero followed by mrmath mean -axis 3, without
+# writing the extracted b0 series to disk
+
+
+class MeanB0InputSpec(BaseInterfaceInputSpec):
+    in_file = File(desc="DWI series (NIfTI or MRtrix format)", exists=True,
+                   mandatory=True)
+    in_bval = File(desc="bvals file in FSL format", exists=True,
+                   mandatory=True)
+    bzero_threshold = traits.Float(10.0, usedefault=True,
+                                   desc="Largest b-value treated as b=0 "
+                                   "(MRtrix BZeroThreshold)")
+    out_file = Str("b0_mean.nii.gz", usedefault=True,
+                   desc="Mean b0 image (NIfTI)")
+
+
+class MeanB0OutputSpec(TraitedSpec):
+    out_file = File(desc="Mean b0 image", exists=True)
+
+
+class MeanB0(SimpleInterface):
+    input_spec = MeanB0InputSpec
+    output_spec = MeanB0OutputSpec
+
+    def _run_interface(self, runtime):
+        data, affine, scaling = load_image(self.inputs.in_file)
+        bvals = read_bvals(self.inputs.in_bval)
+        n_volumes = data.shape[3] if len(data.shape) == 4 else 1
+        if n_volumes != len(bvals):
+            raise ValueError("%s has %d volumes but %s has %d b-values"
+                             % (self.inputs.in_file, n_volumes,
+                                self.inputs.in_bval, len(bvals)))
+        b0_volumes = np.flatnonzero(bvals <= self.inputs.bzero_threshold)
+        if len(b0_volumes) == 0:
+            raise ValueError("No b=0 volumes in %s" % self.inputs.in_bval)
+
+        mean = mean_volumes(data, b0_volumes, scaling)
+        out_file = op.abspath(self.inputs.out_file)
+        save_nifti(mean, affine, out_file)
+        self._results["out_file"] = out_file
+        return runtime
+
+
+### DWI QC ###
+# Per-subject QC of the preprocessed DWI against thresholds (see src/qc.py).
+# The image is memory mapped and only its b=0 volumes are read. in_file is
+# passed on as out_file, so steps reading the DWI through this node only
+# start once the subject passed.
+
+
+class DWIQCInputSpec(BaseInterfaceInputSpec):
+    in_file = File(desc="Preprocessed DWI series", exists=True,
+                   mandatory=True)
+    in_bval = File(desc="bvals of in_file in FSL format", exists=True,
+                   mandatory=True)
+    in_bvec = File(desc="bvecs of in_file in FSL format", exists=True,
+                   mandatory=True)
+    orig_bval = File(desc="Acquired bvals in FSL format", exists=True,
+                     mandatory=True)
+    orig_bvec = File(desc="Acquired bvecs in FSL format", exists=True,
+                     mandatory=True)
+    eddyqc_dir = Directory(desc="eddy's text QC outputs (dwifslpreproc "
+                           "-eddyqc_text)", exists=True)
+    thresholds = traits.Dict(Str, traits.Float, mandatory=True,
+                             desc="Limits, {max_<metric>|min_<metric>: "
+                             "value}")
+    bzero_threshold = traits.Float(10.0, usedefault=True,
+                                   desc="Largest b-value treated as b=0 "
+                                   "(MRtrix BZeroThreshold)")
+    out_report = Str(qc.report_name, usedefault=True,
+                     desc="QC report (json)")
+
+
+class DWIQCOutputSpec(TraitedSpec):
+    passed = traits.Bool(desc="Whether every metric is within thresholds")
+    failures = traits.List(Str, desc="Checks failed")
+    out_report = File(desc="QC report", exists=True)
+    out_file = File(desc="in_file", exists=True)
+
+
+class DWIQC(SimpleInterface):
+    input_spec = DWIQCInputSpec
+    output_spec = DWIQCOutputSpec
+
+    def _run_interface(self, runtime):
+        data, _, scaling = load_image(self.inputs.in_file)
+        n_volumes = data.shape[3] if len(data.shape) == 4 else 1
+        bvals = read_bvals(self.inputs.in_bval)
+        metrics, failures = qc.gradient_metrics(
+            n_volumes, bvals, read_bvecs(self.inputs.in_bvec),
+            read_bvals(self.inputs.orig_bval),
+            read_bvecs(self.inputs.orig_bvec), self.inputs.bzero_threshold)
+
+        b0_volumes = np.flatnonzero(bvals <= self.inputs.bzero_threshold)
+        if len(data.shape) == 4 and len(bvals) == n_volumes and len(
+                b0_volumes):
+            # One volume at a time, the rest of the series is not read
+            b0 = np.stack([np.asarray(data[..., v], dtype=np.float32)
+                           for v in b0_volumes], axis=-1)
+            metrics["b0_snr"] = qc.b0_snr(scaling[0] + scaling[1] * b0)
+        if isdefined(self.inputs.eddyqc_dir):
+            metrics.update(qc.eddy_metrics(self.inputs.eddyqc_dir, bvals,
+                                           self.inputs.bzero_threshold))
+        failures += qc.check(metrics, self.inputs.thresholds)
+
+        out_report = op.abspath(self.inputs.out_report)
+        with open(out_report, "w") as f:
+            json.dump({"passed": not failures, "failures": failures,
+                       "metrics": metrics,
+                       "thresholds": self.inputs.thresholds}, f, indent=2)
+        self._results["passed"] = not failures
+        self._results["failures"] = failures
+        self._results["out_report"] = out_report
+        self._results["out_file"] = self.inputs.in_file
+        return runtime
+
+
+### COMPRESS ###
+# gzip an output for delivery, with pigz when it is available
+
+
+class CompressInputSpec(BaseInterfaceInputSpec):
+    in_file = File(desc="File to compress", exists=True, mandatory=True)
+    compresslevel = traits.Range(1, 9, 6, usedefault=True,
+                                 desc="gzip compression level")
+    num_threads = traits.Int(1, usedefault=True, nohash=True,
+                             desc="Number of pigz threads")
+
+
+class CompressOutputSpec(TraitedSpec):
+    out_file = File(desc="Compressed file", exists=True)
+
+
+class Compress(SimpleInterface):
+    input_spec = CompressInputSpec
+    output_spec = CompressOutputSpec
+
+    def _run_interface(self, runtime):
+        out_file = op.abspath(op.basename(self.inputs.in_file) + ".gz")
+        level = self.inputs.compresslevel
+        with open(out_file, "wb") as f_out:
+            if shutil.which("pigz"):
+                # -n keeps the name and mtime out of the header, as below
+                subprocess.run(["pigz", "-n", "-c", "-%d" % level,
+                                "-p", str(self.inputs.num_threads),
+                                self.inputs.in_file], stdout=f_out, check=True)
+            else:
+                with open(self.inputs.in_file, "rb") as f_in, \
+                        gzip.GzipFile(fileobj=f_out, mode="wb",
+                                      compresslevel=level, mtime=0) as gz:
+                    shutil.copyfileobj(f_in, gz, 16 * 1024 * 1024)
+        self._results["out_file"] = out_file
+        return runtime
+
+
+### DATASINK ###
+# DataSink that delivers files by hard link, reflink or move instead of a
+# copy, and skips files already delivered without re-reading them
+
+
+def deliver(src, dst, mode):
+    """Put src at dst by hard link, reflink, move (leaving a symlink at src)
+    or copy, falling back to a copy when the link cannot be made."""
+    if op.exists(dst):
+        src_stat, dst_stat = os.stat(src), os.stat(dst)
+        if op.samefile(src, dst) or (
+                src_stat.st_size == dst_stat.st_size
+                and src_stat.st_mtime_ns == dst_stat.st_mtime_ns):
+            return
+    if op.lexists(dst):
+        os.remove(dst)
+
+    if mode == "hardlink":
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    elif mode == "reflink":
+        if subprocess.run(["cp", "--reflink=always", "--preserve=timestamps",
+                           src, dst], stderr=subprocess.DEVNULL).returncode == 0:
+            return
+    elif mode == "move":
+        # The symlink keeps the node's outputs in place for downstream nodes
+        # and for the cache check on a rerun
+        shutil.move(src, dst)
+        os.symlink(dst, src)
+        return
+    shutil.copy2(src, dst)
+
+
+class LinkDataSinkInputSpec(DataSinkInputSpec):
+    link_mode = traits.Enum("hardlink", "reflink", "move", "copy",
+                            usedefault=True, desc="How files are delivered")
+
+
+class LinkDataSink(DataSink):
+    """DataSink for local base directories delivering files with deliver().
+
+    Output paths are built as in DataSink (containers, parameterization and
+    substitutions). S3 and local_copy are handed to DataSink.
+    """
+    input_spec = LinkDataSinkInputSpec
+
+    def _list_outputs(self):
+        if (not isdefined(self.inputs.base_directory)
+                or self.inputs.base_directory.startswith("s3://")
+                or isdefined(self.inputs.local_copy)):
+            return super()._list_outputs()
+
+        outputs = self.output_spec().get()
+        outdir = op.abspath(self.inputs.base_directory)
+        if isdefined(self.inputs.container):
+            outdir = op.join(outdir, self.inputs.container)
+
+        out_files = []
+        for key, files in list(self.inputs._outputs.items()):
+            if not isdefined(files):
+                continue
+            keydir = op.join(outdir, *[d for d in key.split(".")
+                                       if not d.startswith("@")])
+            files = ensure_list(files)
+            if isinstance(files[0], list):
+                files = [item for sublist in files for item in sublist]
+            for src in files:
+                src = op.abspath(src)
+                dst = self._substitute(op.join(keydir, self._get_dst(src)))
+                os.makedirs(op.dirname(dst), exist_ok=True)
+                if op.isdir(src):
+                    shutil.copytree(src, dst, dirs_exist_ok=True)
+                else:
+                    deliver(src, dst, self.inputs.link_mode)
+                out_files.append(dst)
+
+        outputs["out_file"] = out_files
+        return outputs
+
+
 ### MRTRIX DWI PREPROCESS ###
 
 
-class DWIPreprocInputSpec(CommandLineInputSpec):
+class DWIPreprocInputSpec(CommandLineInputSpec, ContentCacheInputSpec):
     in_file = File(
         exists=True, argstr="%s", position=0, mandatory=True, desc="input DWI image"
     )
@@ -270,6 +906,10 @@ class DWIPreprocInputSpec(CommandLineInputSpec):
         argstr='-topup_options "%s"',
         desc="Manually provide additional command-line options to the topup command",
     )
+    eddyqc_text = traits.Str(
+        argstr="-eddyqc_text %s",
+        desc="Directory to copy eddy's text QC outputs (motion, outliers) to",
+    )
     export_grad_mrtrix = traits.Bool(
         argstr="-export_grad_mrtrix", desc="export new gradient files in mrtrix format"
     )
@@ -297,6 +937,11 @@ class DWIPreprocInputSpec(CommandLineInputSpec):
     in_bval = File(
         exists=True, argstr="%s", desc="bvals file in FSL format", position=-1
     )
+    num_threads = traits.Int(
+        argstr="-nthreads %d",
+        nohash=True,
+        desc="Number of threads for MRtrix commands and eddy_openmp",
+    )
 
 
 class DWIPreprocOutputSpec(TraitedSpec):
@@ -319,10 +964,12 @@ class DWIPreprocOutputSpec(TraitedSpec):
         usedefault=True,
         desc="exported fsl gradient bval file",
     )
+    out_eddyqc = Directory(desc="eddy's text QC outputs")
 
 
-class DWIPreproc(CommandLine):
+class DWIPreproc(ContentCacheMixin, ThreadedCommandLine):
     _cmd = "dwifslpreproc"
+    _version_cmd = "dwifslpreproc -version; cat ${FSLDIR}/etc/fslversion"
     input_spec = DWIPreprocInputSpec
     output_spec = DWIPreprocOutputSpec
 
@@ -335,5 +982,7 @@ class DWIPreproc(CommandLine):
         if self.inputs.export_grad_fsl:
             outputs["out_fsl_bvec"] = op.abspath(self.inputs.out_grad_fsl[0])
             outputs["out_fsl_bval"] = op.abspath(self.inputs.out_grad_fsl[1])
+        if isdefined(self.inputs.eddyqc_text):
+            outputs["out_eddyqc"] = op.abspath(self.inputs.eddyqc_text)
 
         return outputs
@@ -0,0 +1,148 @@
+import os
+import os.path as op
+import re
+import json
+import numpy as np
+import nibabel as nb
+
+
+### SUBJECT DISCOVERY ###
+# Subjects are the sub-<label> directories of the input directory that have
+# every file of the selectfiles templates, checked from the headers only:
+# the T1w is 3D, the DWI 4D with as many volumes as b-values and b-vectors,
+# and there is a b=0 volume. Incomplete subjects are reported and left out
+# at startup instead of failing inside the workflow. The results are kept in
+# an index file with each subject's directory and file stats, and only
+# subjects whose stats changed are checked again, so a large cohort is
+# listed with a stat per file.
+
+
+subject_pattern = re.compile(r"^sub-[A-Za-z0-9]+$")
+
+# Largest b-value counted as b=0, as MeanB0
+bzero_threshold = 10
+
+
+def image_shape(path):
+    """Shape from the image header, without reading the data."""
+    return nb.load(path).shape
+
+
+def check_files(files):
+    """Problems with a subject's files, by template name (anat, dwi, bval,
+    bvec as in run.py)."""
+    missing = [name for name, path in sorted(files.items())
+               if not op.isfile(path)]
+    if missing:
+        return ["missing %s (%s)" % (name, files[name]) for name in missing]
+
+    problems = []
+    try:
+        t1_shape = image_shape(files["anat"])
+        if len(t1_shape) != 3 and t1_shape[3:] != (1,):
+            problems.append("T1w is not 3D: %s" % (t1_shape,))
+    except Exception as exc:
+        problems.append("unreadable T1w header: %s" % exc)
+    try:
+        dwi_shape = image_shape(files["dwi"])
+    except Exception as exc:
+        return problems + ["unreadable DWI header: %s" % exc]
+    if len(dwi_shape) != 4:
+        return problems + ["DWI is not 4D: %s" % (dwi_shape,)]
+
+    n_volumes = dwi_shape[3]
+    try:
+        bvals = np.loadtxt(files["bval"], ndmin=1)
+        bvecs = np.loadtxt(files["bvec"], ndmin=2)
+    except ValueError as exc:
+        return problems + ["unreadable gradient table: %s" % exc]
+    if bvals.size != n_volumes:
+        problems.append("DWI has %d volumes, bval %d values"
+                        % (n_volumes, bvals.size))
+    elif not np.any(bvals <= bzero_threshold):
+        problems.append("no b=0 volume in bval")
+    if bvecs.shape not in [(3, n_volumes), (n_volumes, 3)]:
+        problems.append("DWI has %d volumes, bvec is %d x %d"
+                        % ((n_volumes,) + bvecs.shape))
+    return problems
+
+
+def stat_signature(paths):
+    """Modification time and size of each path, None if missing."""
+    signature = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            signature.append([st.st_mtime_ns, st.st_size])
+        except OSError:
+            signature.append(None)
+    return signature
+
+
+class SubjectIndex:
+    """Checked subjects of a BIDS input directory, cached in index_file.
+
+    templates are the selectfiles templates, formatted with subject_id.
+    """
+
+    def __init__(self, input_dir, templates, index_file):
+        self.input_dir = str(input_dir)
+        self.templates = templates
+        self.index_file = str(index_file)
+
+    def _files(self, subject):
+        return {name: op.join(self.input_dir,
+                              template.format(subject_id=subject))
+                for name, template in self.templates.items()}
+
+    def _load(self):
+        try:
+            with open(self.index_file) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if (index.get("input_dir") != self.input_dir
+                or index.get("templates") != self.templates):
+            return {}
+        return index.get("subjects", {})
+
+    def refresh(self):
+        """Check the subjects that are new or changed since the index was
+        written. Returns the complete subjects, sorted, and the problems of
+        the others by directory name."""
+        cached = self._load()
+        entries, problems = {}, {}
+        with os.scandir(self.input_dir) as it:
+            names = sorted(e.name for e in it if e.is_dir()
+                           and e.name.startswith("sub-"))
+        for name in names:
+            if not subject_pattern.match(name):
+                problems[name] = ["not a BIDS subject label (sub-<label>)"]
+                continue
+            files = self._files(name)
+            paths = [op.join(self.input_dir, name)]
+            paths += sorted({op.dirname(p) for p in files.values()})
+            paths += [files[k] for k in sorted(files)]
+            signature = stat_signature(paths)
+            entry = cached.get(name)
+            if entry is None or entry["signature"] != signature:
+                entry = {"signature": signature,
+                         "problems": check_files(files)}
+            entries[name] = entry
+            if entry["problems"]:
+                problems[name] = entry["problems"]
+
+        if entries != cached:
+            self._save(entries)
+        complete = [s for s in names if s in entries and s not in problems]
+        return complete, problems
+
+    def _save(self, entries):
+        # Array tasks refresh at the same time, each replaces the file whole
+        tmp_file = "%s.%d.tmp" % (self.index_file, os.getpid())
+        os.makedirs(op.dirname(self.index_file) or ".", exist_ok=True)
+        with open(tmp_file, "w") as f:
+            json.dump({"input_dir": self.input_dir,
+                       "templates": self.templates,
+                       "subjects": entries}, f)
+        os.replace(tmp_file, self.index_file)
@@ -0,0 +1,86 @@
+import os
+import os.path as op
+import json
+import hashlib
+from nipype.interfaces.base import specs
+
+
+### FILE FINGERPRINTS ###
+# A cheaper stand-in for nipype's "content" hashing of large images: the
+# md5 of the file size, the first block (the whole NIfTI/MRtrix header) and
+# evenly spaced sample blocks, so a multi-GB DWI series costs a few reads
+# rather than a full pass. Fingerprints are kept in per-file sidecars under
+# store_dir named by device and inode, and reused while mtime and size are
+# unchanged, so an unchanged file is not read again on a rerun.
+#
+# Files smaller than the sample are hashed in full, as nipype does.
+
+
+block_size = 64 * 1024
+n_blocks = 16
+
+
+def fingerprint(path):
+    """md5 of the size, header block and sampled blocks of a file."""
+    size = op.getsize(path)
+    md5 = hashlib.md5(str(size).encode())
+    with open(path, "rb") as f:
+        if size <= block_size * (n_blocks + 1):
+            md5.update(f.read())
+        else:
+            step = (size - block_size) // n_blocks
+            for offset in [0] + [step * (i + 1) for i in range(n_blocks)]:
+                f.seek(offset)
+                md5.update(f.read(block_size))
+    return md5.hexdigest()
+
+
+class FingerprintStore:
+    """Sidecar store of fingerprints keyed on inode, mtime and size."""
+
+    def __init__(self, store_dir):
+        self.store_dir = str(store_dir)
+        os.makedirs(self.store_dir, exist_ok=True)
+
+    def _sidecar(self, stat):
+        return op.join(self.store_dir, "%d-%d.json" % (stat.st_dev,
+                                                       stat.st_ino))
+
+    def get(self, path):
+        stat = os.stat(path)
+        sidecar = self._sidecar(stat)
+        try:
+            with open(sidecar) as f:
+                entry = json.load(f)
+            if (entry["mtime_ns"] == stat.st_mtime_ns
+                    and entry["size"] == stat.st_size):
+                return entry["fingerprint"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+        entry = {"path": op.abspath(path), "mtime_ns": stat.st_mtime_ns,
+                 "size": stat.st_size, "fingerprint": fingerprint(path)}
+        # Written next to the sidecar and renamed, as several workers can
+        # fingerprint the same input at once
+        tmp = "%s.%d" % (sidecar, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp, sidecar)
+        return entry["fingerprint"]
+
+    def hash_infile(self, afile, *args, raise_notfound=False, **kwargs):
+        """Drop-in for nipype.utils.filemanip.hash_infile."""
+        if not op.isfile(afile):
+            if raise_notfound:
+                raise RuntimeError('File "%s" not found.' % afile)
+            return None
+        return self.get(afile)
+
+
+def install(store_dir):
+    """Use stored fingerprints wherever nipype hashes input files by content
+    (hash_method "content"). MultiProc workers pick this up as long as they
+    are forked, the default on Linux."""
+    store = FingerprintStore(store_dir)
+    specs.hash_infile = store.hash_infile
+    return store
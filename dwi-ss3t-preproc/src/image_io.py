@@ -0,0 +1,220 @@
+import gzip
+import os.path as op
+import numpy as np
+import nibabel as nb
+
+
+### MRTRIX IMAGE FORMAT ###
+# Documentation: https://mrtrix.readthedocs.io/en/latest/getting_started/image_data.html#mrtrix-image-formats
+
+
+mif_datatypes = {
+    "Int8": "i1",
+    "UInt8": "u1",
+    "Int16": "i2",
+    "UInt16": "u2",
+    "Int32": "i4",
+    "UInt32": "u4",
+    "Int64": "i8",
+    "UInt64": "u8",
+    "Float32": "f4",
+    "Float64": "f8",
+}
+
+
+class MifImage:
+    """Minimal reader for MRtrix .mif/.mif.gz/.mih images.
+
+    ``data`` is indexed in the order of the header's dim entries (like the
+    dataobj of a nibabel image) whatever the on-disk layout, and is a
+    memory map for uncompressed images so volumes can be read one at a time.
+    Intensity scaling is not applied to ``data``, see ``scaling``.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.header = {}
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rb") as f:
+            if f.readline().strip() != b"mrtrix image":
+                raise ValueError("Not an MRtrix image: %s" % path)
+            for line in f:
+                line = line.decode("latin-1").strip()
+                if line == "END":
+                    break
+                key, _, value = line.partition(":")
+                self.header.setdefault(key.strip(), []).append(value.strip())
+
+        self.shape = tuple(int(d) for d in self._get("dim").split(","))
+        self.vox = [float(v) for v in self._get("vox").split(",")]
+        self.dtype = self._parse_datatype(self._get("datatype"))
+        self.layout = [(-1 if s[0] == "-" else 1, int(s[1:]))
+                       for s in self._get("layout").split(",")]
+        self.scaling = (0.0, 1.0)
+        if "scaling" in self.header:
+            offset, multiplier = self._get("scaling").split(",")
+            self.scaling = (float(offset), float(multiplier))
+
+        transform = np.eye(4)
+        for row, values in enumerate(self.header.get("transform", [])[:3]):
+            transform[row] = [float(v) for v in values.split(",")]
+        self.affine = transform.copy()
+        self.affine[:3, :3] = transform[:3, :3] * self.vox[:3]
+
+        data_file, offset = self._get("file").split()
+        if data_file == ".":
+            data_file = path
+        else:
+            data_file = op.join(op.dirname(path), data_file)
+        self.data = self._map_data(data_file, int(offset))
+
+    def _get(self, key):
+        if key not in self.header:
+            raise ValueError("Missing '%s' in MRtrix header: %s"
+                             % (key, self.path))
+        return self.header[key][0]
+
+    def _parse_datatype(self, datatype):
+        byteorder = "="
+        if datatype.endswith("LE"):
+            byteorder, datatype = "<", datatype[:-2]
+        elif datatype.endswith("BE"):
+            byteorder, datatype = ">", datatype[:-2]
+        if datatype not in mif_datatypes:
+            raise ValueError("Unsupported MRtrix datatype %s: %s"
+                             % (datatype, self.path))
+        return np.dtype(byteorder + mif_datatypes[datatype])
+
+    def _map_data(self, data_file, offset):
+        size = int(np.prod(self.shape))
+        if data_file.endswith(".gz"):
+            with gzip.open(data_file, "rb") as f:
+                f.seek(offset)
+                flat = np.frombuffer(f.read(size * self.dtype.itemsize),
+                                     dtype=self.dtype)
+        else:
+            flat = np.memmap(data_file, dtype=self.dtype, mode="r",
+                             offset=offset, shape=(size,))
+
+        # Stride (in elements) of each axis from its rank in the layout,
+        # axes stored in reverse start from the far end
+        strides = [0] * len(self.shape)
+        step = 1
+        for axis in sorted(range(len(self.shape)),
+                           key=lambda a: self.layout[a][1]):
+            strides[axis] = self.layout[axis][0] * step
+            step *= self.shape[axis]
+        start = sum((n - 1) * abs(s) for n, s in zip(self.shape, strides)
+                    if s < 0)
+        return np.lib.stride_tricks.as_strided(
+            flat[start:], shape=self.shape,
+            strides=[s * self.dtype.itemsize for s in strides],
+            writeable=False)
+
+
+def _mif_datatype(dtype):
+    names = {np.dtype(code): name for name, code in mif_datatypes.items()}
+    if dtype.newbyteorder("=") not in names:
+        raise ValueError("Unsupported datatype for MRtrix images: %s"
+                         % dtype)
+    datatype = names[dtype.newbyteorder("=")]
+    return datatype + "LE" if dtype.itemsize > 1 else datatype
+
+
+def _mif_header(shape, affine, dtype, keyvals=None):
+    """Header of an image with the data following it in the same file,
+    and the data offset."""
+    vox = np.linalg.norm(affine[:3, :3], axis=0)
+    transform = np.array(affine[:3], dtype=float)
+    transform[:, :3] /= vox
+    lines = ["mrtrix image",
+             "dim: " + ",".join(str(d) for d in shape),
+             "vox: " + ",".join("%g" % v for v in
+                                list(vox) + [1] * (len(shape) - 3)),
+             "layout: " + ",".join("+%d" % a for a in range(len(shape))),
+             "datatype: " + _mif_datatype(dtype)]
+    lines += ["transform: " + ",".join("%.10g" % v for v in row)
+              for row in transform]
+    for key, values in (keyvals or {}).items():
+        lines += ["%s: %s" % (key, value) for value in values]
+    header = "\n".join(lines) + "\nfile: . "
+    # Data offset, written in the header it follows: room for 8 digits,
+    # aligned to 16 bytes
+    offset = -(-(len(header) + 8 + len("\nEND\n")) // 16) * 16
+    header = (header + "%d\nEND\n" % offset).encode("latin-1")
+    return header.ljust(offset, b"\0"), offset
+
+
+def save_mif(data, affine, path, keyvals=None):
+    """Save an image in MRtrix format (.mif or .mif.gz), little endian with
+    the first axis fastest (layout +0,+1,...). Boolean data is saved as
+    UInt8. keyvals are extra header entries, {key: [values]}."""
+    data = np.asarray(data)
+    if data.dtype == bool:
+        data = data.astype(np.uint8)
+    header, _ = _mif_header(data.shape, affine, data.dtype, keyvals)
+
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "wb") as f:
+        f.write(header)
+        f.write(data.astype(data.dtype.newbyteorder("<"))
+                .tobytes(order="F"))
+
+
+def create_mif(path, shape, affine, dtype=np.float32, keyvals=None):
+    """Allocate an uncompressed .mif image (layout as save_mif) and return
+    its data as a writable memory map. Each volume of a 4D image is
+    contiguous on disk, so volumes can be written, and later read, one at a
+    time."""
+    dtype = np.dtype(dtype).newbyteorder("<")
+    header, offset = _mif_header(shape, affine, dtype, keyvals)
+    with open(path, "wb") as f:
+        f.write(header)
+        f.truncate(offset + int(np.prod(shape)) * dtype.itemsize)
+    return np.memmap(path, dtype=dtype, mode="r+", offset=offset,
+                     shape=tuple(shape), order="F")
+
+
+def load_image(path):
+    """Load a NIfTI or MRtrix image lazily.
+
+    Returns ``(data, affine, scaling)`` where ``data`` can be sliced one
+    volume at a time without reading the whole series and ``scaling`` is the
+    (offset, multiplier) still to be applied to it.
+    """
+    if path.endswith((".mif", ".mif.gz", ".mih")):
+        img = MifImage(path)
+        return img.data, img.affine, img.scaling
+    # keep_file_open avoids re-reading gzipped files from the start for
+    # every slice
+    img = nb.load(path, keep_file_open=path.endswith(".gz"))
+    return img.dataobj, img.affine, (0.0, 1.0)
+
+
+def save_nifti(data, affine, path):
+    """Save a NIfTI image with both qform and sform set to scanner space,
+    as MRtrix does."""
+    img = nb.Nifti1Image(data, affine)
+    img.set_qform(affine, code=1)
+    img.set_sform(affine, code=1)
+    img.to_filename(path)
+
+
+def read_bvals(path):
+    """Read an FSL format bval file."""
+    with open(path) as f:
+        return np.array(f.read().split(), dtype=float)
+
+
+def read_bvecs(path):
+    """Read an FSL format bvec file, as a 3 x volumes array."""
+    return np.atleast_2d(np.loadtxt(path))
+
+
+def mean_volumes(data, volumes, scaling=(0.0, 1.0)):
+    """Mean of the given volumes of a 4D image, read one volume at a time."""
+    total = np.zeros(data.shape[:3], dtype=np.float64)
+    for v in volumes:
+        total += np.asarray(data[..., v], dtype=np.float64)
+    mean = total / len(volumes)
+    return (scaling[0] + scaling[1] * mean).astype(np.float32)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+#####
+# Submit a sharded run as a chain of PBS jobs
+#
+# preproc (array) -> group (single job) -> fod (array)
+#
+# or, when run.py sets response_subjects, with --response-subset:
+#
+# group (single job, the subset only) -> fod (array)
+# preproc (array, everything else)    -^
+#
+# or, when run.py sets freeze_response, with --frozen-response:
+#
+# fod (array, against the published group responses)
+#
+# A job that runs out of walltime (see src/walltime.py) submits its
+# continuation with --continuation, from the job script. Jobs waiting for
+# it are made to wait for the continuation too.
+#
+# The script can be a directory of job scripts per phase, submit_<phase>.pbs
+# (as written by run.py --plan).
+#
+# Only uses the standard library so it can be run on the login node,
+# outside the container:
+#   python3 code/src/pbs.py --n-shards 8 code/submit_run.pbs
+#####
+
+import os
+import re
+import fcntl
+import argparse
+import subprocess
+
+
+def qsub(script, env, array_size=1, depend=None, qsub_cmd="qsub"):
+    """Submit one job and return the job id printed by qsub."""
+    cmd = [qsub_cmd]
+    if array_size > 1:
+        # PBS arrays need at least two sub jobs
+        cmd += ["-J", "0-%d" % (array_size - 1)]
+    if depend:
+        cmd += ["-W", "depend=afterok:%s" % depend]
+    # Lets the job submit its own continuation
+    env = dict(env, SUBMIT_SCRIPT=os.path.abspath(script))
+    cmd += ["-v", ",".join("%s=%s" % (k, v) for k, v in env.items())]
+    cmd.append(script)
+    out = subprocess.run(cmd, check=True, stdout=subprocess.PIPE,
+                         universal_newlines=True)
+    return out.stdout.strip()
+
+
+def phase_script(script, phase):
+    """Job script for a phase, from a directory of scripts per phase."""
+    if os.path.isdir(script):
+        return os.path.join(script, "submit_%s.pbs" % phase)
+    return script
+
+
+def submit_sharded(script, n_shards, qsub_cmd="qsub", response_subset=False,
+                   frozen_response=False):
+    """Submit the preproc, group and fod phases with dependencies."""
+    env = {"N_SHARDS": n_shards}
+
+    def submit(phase, **kwargs):
+        return qsub(phase_script(script, phase), dict(env, PHASE=phase),
+                    qsub_cmd=qsub_cmd, **kwargs)
+
+    if frozen_response:
+        return {"fod": submit("fod", array_size=n_shards)}
+    if response_subset:
+        # The rest of the cohort is preprocessed alongside the subset's
+        # group job instead of waiting for it
+        group_id = submit("group")
+        preproc_id = submit("preproc", array_size=n_shards)
+        fod_id = submit("fod", array_size=n_shards,
+                        depend="%s:%s" % (group_id, preproc_id))
+        return {"group": group_id, "preproc": preproc_id, "fod": fod_id}
+    preproc_id = submit("preproc", array_size=n_shards)
+    group_id = submit("group", depend=preproc_id)
+    fod_id = submit("fod", array_size=n_shards, depend=group_id)
+    return {"preproc": preproc_id, "group": group_id, "fod": fod_id}
+
+
+def job_depend(job_id, qstat_cmd="qstat"):
+    """Dependencies of a job from qstat -f, e.g. {"afterok": ["12[].pbs"]}.
+    Empty if qstat is not available."""
+    try:
+        out = subprocess.run([qstat_cmd, "-f", job_id], check=True,
+                             stdout=subprocess.PIPE,
+                             universal_newlines=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+    # Long attributes are wrapped onto tab indented lines
+    match = re.search(r"depend = (.*)", re.sub(r"\n\t", "", out))
+    depend = {}
+    for entry in match.group(1).split(",") if match else []:
+        kind, *jobs = entry.strip().split(":")
+        depend[kind] = [j.split("@")[0] for j in jobs]
+    return depend
+
+
+def submit_continuation(script, env, job_id, qsub_cmd="qsub",
+                        qstat_cmd="qstat", qalter_cmd="qalter"):
+    """Submit a job carrying on from job_id, and make the jobs waiting for
+    job_id to succeed wait for the continuation as well."""
+    continuation_id = qsub(script, env, qsub_cmd=qsub_cmd)
+    # Array sub jobs 12[3].pbs: the dependencies are on the array 12[].pbs
+    array_id = re.sub(r"\[\d+\]", "[]", job_id)
+    # Sub jobs of an array can stop at the same time. Each reads, extends
+    # and writes back the dependents' dependencies, so they take turns
+    lock_file = os.path.join(os.path.dirname(os.path.abspath(script)),
+                             ".pbs_depend.lock")
+    with open(lock_file, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            for dependent in job_depend(array_id, qstat_cmd).get("beforeok",
+                                                                 []):
+                afterok = job_depend(dependent, qstat_cmd).get("afterok", [])
+                subprocess.run([qalter_cmd, "-W", "depend=afterok:%s"
+                                % ":".join(afterok + [continuation_id]),
+                                dependent], check=True)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return continuation_id
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Submit a sharded dwi-ss3t-preproc run")
+    parser.add_argument("script", help="PBS job script (e.g. submit_run.pbs)")
+    parser.add_argument("--n-shards", type=int,
+                        help="Number of array tasks per phase")
+    parser.add_argument("--qsub", default=os.environ.get("QSUB", "qsub"),
+                        help="qsub executable (default: $QSUB or qsub)")
+    parser.add_argument("--response-subset", action="store_true",
+                        help="Run the preproc array alongside the group "
+                        "job, for runs where run.py sets response_subjects")
+    parser.add_argument("--frozen-response", action="store_true",
+                        help="Only submit the fod array, for runs where "
+                        "run.py sets freeze_response")
+    parser.add_argument("--continuation", action="store_true",
+                        help="From inside a job: submit the job continuing "
+                        "this one")
+    parser.add_argument("--max-continuations", type=int, default=5,
+                        help="Give up after this many continuations of the "
+                        "first job (default 5)")
+    args = parser.parse_args()
+
+    if args.continuation:
+        count = int(os.environ.get("CONTINUATION", 0)) + 1
+        if count > args.max_continuations:
+            parser.exit(1, "Not submitting continuation %d, more than "
+                        "--max-continuations\n" % count)
+        env = {"PHASE": os.environ.get("PHASE", "all"),
+               "N_SHARDS": os.environ.get("N_SHARDS", 1),
+               "CONTINUATION": count}
+        shard_index = os.environ.get("SHARD_INDEX",
+                                     os.environ.get("PBS_ARRAY_INDEX"))
+        if shard_index is not None:
+            env["SHARD_INDEX"] = shard_index
+        job_id = submit_continuation(
+            args.script, env, os.environ["PBS_JOBID"], args.qsub,
+            os.environ.get("QSTAT", "qstat"),
+            os.environ.get("QALTER", "qalter"))
+        print("continuation %d: %s" % (count, job_id))
+        raise SystemExit(0)
+    if args.n_shards is None:
+        parser.error("--n-shards is required")
+
+    for phase, job_id in submit_sharded(args.script, args.n_shards,
+                                        args.qsub, args.response_subset,
+                                        args.frozen_response).items():
+        print("%s: %s" % (phase, job_id))
@@ -0,0 +1,374 @@
+import os
+import os.path as op
+import re
+import glob
+import json
+import heapq
+import sqlite3
+import numpy as np
+from nipype import JoinNode, IdentityInterface
+
+
+### PLANNING ###
+# Sizes PBS jobs for the work left: every subject's nodes that have no
+# finished node directory yet are expanded into jobs with runtimes, CPU and
+# memory from the profile database (src/profiling.py), falling back to the
+# observed means in runtime_file and the declared estimates. A job is
+# simulated like MultiProc runs it (ready jobs by critical path, while their
+# threads and memory fit) for each allocation size that fits in the longest
+# walltime. Each job gets the fastest size that keeps enough of the booked
+# cores busy. Of the single job and the sharded chains of src/pbs.py with
+# each number of shards, the one booking the fewest core hours among those
+# finishing close to the earliest is written out.
+#
+# Queue waits are not modelled; a larger number of smaller jobs usually
+# starts sooner, which the core hours alone do not show.
+
+
+class Estimates:
+    """Expected wall time, cores used and peak RSS of each node."""
+
+    def __init__(self, profile_db=None, runtime_file=None, runtimes=None,
+                 default_runtime=60):
+        self.history = {}
+        self.observed = {}
+        self.runtimes = runtimes or {}
+        self.default_runtime = default_runtime
+        if profile_db and op.exists(profile_db):
+            db = sqlite3.connect(str(profile_db))
+            rows = db.execute("SELECT node, wall_s, cpu_s, peak_rss_gb "
+                              "FROM jobs WHERE ok").fetchall()
+            db.close()
+            by_node = {}
+            for name, wall, cpu, rss in rows:
+                by_node.setdefault(name, []).append((wall, cpu, rss or 0))
+            for name, jobs in by_node.items():
+                wall, cpu, rss = np.array(jobs).T
+                self.history[name] = (np.percentile(wall, 90),
+                                      np.sum(cpu) / max(np.sum(wall), 1e-9),
+                                      rss.max())
+        if runtime_file and op.exists(runtime_file):
+            with open(runtime_file) as f:
+                self.observed = {k: v[0] for k, v in json.load(f).items()}
+
+    def source(self, name):
+        if name in self.history:
+            return "profile"
+        if name in self.observed:
+            return "observed"
+        return "estimate" if name in self.runtimes else "default"
+
+    def job(self, node):
+        """Wall seconds, cores, peak RSS GB, threads and memory declared."""
+        if isinstance(node.interface, IdentityInterface):
+            return dict(wall=0.0, cores=0.0, rss=0.0, n_procs=0, mem_gb=0.0)
+        if node.name in self.history:
+            wall, cores, rss = self.history[node.name]
+        else:
+            wall = self.observed.get(node.name, self.runtimes.get(
+                node.name, self.default_runtime))
+            cores, rss = node.n_procs, node.mem_gb
+        return dict(wall=wall, cores=cores, rss=rss, n_procs=node.n_procs,
+                    mem_gb=node.mem_gb)
+
+
+def finished(node_dir):
+    """Whether a node directory holds a finished run of the node."""
+    return any(not f.endswith("_unfinished.json")
+               for f in glob.glob(op.join(node_dir, "_0x*.json")))
+
+
+def expand(connections, source, subject_list, wf_dir, estimates, done=(),
+           is_finished=finished):
+    """Jobs of a graph over some subjects (the iterables of source), without
+    those finished in wf_dir (by is_finished) or listed in done. Keys are
+    (subject, name), subject "" for nodes after a JoinNode."""
+    nodes, edges = {}, set()
+    for src, dest, _ in connections:
+        nodes[src.name], nodes[dest.name] = src, dest
+        edges.add((src.name, dest.name))
+
+    # Nodes reached from the iterables without passing a JoinNode run once
+    # per subject
+    per_subject, todo = set(), [source.name]
+    while todo:
+        name = todo.pop()
+        per_subject.add(name)
+        todo.extend(d for s, d in edges if s == name and d not in per_subject
+                    and not isinstance(nodes[d], JoinNode))
+
+    def keys(name):
+        return ([(s, name) for s in subject_list] if name in per_subject
+                else [("", name)])
+
+    def node_dir(key):
+        subject, name = key
+        if subject:
+            return op.join(wf_dir, "_subject_id_%s" % subject, name)
+        return op.join(wf_dir, name)
+
+    jobs = {}
+    for name, node in nodes.items():
+        for key in keys(name):
+            if key in done or is_finished(node_dir(key)):
+                continue
+            jobs[key] = dict(estimates.job(node), deps=set())
+    for src, dest in edges:
+        for key in keys(dest):
+            if key not in jobs:
+                continue
+            for dep in keys(src):
+                if dep in jobs and (not key[0] or not dep[0]
+                                    or dep[0] == key[0]):
+                    jobs[key]["deps"].add(dep)
+    return jobs
+
+
+def simulate(jobs, ncpus, mem_gb):
+    """Wall seconds, peak summed RSS and CPU seconds of a MultiProc run of
+    jobs on ncpus and mem_gb, starting ready jobs by critical path."""
+    if not jobs:
+        return 0.0, 0.0, 0.0
+
+    def wall(job):
+        # Fewer threads than the job used stretch it
+        threads = max(min(job["n_procs"], ncpus), 1)
+        return max(job["wall"], job["wall"] * job["cores"] / threads)
+
+    dependents = {key: [] for key in jobs}
+    for key, job in jobs.items():
+        for dep in job["deps"]:
+            dependents[dep].append(key)
+    length = {}
+    for key in reversed(_topological(jobs, dependents)):
+        length[key] = wall(jobs[key]) + max(
+            [length[d] for d in dependents[key]], default=0)
+
+    waiting = {key: len(job["deps"]) for key, job in jobs.items()}
+    ready = [key for key, n in waiting.items() if n == 0]
+    running, now, free_cpus, free_gb = [], 0.0, ncpus, mem_gb
+    rss = peak = cpu = 0.0
+    while ready or running:
+        ready.sort(key=lambda k: -length[k])
+        for key in list(ready):
+            job = jobs[key]
+            threads = min(job["n_procs"], ncpus)
+            gb = min(job["mem_gb"], mem_gb)
+            if threads <= free_cpus and gb <= free_gb:
+                ready.remove(key)
+                free_cpus -= threads
+                free_gb -= gb
+                rss += job["rss"]
+                cpu += job["wall"] * job["cores"]
+                peak = max(peak, rss)
+                heapq.heappush(running, (now + wall(job), key))
+        now, key = heapq.heappop(running)
+        job = jobs[key]
+        free_cpus += min(job["n_procs"], ncpus)
+        free_gb += min(job["mem_gb"], mem_gb)
+        rss -= job["rss"]
+        for dependent in dependents[key]:
+            waiting[dependent] -= 1
+            if waiting[dependent] == 0:
+                ready.append(dependent)
+    return now, peak, cpu
+
+
+def _topological(jobs, dependents):
+    indegree = {key: len(job["deps"]) for key, job in jobs.items()}
+    order = [key for key, n in indegree.items() if n == 0]
+    for key in order:
+        for dependent in dependents[key]:
+            indegree[dependent] -= 1
+            if indegree[dependent] == 0:
+                order.append(dependent)
+    return order
+
+
+class Planner:
+    """Picks ncpus, memory and walltime for jobs running stages of the
+    pipeline one after the other.
+
+    A stage is (connections, subjects), source the node iterating over the
+    subjects. ncpus_options are the job sizes to try, each with gb_per_cpu
+    of memory; walltimes are the simulated wall time times safety plus
+    margin seconds, rounded up to 15 minutes, and at most max_walltime
+    seconds. A job gets the fastest size using at least min_efficiency of
+    the cores it books.
+    """
+
+    def __init__(self, wf_dir, source, estimates, ncpus_options, gb_per_cpu,
+                 max_walltime, margin=600, safety=1.25, min_efficiency=0.5):
+        self.wf_dir = wf_dir
+        self.source = source
+        self.estimates = estimates
+        self.ncpus_options = sorted(ncpus_options)
+        self.gb_per_cpu = gb_per_cpu
+        self.max_walltime = max_walltime
+        self.margin = margin
+        self.safety = safety
+        self.min_efficiency = min_efficiency
+        # (graph, subject): jobs, as every plan has the same subjects
+        self._expanded = {}
+        self._finished = {}
+
+    def finished(self, node_dir):
+        if node_dir not in self._finished:
+            self._finished[node_dir] = finished(node_dir)
+        return self._finished[node_dir]
+
+    def expand(self, connections, subject_list, done=()):
+        """expand() over the subjects, each expanded once per graph."""
+        graph = tuple((src.name, dest.name) for src, dest, _ in connections)
+        jobs = {}
+        for subject in subject_list:
+            if (graph, subject) not in self._expanded:
+                self._expanded[graph, subject] = expand(
+                    connections, self.source, [subject], self.wf_dir,
+                    self.estimates, is_finished=self.finished)
+            for key, job in self._expanded[graph, subject].items():
+                if key in done:
+                    continue
+                if key in jobs:
+                    # Nodes after a JoinNode wait for every subject
+                    jobs[key]["deps"] |= job["deps"]
+                else:
+                    jobs[key] = dict(job, deps=set(job["deps"]))
+        for job in jobs.values():
+            job["deps"] = {dep for dep in job["deps"] if dep in jobs}
+        return jobs
+
+    def stage_jobs(self, stages, done=()):
+        """Jobs of each stage, and done with them added."""
+        done = set(done)
+        all_jobs = []
+        for connections, subject_list in stages:
+            jobs = self.expand(connections, subject_list, done)
+            done.update(jobs)
+            all_jobs.append(jobs)
+        return all_jobs, done
+
+    def size(self, stages, done=()):
+        """Allocation for a job running stages, None if none fits."""
+        all_jobs, _ = self.stage_jobs(stages, done)
+        options = []
+        for ncpus in self.ncpus_options:
+            mem_gb = ncpus * self.gb_per_cpu
+            results = [simulate(jobs, ncpus, mem_gb) for jobs in all_jobs]
+            seconds = sum(r[0] for r in results)
+            peak = max(r[1] for r in results)
+            cpu = sum(r[2] for r in results)
+            walltime = 900 * np.ceil((seconds * self.safety + self.margin)
+                                     / 900)
+            if walltime > self.max_walltime or peak > mem_gb:
+                continue
+            options.append(dict(
+                ncpus=ncpus, mem_gb=mem_gb, walltime=walltime,
+                seconds=seconds, peak_gb=peak, cpu_s=cpu,
+                efficiency=cpu / max(ncpus * seconds, 1e-9),
+                jobs=sum(len(j) for j in all_jobs)))
+        if not options:
+            return None
+        efficient = [o for o in options
+                     if o["efficiency"] >= self.min_efficiency]
+        if not efficient:
+            efficient = [max(options, key=lambda o: o["efficiency"])]
+        return min(efficient, key=lambda o: (o["seconds"], o["ncpus"]))
+
+    def plans(self, single, chain, subject_list, concurrent=()):
+        """Candidate plans: a single job running the stages in single, and
+        the sharded chain with each number of shards.
+
+        chain is a list of (phase, connections, subjects or None for each
+        shard's subjects). Phases in concurrent run alongside the phase
+        before them, on the jobs it leaves. Array jobs are sized for the
+        shard with the most work left. Plans have n_shards (0 for the
+        single job), sizes per phase, completion (wall seconds, arrays
+        running at once) and core_hours."""
+        plans = []
+        size = self.size(single)
+        if size:
+            plans.append(dict(n_shards=0, sizes={"all": dict(size, count=1)},
+                              completion=size["seconds"],
+                              core_hours=size["ncpus"] * size["seconds"]
+                              / 3600))
+
+        shard_counts = sorted({-(-len(subject_list) // k)
+                               for k in range(1, len(subject_list) + 1)})
+        for n_shards in shard_counts:
+            shards = [subject_list[i::n_shards] for i in range(n_shards)]
+            sizes, done = {}, set()
+            for phase, connections, phase_subjects in chain:
+                if phase_subjects is not None:
+                    stages = [(connections, phase_subjects)]
+                    size = self.size(stages, done)
+                    done = self.stage_jobs(stages, done)[1]
+                    count = 1
+                else:
+                    # The shard with the most work left sets the resources
+                    work = [sum(j["wall"] * j["cores"] for j in
+                                self.stage_jobs([(connections, s)],
+                                                done)[0][0].values())
+                            for s in shards]
+                    size = self.size([(connections,
+                                       shards[int(np.argmax(work))])], done)
+                    done = self.stage_jobs([(connections, s)
+                                            for s in shards], done)[1]
+                    count = n_shards
+                if size is None:
+                    break
+                sizes[phase] = dict(size, count=count)
+            else:
+                completion, stage = 0, 0
+                for phase, _, _ in chain:
+                    if phase in concurrent:
+                        stage = max(stage, sizes[phase]["seconds"])
+                    else:
+                        completion += stage
+                        stage = sizes[phase]["seconds"]
+                plans.append(dict(
+                    n_shards=n_shards, sizes=sizes,
+                    completion=completion + stage,
+                    core_hours=sum(s["ncpus"] * s["seconds"] * s["count"]
+                                   for s in sizes.values()) / 3600))
+        return plans
+
+
+def choose(plans, slack=0.1):
+    """The plan with the fewest core hours among those finishing within
+    slack of the fastest."""
+    if not plans:
+        return None
+    fastest = min(p["completion"] for p in plans)
+    return min((p for p in plans if p["completion"] <= fastest * (1 + slack)),
+               key=lambda p: (p["core_hours"], p["n_shards"]))
+
+
+def format_walltime(seconds):
+    seconds = int(seconds)
+    return "%02d:%02d:%02d" % (seconds // 3600, seconds % 3600 // 60,
+                               seconds % 60)
+
+
+def write_script(template, path, phase, size):
+    """A copy of the job script template with the planned resources."""
+    with open(template) as f:
+        script = f.read()
+    mem = int(np.ceil(size["mem_gb"]))
+    script = re.sub(r"ncpus=\d+:mem=\d+GB", "ncpus=%d:mem=%dGB"
+                    % (size["ncpus"], mem), script)
+    script = re.sub(r"walltime=[\d:]+", "walltime=%s"
+                    % format_walltime(size["walltime"]), script)
+    script = re.sub(r"export MEM_GB=\d+", "export MEM_GB=%d" % mem, script)
+    script = re.sub(r"(#PBS -N \S+)", r"\1_%s" % phase, script)
+    with open(path, "w") as f:
+        f.write(script)
+    os.chmod(path, 0o755)
+
+
+def describe(phase, size):
+    return ("%-8s %3d x %3d cpus %5.0f GB %s   %6.1f h wall, %7.1f CPU h, "
+            "peak %5.1f GB, %d jobs left" % (
+                phase, size.get("count", 1), size["ncpus"], size["mem_gb"],
+                format_walltime(size["walltime"]), size["seconds"] / 3600,
+                size["cpu_s"] / 3600, size["peak_gb"], size["jobs"]))
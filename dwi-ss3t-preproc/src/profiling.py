@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+import os
+import os.path as op
+import sys
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+from traceback import format_exception
+import numpy as np
+from nipype.pipeline.plugins.multiproc import MultiProcPlugin
+
+
+### PROFILING ###
+# Records every job a run executes in an SQLite database: wall time, CPU
+# time, peak RSS and bytes read/written, with the subject, node and the
+# threads/memory the node declared. CPU time and I/O come from the MultiProc
+# worker's own accounting, which Linux adds each finished child process to,
+# so they cover the whole process tree of the job (dwifslpreproc -> eddy
+# etc.). Peak RSS is sampled over the worker's descendants every
+# profile_interval seconds, so processes shorter than that can be missed.
+# Only reads /proc, on other systems RSS and I/O are left empty.
+#
+#   python3 src/profiling.py report <deriv_dir>/profile.sqlite
+#   python3 src/profiling.py export <deriv_dir>/profile.sqlite > profile.jsonl
+
+
+schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY, host TEXT, job_id TEXT, phase TEXT,
+    n_procs INTEGER, memory_gb REAL, start REAL, end REAL, edges TEXT);
+CREATE TABLE IF NOT EXISTS jobs (
+    run_id TEXT, subject TEXT, node TEXT, fullname TEXT, n_procs INTEGER,
+    mem_gb REAL, start REAL, end REAL, wall_s REAL, cpu_s REAL,
+    peak_rss_gb REAL, read_bytes INTEGER, write_bytes INTEGER, ok INTEGER);
+CREATE INDEX IF NOT EXISTS jobs_node ON jobs (node, subject);
+"""
+
+
+def connect(db_path):
+    # Array tasks of a sharded run share the database
+    db = sqlite3.connect(str(db_path), timeout=60)
+    db.executescript(schema)
+    return db
+
+
+def subject_of(node):
+    for param in node.parameterization:
+        if param.startswith("_subject_id_"):
+            return param[len("_subject_id_"):]
+    return ""
+
+
+def descendants(pid):
+    """pids of a process's descendants, from the parent pids in /proc."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % entry) as f:
+                # The command name can contain spaces, fields follow the ")"
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    found, todo = set(), [pid]
+    while todo:
+        for child in children.get(todo.pop(), []):
+            found.add(child)
+            todo.append(child)
+    return found
+
+
+def rss_bytes(pid):
+    try:
+        with open("/proc/%d/statm" % pid) as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def io_bytes():
+    """Bytes this process and its finished children read and wrote."""
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return int(fields["read_bytes"]), int(fields["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def cpu_seconds():
+    times = os.times()
+    return (times.user + times.system + times.children_user
+            + times.children_system)
+
+
+class PeakRSS(threading.Thread):
+    """Samples the summed RSS of this process and its descendants."""
+
+    def __init__(self, interval):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        if not op.isdir("/proc/self"):
+            return
+        pid = os.getpid()
+        while True:
+            self.peak = max(self.peak, sum(rss_bytes(p) for p in
+                                           descendants(pid) | {pid}))
+            if self._stop_event.wait(self.interval):
+                break
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        return self.peak
+
+
+def profiled_run_node(node, updatehash, taskid, db_path, run_id, interval):
+    """MultiProc's run_node, recording the job in the profile database."""
+    result = dict(result=None, traceback=None, taskid=taskid)
+    sampler = PeakRSS(interval)
+    sampler.start()
+    start, cpu_start = time.time(), cpu_seconds()
+    read_start, write_start = io_bytes()
+    try:
+        result["result"] = node.run(updatehash=updatehash)
+    except:  # noqa: E722, as run_node
+        result["traceback"] = format_exception(*sys.exc_info())
+        try:
+            result["result"] = node.result
+        except FileNotFoundError:
+            # Failed before writing a result file, raising here would leave
+            # MultiProc waiting for the job
+            pass
+
+    end = time.time()
+    read_end, write_end = io_bytes()
+    peak = sampler.stop()
+    try:
+        db = connect(db_path)
+        with db:
+            db.execute(
+                "INSERT INTO jobs VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                (run_id, subject_of(node), node.name, node.fullname,
+                 node.n_procs, node.mem_gb, start, end, end - start,
+                 cpu_seconds() - cpu_start, peak / 1024 ** 3 or None,
+                 None if read_end is None else read_end - read_start,
+                 None if write_end is None else write_end - write_start,
+                 result["traceback"] is None))
+        db.close()
+    except sqlite3.Error:
+        # Losing a profile record should not fail the node
+        pass
+    return result
+
+
+class ProfilingMultiProcPlugin(MultiProcPlugin):
+    """MultiProc recording each job's resource use.
+
+    Extra plugin_args:
+
+    - profile_db: SQLite file to record runs and jobs in (None to disable)
+    - profile_interval: seconds between RSS samples (default 1)
+    - profile_phase: phase recorded for the run
+    """
+
+    def __init__(self, plugin_args=None):
+        super().__init__(plugin_args=plugin_args)
+        self.profile_db = self.plugin_args.get("profile_db")
+        self.profile_interval = self.plugin_args.get("profile_interval", 1)
+        self.profile_phase = self.plugin_args.get("profile_phase", "all")
+        self.run_id = "%s-%d-%d" % (socket.gethostname(), os.getpid(),
+                                    time.time())
+
+    def _prerun_check(self, graph):
+        super()._prerun_check(graph)
+        if not self.profile_db:
+            return
+        edges = sorted({(u.name, v.name) for u, v in graph.edges()})
+        db = connect(self.profile_db)
+        with db:
+            db.execute("INSERT INTO runs VALUES (?,?,?,?,?,?,?,?,?)",
+                       (self.run_id, socket.gethostname(),
+                        os.environ.get("PBS_JOBID", ""), self.profile_phase,
+                        self.processors, self.memory_gb, time.time(), None,
+                        json.dumps(edges)))
+        db.close()
+
+    def _submit_job(self, node, updatehash=False):
+        if not self.profile_db:
+            return super()._submit_job(node, updatehash=updatehash)
+        self._taskid += 1
+        if getattr(node.interface, "terminal_output", "") == "stream":
+            node.interface.terminal_output = "allatonce"
+        result_future = self.pool.submit(profiled_run_node, node, updatehash,
+                                         self._taskid, str(self.profile_db),
+                                         self.run_id, self.profile_interval)
+        result_future.add_done_callback(self._async_callback)
+        self._task_obj[self._taskid] = result_future
+        return self._taskid
+
+    def _postrun_check(self):
+        super()._postrun_check()
+        if self.profile_db:
+            db = connect(self.profile_db)
+            with db:
+                db.execute("UPDATE runs SET end = ? WHERE run_id = ?",
+                           (time.time(), self.run_id))
+            db.close()
+
+
+### REPORT ###
+
+
+def critical_path(edges, runtimes):
+    """Longest chain of median runtimes through the node graph."""
+    successors = {}
+    for u, v in edges:
+        successors.setdefault(u, set()).add(v)
+    memo = {}
+
+    def longest(name):
+        if name not in memo:
+            tails = [longest(s) for s in successors.get(name, ())]
+            best = max(tails, key=lambda t: t[0], default=(0, []))
+            memo[name] = (runtimes.get(name, 0) + best[0], [name] + best[1])
+        return memo[name]
+
+    names = set(runtimes) | set(successors)
+    return max((longest(n) for n in names), key=lambda t: t[0],
+               default=(0, []))
+
+
+def peak_concurrent_gb(jobs):
+    """Largest sum of peak RSS over jobs running at the same time."""
+    events = sorted([(s, r or 0) for s, _, r in jobs] +
+                    [(e, -(r or 0)) for _, e, r in jobs])
+    level = peak = 0
+    for _, change in events:
+        level += change
+        peak = max(peak, level)
+    return peak
+
+
+def report(db_path, last=None):
+    db = connect(db_path)
+    runs = db.execute("SELECT run_id, phase, job_id, n_procs, memory_gb, "
+                      "start, end, edges FROM runs ORDER BY start").fetchall()
+    if last:
+        runs = runs[-last:]
+    run_ids = [r[0] for r in runs]
+    marks = ",".join("?" * len(run_ids))
+    jobs = db.execute("SELECT run_id, node, n_procs, start, end, wall_s, "
+                      "cpu_s, peak_rss_gb, read_bytes, write_bytes FROM jobs "
+                      "WHERE ok AND run_id IN (%s)" % marks,
+                      run_ids).fetchall()
+    if not jobs:
+        print("No jobs recorded in %s" % db_path)
+        return
+
+    by_node = {}
+    for job in jobs:
+        by_node.setdefault(job[1], []).append(job)
+    print("%-28s %5s %21s %7s %7s %16s %9s %9s" % (
+        "node", "jobs", "wall min (p50/p90/max)", "threads", "cores",
+        "RSS GB (p50/max)", "read GB", "write GB"))
+    medians = {}
+    for node, node_jobs in sorted(by_node.items()):
+        wall = np.array([j[5] for j in node_jobs])
+        cpu = np.array([j[6] for j in node_jobs])
+        rss = np.array([j[7] or 0 for j in node_jobs])
+        read = np.array([j[8] or 0 for j in node_jobs]) / 1024 ** 3
+        write = np.array([j[9] or 0 for j in node_jobs]) / 1024 ** 3
+        medians[node] = np.median(wall)
+        print("%-28s %5d %7.1f %6.1f %6.1f %7d %7.1f %7.1f %8.1f %9.2f %9.2f"
+              % (node, len(node_jobs), np.median(wall) / 60,
+                 np.percentile(wall, 90) / 60, wall.max() / 60,
+                 node_jobs[0][2], np.sum(cpu) / max(np.sum(wall), 1e-9),
+                 np.median(rss), rss.max(), np.median(read),
+                 np.median(write)))
+    print("cores: CPU time over wall time, to compare with the threads "
+          "declared")
+
+    edges = set()
+    for run in runs:
+        edges.update(tuple(e) for e in json.loads(run[7] or "[]"))
+    length, path = critical_path(edges, medians)
+    print("\nCritical path (median runtimes, %.1f h):\n  %s"
+          % (length / 3600, " -> ".join(path)))
+
+    print("\n%-28s %-7s %6s %7s %7s %9s %10s %11s" % (
+        "run", "phase", "procs", "mem GB", "wall h", "CPU used",
+        "CPU booked", "peak mem GB"))
+    for run_id, phase, job_id, n_procs, memory_gb, start, end, _ in runs:
+        run_jobs = [j for j in jobs if j[0] == run_id]
+        if not run_jobs or not end:
+            continue
+        wall = end - start
+        used = sum(j[6] for j in run_jobs) / (n_procs * wall)
+        booked = sum(min(j[2], n_procs) * j[5] for j in run_jobs) / (
+            n_procs * wall)
+        peak = peak_concurrent_gb([(j[3], j[4], j[7]) for j in run_jobs])
+        print("%-28s %-7s %6d %7.0f %7.2f %8.0f%% %9.0f%% %11.1f" % (
+            job_id or run_id, phase, n_procs, memory_gb, wall / 3600,
+            100 * used, 100 * booked, peak))
+    print("CPU used/booked: CPU time and declared threads x wall time of the "
+          "jobs, over the\nallocation's cores x wall time. peak mem: largest "
+          "sum of job RSS peaks at one time.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Node resource profiles")
+    parser.add_argument("command", choices=["report", "export"])
+    parser.add_argument("db", help="Profile database (profile.sqlite)")
+    parser.add_argument("--last", type=int,
+                        help="Only the last N runs (report)")
+    args = parser.parse_args()
+
+    if args.command == "report":
+        report(args.db, args.last)
+    else:
+        db = connect(args.db)
+        db.row_factory = sqlite3.Row
+        for row in db.execute("SELECT jobs.*, runs.phase, runs.job_id FROM "
+                              "jobs JOIN runs USING (run_id)"):
+            print(json.dumps(dict(row)))
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+import os.path as op
+import glob
+import json
+import argparse
+import numpy as np
+from nipype import logging
+from nipype.pipeline.plugins.multiproc import MultiProcPlugin
+
+logger = logging.getLogger("nipype.workflow")
+
+
+### QC GATE ###
+# Per-subject checks after biascorrect, before the upsampling, masking and
+# FODs: eddy's motion and outlier summaries, the b=0 SNR and the gradient
+# table against the image and the table it was acquired with. Each metric
+# is checked against thresholds named "max_<metric>" or "min_<metric>";
+# metrics that could not be computed (e.g. without eddy's QC files) are not
+# checked. A gradient table that does not match the image or the acquired
+# one always fails.
+#
+# The QC node reports whether the subject passed. QCGateMultiProcPlugin
+# then marks the subject's jobs downstream of it as done without running
+# them, and the group responses leave the subject's responses out (the
+# JoinNodes also join the QC result). The reports stay in the QC nodes'
+# directories:
+#
+#   python3 src/qc.py <deriv_dir>/dwi_ss3t_preproc_wf
+
+
+report_name = "dwi_qc.json"
+
+
+def eddy_metrics(eddyqc_dir, bvals=None, bzero_threshold=10.0):
+    """Motion (mm) and outlier summaries from eddy's text outputs, as
+    dwifslpreproc -eddyqc_text exports them."""
+    metrics = {}
+    rms_file = op.join(eddyqc_dir, "eddy_movement_rms")
+    if op.exists(rms_file):
+        # Per volume: RMS displacement from the first volume, and from the
+        # previous one
+        rms = np.loadtxt(rms_file, ndmin=2)
+        metrics["mean_abs_motion_mm"] = float(rms[:, 0].mean())
+        metrics["mean_rel_motion_mm"] = float(rms[1:, 1].mean()
+                                              if len(rms) > 1 else 0.0)
+        metrics["max_rel_motion_mm"] = float(rms[:, 1].max())
+    outlier_file = op.join(eddyqc_dir, "eddy_outlier_map")
+    if op.exists(outlier_file):
+        # A header line, then a row per volume with 1 for outlier slices
+        outliers = np.loadtxt(outlier_file, skiprows=1, ndmin=2)
+        if bvals is not None and len(bvals) == len(outliers):
+            # Only diffusion weighted volumes are checked for outliers
+            outliers = outliers[bvals > bzero_threshold]
+        metrics["outlier_pct"] = float(100 * outliers.mean())
+    return metrics
+
+
+def b0_snr(b0):
+    """Median SNR of b=0 volumes (x, y, z, volumes) over a rough foreground
+    mask: the mean over the standard deviation across the volumes with two
+    or more, or over the spread of the background with one."""
+    b0 = np.asarray(b0, dtype=np.float32)
+    mean = b0.mean(axis=-1)
+    if not np.any(mean > 0):
+        return 0.0
+    mask = mean > 0.2 * np.percentile(mean[mean > 0], 99)
+    if b0.shape[-1] > 1:
+        std = b0[mask].std(axis=-1, ddof=1)
+        snr = mean[mask] / np.maximum(std, 1e-6 * mean[mask].max())
+        return float(np.median(snr))
+    background = mean[~mask & (mean > 0)]
+    if len(background) < 2:
+        return None
+    return float(np.median(mean[mask]) / max(background.std(), 1e-6))
+
+
+def gradient_metrics(n_volumes, bvals, bvecs, orig_bvals, orig_bvecs,
+                     bzero_threshold=10.0):
+    """Consistency of a gradient table with its image and with the table
+    it was acquired with. Returns the metrics and the inconsistencies
+    found, as messages."""
+    errors = []
+    if len(bvals) != n_volumes:
+        errors.append("%d b-values for %d volumes" % (len(bvals), n_volumes))
+    if bvecs.shape != (3, len(bvals)):
+        errors.append("bvecs of shape %s for %d b-values"
+                      % ("x".join(map(str, bvecs.shape)), len(bvals)))
+    if len(orig_bvals) != len(bvals) or orig_bvecs.shape != bvecs.shape:
+        errors.append("%d volumes in the gradient table, %d in the input's"
+                      % (len(bvals), len(orig_bvals)))
+    metrics = {"gradient_errors": 0}
+    if errors:
+        metrics["gradient_errors"] = len(errors)
+        return metrics, errors
+
+    weighted = bvals > bzero_threshold
+    if not np.any(~weighted):
+        errors.append("no b=0 volumes")
+    if not np.any(weighted):
+        errors.append("no diffusion weighted volumes")
+    changed = np.abs(bvals - orig_bvals) > np.maximum(bzero_threshold,
+                                                      0.05 * orig_bvals)
+    if np.any(changed):
+        errors.append("%d b-values differ from the input's"
+                      % np.count_nonzero(changed))
+    norms = np.linalg.norm(bvecs[:, weighted], axis=0)
+    if np.any(np.abs(norms - 1) > 0.1):
+        errors.append("%d diffusion directions are not unit vectors"
+                      % np.count_nonzero(np.abs(norms - 1) > 0.1))
+    metrics["gradient_errors"] = len(errors)
+
+    if np.any(weighted):
+        # Angle between each direction and the acquired one (eddy rotates
+        # them with the head), either sign
+        orig = orig_bvecs[:, weighted]
+        cos = (np.abs((bvecs[:, weighted] * orig).sum(axis=0))
+               / np.maximum(norms * np.linalg.norm(orig, axis=0), 1e-6))
+        metrics["bvec_rotation_deg"] = float(
+            np.degrees(np.arccos(np.clip(cos, 0, 1))).max())
+    return metrics, errors
+
+
+def check(metrics, thresholds):
+    """Metrics outside thresholds {"max_<metric>": limit, "min_<metric>":
+    limit}, as messages."""
+    failures = []
+    for key, limit in sorted(thresholds.items()):
+        bound, _, name = key.partition("_")
+        if bound not in ["min", "max"]:
+            raise ValueError("QC thresholds are named max_<metric> or "
+                             "min_<metric>, got %s" % key)
+        value = metrics.get(name)
+        if value is None or np.isnan(value):
+            continue
+        if value > limit if bound == "max" else value < limit:
+            failures.append("%s %.3g %s %g" % (
+                name, value, "above" if bound == "max" else "below", limit))
+    return failures
+
+
+class QCGateMultiProcPlugin(MultiProcPlugin):
+    """MultiProc dropping a subject's remaining jobs when it fails QC.
+
+    Extra plugin_args:
+
+    - qc_node: name of the node whose ``passed`` output gates the subject's
+      jobs downstream of it (None to disable)
+    """
+
+    def __init__(self, plugin_args=None):
+        super().__init__(plugin_args=plugin_args)
+        self.qc_node = self.plugin_args.get("qc_node")
+        # subject: failures
+        self.qc_failed = {}
+
+    def _prerun_check(self, graph):
+        super()._prerun_check(graph)
+        self._graph = graph
+
+    def _task_finished_cb(self, jobid, cached=False):
+        super()._task_finished_cb(jobid, cached=cached)
+        node = self.procs[jobid]
+        if not self.qc_node or node.name != self.qc_node:
+            return
+        outputs = node.result.outputs
+        if outputs is not None and not outputs.passed:
+            self._drop(jobid, outputs.failures)
+
+    def _drop(self, jobid, failures):
+        """Mark the jobs of jobid's subject downstream of it as done without
+        running them. Group level jobs, and what follows them, are kept."""
+        node = self.procs[jobid]
+        subject = node.parameterization
+        index = {n: i for i, n in enumerate(self.procs)}
+        dropped = set()
+        todo = list(self._graph.successors(node))
+        while todo:
+            job = todo.pop()
+            if index[job] in dropped or job.parameterization != subject:
+                continue
+            dropped.add(index[job])
+            todo.extend(self._graph.successors(job))
+        for i in dropped:
+            self.proc_done[i] = True
+            self.proc_pending[i] = False
+            # Release the successors outside the subject, as a finished job
+            # does, so they are not left waiting
+            rowview = self.depidx.getrowview(i)
+            rowview[rowview.nonzero()] = 0
+            # Releases the inputs of the dropped jobs for retention
+            self.refidx[self.refidx[:, i].nonzero()[0], i] = 0
+        name = next((p[len("_subject_id_"):] for p in subject
+                     if p.startswith("_subject_id_")), node.fullname)
+        self.qc_failed[name] = failures
+        logger.warning("[QC] %s failed QC (%s), dropping its %d remaining "
+                       "jobs", name, "; ".join(failures), len(dropped))
+
+    def _postrun_check(self):
+        super()._postrun_check()
+        if self.qc_failed:
+            logger.warning("[QC] %d subjects failed QC and were left out: %s",
+                           len(self.qc_failed),
+                           ", ".join(sorted(self.qc_failed)))
+
+
+### REPORT ###
+
+
+def read_reports(wf_dir):
+    """{subject: report} of the QC nodes in a working tree."""
+    reports = {}
+    pattern = op.join(wf_dir, "_subject_id_*", "*", report_name)
+    for path in sorted(glob.glob(pattern)):
+        subject = op.basename(op.dirname(op.dirname(path)))
+        with open(path) as f:
+            reports[subject[len("_subject_id_"):]] = json.load(f)
+    return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="QC gate reports")
+    parser.add_argument("wf_dir", help="Working tree of the workflow")
+    args = parser.parse_args()
+
+    reports = read_reports(args.wf_dir)
+    if not reports:
+        print("No QC reports in %s" % args.wf_dir)
+        raise SystemExit(1)
+    names = sorted({m for r in reports.values() for m in r["metrics"]})
+    print("%-16s %6s " % ("subject", "QC") +
+          " ".join("%18s" % n for n in names))
+    for subject, report in sorted(reports.items()):
+        values = [report["metrics"].get(n) for n in names]
+        print("%-16s %6s " % (subject,
+                              "pass" if report["passed"] else "FAIL") +
+              " ".join("%18s" % ("-" if v is None else "%.3g" % v)
+                       for v in values))
+    failed = {s: r for s, r in reports.items() if not r["passed"]}
+    print("\n%d of %d subjects failed" % (len(failed), len(reports)))
+    for subject, report in sorted(failed.items()):
+        print("  %s: %s" % (subject, "; ".join(report["failures"])))
@@ -0,0 +1,165 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from .image_io import MifImage, load_image, create_mif
+
+
+### CHUNKED REGRID ###
+# mrgrid regrid for 4D images whose output grid has the same axes as the
+# input (-vox, or a -template made from the image such as the cropped grid),
+# so resampling is separable: a small weight matrix per axis, applied with
+# NumPy to groups of volumes. The groups are spread over worker processes
+# that each read their volumes from the input and write them into the
+# output, allocated up front as a memory mapped .mif. Memory is bounded by
+# the group size, chosen from a budget, instead of growing with the number
+# of volumes. Each output volume is contiguous on disk, so later steps
+# reading the b=0 volumes only read those.
+#
+# Interpolation follows MRtrix: cubic is the Catmull-Rom (Hermite, tension
+# 0) spline, sample positions outside the input are 0 and neighbours past
+# the edge are clamped. Output voxels larger than the input's are averaged
+# over ceil(ratio) samples per axis, as mrgrid oversamples when
+# downsampling.
+
+
+def regrid_vox_grid(shape, affine, vox):
+    """Grid mrgrid regrid -vox gives: same field of view, the voxel count
+    rounded."""
+    in_vox = np.linalg.norm(affine[:3, :3], axis=0)
+    out_shape = tuple(int(round(n * v / vox - 0.0001))
+                      for n, v in zip(shape[:3], in_vox))
+    directions = affine[:3, :3] / in_vox
+    out_affine = np.array(affine, dtype=float)
+    out_affine[:3, :3] = directions * vox
+    # The first voxel's corner stays put
+    out_affine[:3, 3] += directions @ ((vox - in_vox) / 2)
+    return out_shape, out_affine
+
+
+def _kernel(t, interp):
+    """Offsets from floor(x) and weights of the input samples at x, t the
+    fractional part."""
+    if interp == "cubic":
+        t2, t3 = t * t, t * t * t
+        return [-1, 0, 1, 2], [0.5 * (-t3 + 2 * t2 - t),
+                               0.5 * (3 * t3 - 5 * t2 + 2),
+                               0.5 * (-3 * t3 + 4 * t2 + t),
+                               0.5 * (t3 - t2)]
+    if interp == "linear":
+        return [0, 1], [1 - t, t]
+    if interp == "nearest":
+        return [0, 1], [t < 0.5, t >= 0.5]
+    raise ValueError("Unsupported interpolation: %s" % interp)
+
+
+def axis_weights(n_in, n_out, scale, offset, interp="cubic"):
+    """Weights (n_out x n_in) taking one axis from the input grid to the
+    output grid, input voxel x = scale * output voxel + offset."""
+    factor = max(int(np.ceil(abs(scale) - 1e-6)), 1)
+    weights = np.zeros((n_out, n_in))
+    for k in range(factor):
+        # Sample positions within each output voxel
+        x = scale * (np.arange(n_out) + (k + 0.5) / factor - 0.5) + offset
+        inside = (x >= -0.5) & (x <= n_in - 0.5)
+        base = np.floor(x).astype(int)
+        offsets, kernel = _kernel(x - base, interp)
+        for step, w in zip(offsets, kernel):
+            index = np.clip(base + step, 0, n_in - 1)
+            np.add.at(weights, (np.flatnonzero(inside), index[inside]),
+                      (np.asarray(w, dtype=float) / factor)[inside])
+    return weights.astype(np.float32)
+
+
+def grid_weights(in_shape, in_affine, out_shape, out_affine, interp="cubic"):
+    """Per axis weights between two grids with the same axes."""
+    to_input = np.linalg.inv(in_affine) @ out_affine
+    linear = to_input[:3, :3]
+    if not np.allclose(linear, np.diag(np.diag(linear)),
+                       atol=1e-6 * np.abs(linear).max()):
+        raise ValueError("Output grid is rotated against the input, the "
+                         "chunked regrid only handles grids with the same "
+                         "axes")
+    return [axis_weights(in_shape[a], out_shape[a], linear[a, a],
+                         to_input[a, 3], interp) for a in range(3)]
+
+
+def resample(volumes, weights):
+    """Apply the per axis weights to an (x, y, z, volumes) array."""
+    out = volumes
+    for axis, w in enumerate(weights):
+        out = np.moveaxis(np.tensordot(w, out, axes=(1, axis)), 0, axis)
+    return out
+
+
+def group_size(in_shape, out_shape, n_volumes, n_workers, memory_gb):
+    """Volumes per group so the workers' groups fit memory_gb."""
+    n_in, n_out = np.prod(in_shape[:3]), np.prod(out_shape[:3])
+    # Input, the largest intermediate and output per volume, in float32,
+    # plus tensordot's copy of its input
+    per_volume = 4 * (2 * n_in + 3 * n_out)
+    size = int(memory_gb * 1024 ** 3 / (n_workers * per_volume))
+    return int(np.clip(size, 1, -(-n_volumes // n_workers)))
+
+
+def _output_map(out_file):
+    out = MifImage(out_file)
+    offset = int(out.header["file"][0].split()[1])
+    return np.memmap(out_file, dtype=out.dtype, mode="r+", offset=offset,
+                     shape=out.shape, order="F")
+
+
+def _regrid_group(in_file, out_file, weights, start, stop):
+    """Regrid volumes start to stop of in_file into out_file."""
+    data, _, scaling = load_image(in_file)
+    out_map = _output_map(out_file)
+    if len(data.shape) == 3:
+        volumes = np.asarray(data, dtype=np.float32)[..., None]
+        out = out_map[..., None]
+    else:
+        volumes = np.asarray(data[..., start:stop], dtype=np.float32)
+        out = out_map
+    out[..., start:stop] = resample(scaling[0] + scaling[1] * volumes,
+                                    weights)
+    out_map.flush()
+    return stop - start
+
+
+def regrid(in_file, out_file, vox=None, template=None, interp="cubic",
+           n_workers=1, memory_gb=2.0):
+    """Regrid a 3D/4D image onto voxel size vox or the grid of template,
+    written to out_file (.mif) as float32. Header entries other than the
+    geometry (the gradient table, ...) are kept, as mrgrid does."""
+    data, affine, _ = load_image(in_file)
+    shape = data.shape
+    if template is not None:
+        template_data, out_affine, _ = load_image(template)
+        out_shape = template_data.shape[:3]
+    else:
+        out_shape, out_affine = regrid_vox_grid(shape, affine, vox)
+    weights = grid_weights(shape, affine, out_shape, out_affine, interp)
+
+    keyvals = {}
+    if in_file.endswith((".mif", ".mif.gz", ".mih")):
+        geometry = {"dim", "vox", "layout", "datatype", "transform", "file",
+                    "scaling"}
+        keyvals = {k: v for k, v in MifImage(in_file).header.items()
+                   if k not in geometry}
+    n_volumes = shape[3] if len(shape) > 3 else 1
+    # Allocated here, filled in by the groups
+    create_mif(out_file, out_shape + tuple(shape[3:]), out_affine,
+               np.float32, keyvals)
+
+    size = group_size(shape, out_shape, n_volumes, n_workers, memory_gb)
+    groups = [(start, min(start + size, n_volumes))
+              for start in range(0, n_volumes, size)]
+    if n_workers == 1 or len(groups) == 1:
+        done = [_regrid_group(in_file, out_file, weights, start, stop)
+                for start, stop in groups]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            # Workers write straight into the output, only counts come back
+            done = list(pool.map(_regrid_group, *zip(*[
+                (in_file, out_file, weights, start, stop)
+                for start, stop in groups])))
+    if sum(done) != n_volumes:
+        raise RuntimeError("Regrid of %s wrote %d of %d volumes"
+                           % (in_file, sum(done), n_volumes))
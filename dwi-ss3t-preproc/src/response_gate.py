@@ -0,0 +1,102 @@
+import subprocess
+from nipype import logging
+from nipype.pipeline.plugins.multiproc import MultiProcPlugin
+
+from .walltime import WalltimeExceeded, resubmit_exit_code
+
+logger = logging.getLogger("nipype.workflow")
+
+
+### RESPONSE GATE ###
+# For the "all" phase with response_subjects: every subject's preprocessing
+# runs from the start, and only the nodes using the group responses (ss3t,
+# and so mtnormalise after it) wait for them. Once the jobs of the response
+# subjects feeding the group responses have finished, the group responses
+# are built in the background (run.py --phase group, in a process of its
+# own as a process can only build one workflow from the shared nodes, and
+# finding the subset's jobs cached). When it is done, the held nodes get
+# the responses as inputs and are released.
+
+
+class ResponseGateMultiProcPlugin(MultiProcPlugin):
+    """MultiProc holding the nodes using the group responses until they
+    are built.
+
+    Extra plugin_args:
+
+    - response_nodes: names of the nodes held (empty to disable)
+    - response_sources: names of the nodes feeding the group responses
+    - response_subjects: subjects the group responses are built from
+    - response_inputs: {input: path} set on the held nodes when released
+    - build_responses: callable starting the build of the group responses
+      once response_sources of response_subjects have finished, returning
+      its subprocess.Popen
+    """
+
+    def __init__(self, plugin_args=None):
+        super().__init__(plugin_args=plugin_args)
+        self.response_nodes = set(self.plugin_args.get("response_nodes", []))
+        self.response_sources = set(self.plugin_args.get("response_sources",
+                                                         []))
+        self.response_subjects = set(self.plugin_args.get(
+            "response_subjects", []))
+        self.response_inputs = self.plugin_args.get("response_inputs", {})
+        self.build_responses = self.plugin_args.get("build_responses")
+        self._sources = None
+        self._build = None
+        self._released = not self.response_nodes
+
+    def _send_procs_to_workers(self, updatehash=False, graph=None):
+        if not self._released:
+            self._check_responses()
+        return super()._send_procs_to_workers(updatehash=updatehash,
+                                              graph=graph)
+
+    def _check_responses(self):
+        """Start building the responses once their sources have finished,
+        and release the held nodes once they are built."""
+        if self._sources is None:
+            subjects = {"_subject_id_%s" % s for s in self.response_subjects}
+            self._sources = [
+                i for i, node in enumerate(self.procs)
+                if node.name in self.response_sources
+                and subjects & set(node.parameterization)]
+        if self._build is None:
+            if any(not self.proc_done[i] or self.proc_pending[i]
+                   for i in self._sources):
+                return
+            logger.info("[Responses] Building the group responses from %d "
+                        "subjects", len(self.response_subjects))
+            self._build = self.build_responses()
+        returncode = self._build.poll()
+        if returncode is None:
+            return
+        if returncode == resubmit_exit_code:
+            self._postrun_check()
+            raise WalltimeExceeded("the group responses were stopped before "
+                                   "the end of the walltime")
+        if returncode:
+            self._postrun_check()
+            raise subprocess.CalledProcessError(returncode, self._build.args)
+        held = [node for node in self.procs
+                if node.name in self.response_nodes]
+        for node in held:
+            for name, path in self.response_inputs.items():
+                setattr(node.inputs, name, path)
+        self._released = True
+        logger.info("[Responses] Group responses built, releasing %d jobs",
+                    len(held))
+
+    def _sort_jobs(self, jobids, scheduler="tsort"):
+        # Before ranking, so no room is kept free for the held jobs
+        if not self._released:
+            jobids = [j for j in jobids
+                      if self.procs[j].name not in self.response_nodes]
+        return super()._sort_jobs(jobids, scheduler=scheduler)
+
+    def _postrun_check(self):
+        super()._postrun_check()
+        if self._build is not None and self._build.poll() is None:
+            # Stopped early, e.g. at the end of the walltime
+            self._build.terminate()
+            self._build.wait()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+import os
+import os.path as op
+import json
+import fcntl
+import shutil
+import argparse
+from contextlib import contextmanager
+import numpy as np
+
+
+### RESPONSE STORE ###
+# Per-subject response functions and the running group mean of each tissue,
+# kept between runs so new subjects are merged in without re-reading every
+# subject's response. "Publishing" copies the current means to published/,
+# where freeze_response in run.py reads them, so later subjects do not
+# change the response used for the FODs.
+#
+# The mean follows responsemean's default: each response is scaled by the
+# least squares factor matching its l=0 terms to the mean l=0 terms, then
+# the scaled responses are averaged. With L the sum of the l=0 terms and
+# A[k] the sum over subjects of R * l[k] / |l|^2, the mean is
+# sum_k L[k] * A[k] / n^2, so (n, L, A) can be updated one subject at a time.
+#
+#   python3 src/response_store.py show <store_dir>
+#   python3 src/response_store.py publish <store_dir>
+
+
+tissues = ["wm", "gm", "csf"]
+
+
+def read_response(path):
+    """Header comment lines and coefficients (one row per shell) of an
+    MRtrix response function file."""
+    header, rows = [], []
+    with open(path) as f:
+        for line in f:
+            if line.startswith("#"):
+                header.append(line.rstrip("\n"))
+            elif line.strip():
+                rows.append(line.split())
+    return header, np.array(rows, dtype=float)
+
+
+def write_response(path, header, response):
+    with open(path, "w") as f:
+        for line in header:
+            f.write(line + "\n")
+        for row in np.atleast_2d(response):
+            f.write(" ".join("%.10g" % c for c in row) + "\n")
+
+
+def response_terms(response):
+    """This response's additive contribution to the group mean."""
+    l0 = response[:, 0]
+    weights = l0 / np.dot(l0, l0)
+    return l0, weights[:, None, None] * response[None]
+
+
+def response_mean(responses):
+    """responsemean's default mean of a list of responses."""
+    l0_sum = sum(response_terms(r)[0] for r in responses)
+    weighted = sum(response_terms(r)[1] for r in responses)
+    n = len(responses)
+    return np.tensordot(l0_sum, weighted, axes=1) / n ** 2
+
+
+class ResponseStore:
+    """Persistent per-subject responses and group mean aggregates."""
+
+    def __init__(self, store_dir):
+        self.store_dir = str(store_dir)
+        self.store_file = op.join(self.store_dir, "store.json")
+        self.published_dir = op.join(self.store_dir, "published")
+        os.makedirs(self.store_dir, exist_ok=True)
+
+    @contextmanager
+    def open(self):
+        """Load the store under an exclusive lock, saving it on exit."""
+        with open(op.join(self.store_dir, ".lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._load()
+                yield self
+                tmp = self.store_file + ".tmp"
+                with open(tmp, "w") as f:
+                    json.dump(self._data, f)
+                os.replace(tmp, self.store_file)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _load(self):
+        self._data = {"subjects": {}, "header": {}, "aggregate": {}}
+        if op.exists(self.store_file):
+            with open(self.store_file) as f:
+                self._data = json.load(f)
+
+    def add(self, subject, tissue, header, response):
+        """Merge a subject's response, replacing any stored before.
+        Returns False if the stored response was already the same."""
+        stored = self._data["subjects"].setdefault(subject, {})
+        if tissue in stored and np.array_equal(stored[tissue], response):
+            return False
+
+        aggregate = self._data["aggregate"].get(tissue)
+        if aggregate and np.shape(aggregate["weighted"])[1:] != response.shape:
+            raise ValueError("Response of %s (%s) has %d shells and %d "
+                             "coefficients, the store has %d and %d"
+                             % ((subject, tissue) + response.shape +
+                                np.shape(aggregate["weighted"])[2:]))
+        n = aggregate["n"] if aggregate else 0
+        l0_sum = np.array(aggregate["l0_sum"]) if aggregate else 0
+        weighted = np.array(aggregate["weighted"]) if aggregate else 0
+        if tissue in stored:
+            old_l0, old_weighted = response_terms(np.array(stored[tissue]))
+            n, l0_sum, weighted = n - 1, l0_sum - old_l0, weighted - old_weighted
+        new_l0, new_weighted = response_terms(response)
+        self._data["aggregate"][tissue] = {
+            "n": n + 1,
+            "l0_sum": (l0_sum + new_l0).tolist(),
+            "weighted": (weighted + new_weighted).tolist()}
+        self._data["header"].setdefault(tissue, header)
+        stored[tissue] = response.tolist()
+        return True
+
+    def remove(self, subject, tissue):
+        """Take a subject's response out of the group mean. Returns False if
+        it was not stored."""
+        stored = self._data["subjects"].get(subject, {})
+        if tissue not in stored:
+            return False
+        aggregate = self._data["aggregate"][tissue]
+        old_l0, old_weighted = response_terms(np.array(stored.pop(tissue)))
+        if aggregate["n"] == 1:
+            del self._data["aggregate"][tissue]
+        else:
+            self._data["aggregate"][tissue] = {
+                "n": aggregate["n"] - 1,
+                "l0_sum": (np.array(aggregate["l0_sum"]) - old_l0).tolist(),
+                "weighted": (np.array(aggregate["weighted"])
+                             - old_weighted).tolist()}
+        if not stored:
+            del self._data["subjects"][subject]
+        return True
+
+    def subjects(self, tissue):
+        return sorted(s for s, r in self._data["subjects"].items()
+                      if tissue in r)
+
+    def mean(self, tissue):
+        aggregate = self._data["aggregate"][tissue]
+        return (np.tensordot(aggregate["l0_sum"], aggregate["weighted"],
+                             axes=1) / aggregate["n"] ** 2)
+
+    def write_mean(self, tissue, path):
+        write_response(path, self._data["header"].get(tissue, []),
+                       self.mean(tissue))
+
+    def publish(self):
+        """Copy the current group means to published/."""
+        missing = [t for t in tissues if t not in self._data["aggregate"]]
+        if missing:
+            raise ValueError("No %s responses in %s to publish"
+                             % (", ".join(missing), self.store_dir))
+        os.makedirs(self.published_dir, exist_ok=True)
+        for tissue in tissues:
+            self.write_mean(tissue, self.published_path(tissue))
+        with open(op.join(self.published_dir, "subjects.txt"), "w") as f:
+            f.write("\n".join(self.subjects("wm")) + "\n")
+
+    def published_path(self, tissue):
+        return op.join(self.published_dir, "group_response_%s.txt" % tissue)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Group response store")
+    parser.add_argument("command", choices=["show", "publish"])
+    parser.add_argument("store_dir")
+    args = parser.parse_args()
+
+    with ResponseStore(args.store_dir).open() as store:
+        if args.command == "publish":
+            if op.isdir(store.published_dir):
+                # Keep the previous frozen responses next to the new ones
+                shutil.rmtree(store.published_dir + ".previous",
+                              ignore_errors=True)
+                shutil.move(store.published_dir,
+                            store.published_dir + ".previous")
+            store.publish()
+            print("Published the group responses of %d subjects to %s"
+                  % (len(store.subjects("wm")), store.published_dir))
+        for tissue in tissues:
+            if tissue in store._data["aggregate"]:
+                print("%s (%d subjects):" % (tissue,
+                                             len(store.subjects(tissue))))
+                print(np.array2string(store.mean(tissue), precision=4))
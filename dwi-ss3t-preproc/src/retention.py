@@ -0,0 +1,225 @@
+import os
+import os.path as op
+import json
+import time
+import numpy as np
+from nipype import logging
+from nipype.pipeline.plugins.multiproc import MultiProcPlugin
+
+logger = logging.getLogger("nipype.workflow")
+
+
+### RETENTION ###
+# Frees the disk used by intermediates once every node consuming them has
+# finished. Large files in the node directory are hollowed: truncated to a
+# sparse file of the same size with the same mtime, so they take no blocks
+# but a rerun still finds the node and its consumers cached ("timestamp"
+# hashing, and "fingerprint" hashing through the stored fingerprints). The
+# files hollowed are listed in the node's _retention.json so a node that
+# would actually read one fails with a clear error instead of reading zeros.
+#
+# A disk budget holds back subjects that have not started while the working
+# tree is over budget, letting started subjects finish and free their
+# intermediates first.
+
+
+tombstone_file = "_retention.json"
+
+
+def hollow(path):
+    """Release a file's blocks, keeping its size and mtime."""
+    stat = os.stat(path)
+    with open(path, "r+b") as f:
+        f.truncate(0)
+        f.truncate(stat.st_size)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+
+def tombstones(node_dir):
+    """Files of a node directory hollowed by retention."""
+    try:
+        with open(op.join(node_dir, tombstone_file)) as f:
+            return json.load(f)["files"]
+    except (OSError, ValueError, KeyError):
+        return []
+
+
+def apply_tombstones(node_dir):
+    """Hollow the files listed in a node directory's tombstone file, for
+    copies of a working tree made after retention ran."""
+    for name in tombstones(node_dir):
+        path = op.join(node_dir, name)
+        if op.isfile(path) and os.stat(path).st_blocks:
+            hollow(path)
+
+
+def hollow_node_dir(node_dir, min_bytes, fingerprint_store=None):
+    """Hollow the large outputs and scratch files of a finished node.
+
+    nipype's own files (_*, result_*.pklz) are kept, as are symlinks and
+    files with other hard links (datasink or cache copies), which would not
+    free anything. Returns the number of bytes released.
+    """
+    hollowed = tombstones(node_dir)
+    released = 0
+    for root, _, files in os.walk(node_dir):
+        for f in files:
+            path = op.join(root, f)
+            name = op.relpath(path, node_dir)
+            if f.startswith("_") or f.startswith("result_") or name in hollowed:
+                continue
+            stat = os.lstat(path)
+            if (op.islink(path) or stat.st_nlink > 1
+                    or stat.st_size < min_bytes):
+                continue
+            if fingerprint_store:
+                # Store the fingerprint while the content is still there
+                fingerprint_store.get(path)
+            hollow(path)
+            hollowed.append(name)
+            released += stat.st_blocks * 512
+
+    if released:
+        with open(op.join(node_dir, tombstone_file), "w") as f:
+            json.dump({"files": hollowed, "time": time.time()}, f, indent=2)
+    return released
+
+
+def hollow_inputs(node):
+    """Input files of a node that retention hollowed."""
+    try:
+        node._get_inputs()
+    except Exception:
+        return []
+    hollow_files = []
+    for value in node.inputs.get().values():
+        for path in value if isinstance(value, (list, tuple)) else [value]:
+            if (isinstance(path, str) and op.isfile(path)
+                    and op.basename(path) in tombstones(op.dirname(path))):
+                hollow_files.append(path)
+    return hollow_files
+
+
+def hollow_input_error(fullname, hollow_files, taskid):
+    """Stand-in task result for a node that would read hollowed inputs."""
+    message = ("%s needs outputs that were removed by the retention policy:\n"
+               "  %s\nRemove the working directories of the nodes that made "
+               "them and run again.\n" % (fullname, "\n  ".join(hollow_files)))
+    return dict(result=None, traceback=[message], taskid=taskid)
+
+
+def tree_usage_gb(path):
+    """Disk usage of a directory tree, counting hard links once."""
+    seen = set()
+    used = 0
+    for root, dirs, files in os.walk(path):
+        for f in files + dirs:
+            stat = os.lstat(op.join(root, f))
+            if (stat.st_dev, stat.st_ino) not in seen:
+                seen.add((stat.st_dev, stat.st_ino))
+                used += stat.st_blocks * 512
+    return used / 1024 ** 3
+
+
+class RetentionMultiProcPlugin(MultiProcPlugin):
+    """MultiProc with intermediate retention and a disk budget.
+
+    Extra plugin_args:
+
+    - retain_nodes: names of the nodes whose outputs are hollowed once all
+      their consumers have finished. Only list nodes whose consumers in every
+      phase are part of the graph being run.
+    - retain_min_mb: files smaller than this are kept (default 10)
+    - fingerprint_store: FingerprintStore used for "fingerprint" hashing
+    - disk_budget_gb, disk_budget_dir: hold back new subjects while the
+      usage of disk_budget_dir is above disk_budget_gb
+    - disk_check_interval: seconds between usage checks (default 60)
+    """
+
+    def __init__(self, plugin_args=None):
+        super().__init__(plugin_args=plugin_args)
+        self.retain_nodes = set(self.plugin_args.get("retain_nodes", []))
+        self.retain_min_bytes = (self.plugin_args.get("retain_min_mb", 10)
+                                 * 1024 ** 2)
+        self.fingerprint_store = self.plugin_args.get("fingerprint_store")
+        self.disk_budget_gb = self.plugin_args.get("disk_budget_gb")
+        self.disk_budget_dir = self.plugin_args.get("disk_budget_dir")
+        self.disk_check_interval = self.plugin_args.get("disk_check_interval",
+                                                        60)
+        self._retained = set()
+        self._started = set()
+        self._usage = (0.0, -np.inf)
+
+    def _remove_node_dirs(self):
+        super()._remove_node_dirs()
+        if not self.retain_nodes:
+            return
+        # refidx rows are cleared as each dependent finishes
+        consumed = np.flatnonzero((self.refidx.sum(axis=1) == 0).__array__())
+        for idx in consumed:
+            node = self.procs[idx]
+            if (idx in self._retained or idx in self.mapnodesubids
+                    or node.name not in self.retain_nodes
+                    or not self.proc_done[idx] or self.proc_pending[idx]):
+                continue
+            self._retained.add(idx)
+            outdir = node.output_dir()
+            if op.isdir(outdir):
+                released = hollow_node_dir(outdir, self.retain_min_bytes,
+                                           self.fingerprint_store)
+                if released:
+                    logger.info("[Retention] Released %.2f GB from %s",
+                                released / 1024 ** 3, node.fullname)
+
+    def _subject(self, node):
+        # Nodes of one subject share the iterables parameterization, group
+        # level nodes have none
+        return tuple(node.parameterization)
+
+    def _submit_job(self, node, updatehash=False):
+        # Counted against the budget once it actually starts, not when its
+        # jobs are ranked, as MultiProc may then not have room for them
+        if self._subject(node):
+            self._started.add(self._subject(node))
+        hollow_files = hollow_inputs(node)
+        if not hollow_files:
+            return super()._submit_job(node, updatehash=updatehash)
+        self._taskid += 1
+        result_future = self.pool.submit(hollow_input_error, node.fullname,
+                                         hollow_files, self._taskid)
+        result_future.add_done_callback(self._async_callback)
+        self._task_obj[self._taskid] = result_future
+        return self._taskid
+
+    def _task_finished_cb(self, jobid, cached=False):
+        # Subjects with results from an earlier run have started too
+        if cached and self._subject(self.procs[jobid]):
+            self._started.add(self._subject(self.procs[jobid]))
+        super()._task_finished_cb(jobid, cached=cached)
+
+    def _usage_gb(self):
+        usage, checked = self._usage
+        if time.time() - checked > self.disk_check_interval:
+            usage = tree_usage_gb(self.disk_budget_dir)
+            self._usage = (usage, time.time())
+        return usage
+
+    def _sort_jobs(self, jobids, scheduler="tsort"):
+        jobids = super()._sort_jobs(jobids, scheduler=scheduler)
+        if self.disk_budget_gb is None:
+            return jobids
+
+        subject = lambda jobid: self._subject(self.procs[jobid])
+        new = [j for j in jobids
+               if subject(j) and subject(j) not in self._started]
+        if new and self._usage_gb() > self.disk_budget_gb:
+            held = new
+            if not self.pending_tasks:
+                # Nothing running would free space, let one subject start
+                held = [j for j in new if subject(j) != subject(new[0])]
+            if held:
+                logger.info("[Retention] Working tree over the %.0f GB budget "
+                            "(%.0f GB), holding back %d new subject jobs",
+                            self.disk_budget_gb, self._usage[0], len(held))
+                jobids = [j for j in jobids if j not in held]
+        return jobids
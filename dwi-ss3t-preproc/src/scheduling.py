@@ -0,0 +1,151 @@
+import os
+import os.path as op
+import json
+import time
+import numpy as np
+from nipype.pipeline.plugins.multiproc import MultiProcPlugin
+
+
+### CRITICAL PATH SCHEDULING ###
+# With scheduler "critical_path", ready jobs are started in order of the
+# runtime left on the longest chain from the job to the end of the graph, so
+# the synb0 -> dwipreproc -> response_func chains leading to the group
+# JoinNodes start ahead of work that nothing is waiting on yet. Runtimes are
+# per node name: declared estimates, updated with the durations observed in
+# this run and kept in runtime_file for the next one.
+#
+# MultiProc fills free threads with whatever ready job fits, so short 2
+# thread jobs can keep a 4 thread job on the critical path waiting. When the
+# first ranked job does not fit, it gets a reservation at the time enough
+# running jobs are expected to have finished, and lower ranked jobs only
+# start if they are expected to finish by then or fit beside it (EASY
+# backfilling).
+
+
+class CriticalPathMultiProcPlugin(MultiProcPlugin):
+    """MultiProc ranking ready jobs by remaining critical path length.
+
+    Extra plugin_args:
+
+    - scheduler: "critical_path" to enable (MultiProc's own values still work)
+    - runtimes: dict of estimated seconds per node name
+    - default_runtime: seconds for nodes without an estimate (default 60)
+    - runtime_file: json of observed mean runtimes, read at the start and
+      updated at the end of the run
+    """
+
+    def __init__(self, plugin_args=None):
+        super().__init__(plugin_args=plugin_args)
+        self.runtimes = dict(self.plugin_args.get("runtimes", {}))
+        self.default_runtime = self.plugin_args.get("default_runtime", 60)
+        self.runtime_file = self.plugin_args.get("runtime_file")
+        # name: (mean seconds, number of runs)
+        self.observed = {}
+        if self.runtime_file and op.exists(self.runtime_file):
+            with open(self.runtime_file) as f:
+                self.observed = {k: tuple(v) for k, v in json.load(f).items()}
+        self._started_at = {}
+        self._critical_path = None
+
+    def runtime(self, name):
+        if name in self.observed:
+            return self.observed[name][0]
+        return self.runtimes.get(name, self.default_runtime)
+
+    def _generate_dependency_list(self, graph):
+        super()._generate_dependency_list(graph)
+        # depidx is cleared as jobs finish, keep the full graph
+        self._successors = [self.depidx.getrowview(i).nonzero()[1]
+                            for i in range(len(self.procs))]
+
+    def critical_path(self):
+        """Seconds from the start of each job to the end of the graph."""
+        if self._critical_path is None:
+            length = np.zeros(len(self.procs))
+            # procs are in topological order
+            for i in reversed(range(len(self.procs))):
+                after = self._successors[i]
+                length[i] = (self.runtime(self.procs[i].name)
+                             + (length[after].max() if len(after) else 0))
+            self._critical_path = length
+        return self._critical_path
+
+    def _sort_jobs(self, jobids, scheduler="tsort"):
+        if scheduler != "critical_path":
+            return super()._sort_jobs(jobids, scheduler=scheduler)
+        length = self.critical_path()
+        return self._backfill(sorted(jobids, key=lambda jobid: -length[jobid]))
+
+    def _backfill(self, jobids):
+        """Drop jobs that would delay the first ranked job that does not fit."""
+        now = time.time()
+        free_gb, free_procs = self._check_resources(self.pending_tasks)
+        running = []
+        for _, jobid in self.pending_tasks:
+            node = self.procs[jobid]
+            started = self._started_at.get(node.itername, now)
+            running.append((started + self.runtime(node.name),
+                            min(node.n_procs, self.processors),
+                            min(node.mem_gb, self.memory_gb)))
+
+        kept = []
+        shadow = None
+        for jobid in jobids:
+            node = self.procs[jobid]
+            procs = min(node.n_procs, self.processors)
+            gb = min(node.mem_gb, self.memory_gb)
+            fits = procs <= free_procs and gb <= free_gb
+            if shadow is None and not fits:
+                # Reserve resources for this job at the earliest time enough
+                # running jobs are expected to have finished
+                shadow, spare_procs, spare_gb = now, 0, 0.0
+                avail_procs, avail_gb = free_procs, free_gb
+                for finish, r_procs, r_gb in sorted(running):
+                    avail_procs += r_procs
+                    avail_gb += r_gb
+                    if procs <= avail_procs and gb <= avail_gb:
+                        shadow = finish
+                        spare_procs, spare_gb = avail_procs - procs, avail_gb - gb
+                        break
+                kept.append(jobid)
+                continue
+            if not fits:
+                continue
+            if shadow is not None:
+                ends_in_time = now + self.runtime(node.name) <= shadow
+                if not ends_in_time:
+                    if procs > spare_procs or gb > spare_gb:
+                        continue
+                    spare_procs -= procs
+                    spare_gb -= gb
+            free_procs -= procs
+            free_gb -= gb
+            if shadow is None:
+                # Started ahead of the first job that does not fit, which
+                # may get its room when this one finishes
+                running.append((now + self.runtime(node.name), procs, gb))
+            kept.append(jobid)
+        return kept
+
+    def _submit_job(self, node, updatehash=False):
+        self._started_at[node.itername] = time.time()
+        return super()._submit_job(node, updatehash=updatehash)
+
+    def _task_finished_cb(self, jobid, cached=False):
+        started = self._started_at.pop(self.procs[jobid].itername, None)
+        if started is not None and not cached:
+            name = self.procs[jobid].name
+            mean, n = self.observed.get(name, (0.0, 0))
+            self.observed[name] = ((mean * n + time.time() - started) / (n + 1),
+                                   n + 1)
+            self._critical_path = None
+        super()._task_finished_cb(jobid, cached=cached)
+
+    def _postrun_check(self):
+        super()._postrun_check()
+        if self.runtime_file:
+            # Array tasks of a sharded run share the file, last one wins
+            tmp = "%s.%d" % (self.runtime_file, os.getpid())
+            with open(tmp, "w") as f:
+                json.dump(self.observed, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.runtime_file)
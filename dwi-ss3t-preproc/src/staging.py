@@ -0,0 +1,145 @@
+import os
+import os.path as op
+import glob
+import shutil
+import threading
+from nipype import logging
+from .retention import tombstone_file, apply_tombstones
+
+logger = logging.getLogger("nipype.workflow")
+
+
+### SCRATCH STAGING ###
+# Runs the working tree on node-local scratch instead of the shared
+# filesystem. Before the run, the subjects' inputs are copied to scratch and
+# their part of the working tree is restored from deriv so finished nodes are
+# found cached. During the run an uploader thread copies each node directory
+# back to deriv once nipype has written its final hashfile
+# (_0x<hash>.json, the last step of a node), so a later run resumes from
+# whatever was synced even if this job is killed.
+#
+# Files are copied with copy2, keeping mtimes so "timestamp" hashing matches
+# between the two trees. Files hollowed by the retention policy are hollowed
+# again after copying, rather than copied as zeros.
+
+
+def _same(src_stat, dst):
+    try:
+        dst_stat = os.lstat(dst)
+    except OSError:
+        return False
+    return (src_stat.st_size == dst_stat.st_size
+            and src_stat.st_mtime_ns == dst_stat.st_mtime_ns)
+
+
+def sync_dir(src, dst, delete=False):
+    """Copy new or changed files from src to dst, optionally removing files
+    in dst that are no longer in src. Returns the number of files copied."""
+    copied = 0
+    for root, dirs, files in os.walk(src):
+        dst_root = op.join(dst, op.relpath(root, src))
+        os.makedirs(dst_root, exist_ok=True)
+        for f in files + [d for d in dirs if op.islink(op.join(root, d))]:
+            src_file, dst_file = op.join(root, f), op.join(dst_root, f)
+            src_stat = os.lstat(src_file)
+            if _same(src_stat, dst_file):
+                continue
+            if op.lexists(dst_file):
+                os.remove(dst_file)
+            if op.islink(src_file):
+                os.symlink(os.readlink(src_file), dst_file)
+            else:
+                shutil.copy2(src_file, dst_file)
+            copied += 1
+        if delete:
+            for f in set(os.listdir(dst_root)) - set(files + dirs):
+                path = op.join(dst_root, f)
+                if op.isdir(path) and not op.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+    return copied
+
+
+def finished_node_dirs(wf_dir):
+    """Node directories holding a final hashfile, with the mtimes of the
+    hashfile and tombstone file."""
+    finished = {}
+    for hashfile in glob.glob(op.join(wf_dir, "**", "_0x*.json"),
+                              recursive=True):
+        if not hashfile.endswith("_unfinished.json"):
+            node_dir = op.dirname(hashfile)
+            tombstones = op.join(node_dir, tombstone_file)
+            finished[node_dir] = (
+                os.stat(hashfile).st_mtime_ns,
+                op.exists(tombstones) and os.stat(tombstones).st_mtime_ns)
+    return finished
+
+
+class Uploader(threading.Thread):
+    """Background thread syncing finished node directories from the scratch
+    working tree to deriv."""
+
+    def __init__(self, scratch_wf_dir, deriv_wf_dir, interval=30):
+        super().__init__(name="scratch-uploader", daemon=True)
+        self.scratch_wf_dir = scratch_wf_dir
+        self.deriv_wf_dir = deriv_wf_dir
+        self.interval = interval
+        self.synced = {}
+        self._stop_event = threading.Event()
+        # sync() is also called from outside the thread, e.g. by stop()
+        self._lock = threading.Lock()
+
+    def sync(self):
+        with self._lock:
+            for node_dir, mtimes in sorted(
+                    finished_node_dirs(self.scratch_wf_dir).items()):
+                if self.synced.get(node_dir) == mtimes:
+                    continue
+                dst = op.join(self.deriv_wf_dir,
+                              op.relpath(node_dir, self.scratch_wf_dir))
+                copied = sync_dir(node_dir, dst, delete=True)
+                apply_tombstones(dst)
+                self.synced[node_dir] = mtimes
+                logger.debug("Synced %d files to %s", copied, dst)
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.sync()
+            except OSError as e:
+                # Retried on the next pass and in the final sync
+                logger.warning("Scratch upload failed: %s", e)
+
+    def stop(self):
+        """Stop the thread and sync whatever finished since the last pass."""
+        self._stop_event.set()
+        self.join()
+        self.sync()
+
+
+def stage_inputs(input_dir, scratch_input_dir, subjects):
+    """Copy the subjects' input directories to scratch."""
+    for subject in subjects:
+        sync_dir(op.join(input_dir, subject),
+                 op.join(scratch_input_dir, subject))
+
+
+def restore_working_tree(deriv_wf_dir, scratch_wf_dir, subjects):
+    """Copy the subjects' node directories and the group level nodes from
+    deriv to scratch so finished nodes are not rerun."""
+    if not op.isdir(deriv_wf_dir):
+        return
+    subject_dirs = {"_subject_id_%s" % s for s in subjects}
+    for name in os.listdir(deriv_wf_dir):
+        src = op.join(deriv_wf_dir, name)
+        if name.startswith("_subject_id_") and name not in subject_dirs:
+            continue
+        if op.isdir(src):
+            sync_dir(src, op.join(scratch_wf_dir, name))
+            for root, _, files in os.walk(op.join(scratch_wf_dir, name)):
+                if tombstone_file in files:
+                    apply_tombstones(root)
+        else:
+            os.makedirs(scratch_wf_dir, exist_ok=True)
+            shutil.copy2(src, op.join(scratch_wf_dir, name))
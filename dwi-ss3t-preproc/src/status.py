@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+#####
+# Show the progress of running workflows, from the status files run.py
+# writes to <deriv_dir>/status (see src/telemetry.py) or from the status
+# served on status_port:
+#
+#   python3 src/status.py <deriv_dir>/status
+#   python3 src/status.py http://127.0.0.1:8765/ --subjects --watch 30
+#
+# Only uses the standard library so it can be run on the login node,
+# outside the container.
+#####
+
+import os
+import json
+import time
+import argparse
+import urllib.request
+import os.path as op
+
+
+def load_status(source):
+    """Statuses from a status file, a directory of them or a URL."""
+    if source.startswith("http://"):
+        with urllib.request.urlopen(source, timeout=10) as response:
+            return [json.load(response)]
+    paths = ([op.join(source, f) for f in sorted(os.listdir(source))
+              if f.endswith(".json")] if op.isdir(source) else [source])
+    statuses = []
+    for path in paths:
+        with open(path) as f:
+            statuses.append(json.load(f))
+    return statuses
+
+
+def hours(seconds):
+    if seconds < 3600:
+        return "%.0f min" % (seconds / 60)
+    return "%.1f h" % (seconds / 3600)
+
+
+def show(status, list_subjects=False):
+    now = time.time()
+    jobs = status["jobs"]
+    print("%s phase on %s %s: %s, updated %s ago, running for %s" % (
+        status["phase"], status["host"], status["job_id"], status["state"],
+        hours(now - status["updated"]),
+        hours(status["updated"] - status["started"])))
+    print("  jobs     %d finished, %d running, %d ready, %d waiting, "
+          "%d failed, %d skipped of %d" % (
+              jobs["finished"], jobs["running"], jobs["ready"],
+              jobs["waiting"], jobs["failed"], jobs["skipped"],
+              jobs["total"]))
+    cpus, mem = status["cpus"], status["memory_gb"]
+    print("  cpus     %d/%d booked, load %.1f" % (cpus["booked"],
+                                                   cpus["total"],
+                                                   cpus["load"]))
+    print("  memory   %.1f/%.1f GB booked, %.1f GB in use" % (
+        mem["booked"], mem["total"], mem["rss"]))
+    if status["state"] == "running":
+        print("  ETA      %s" % hours(status["eta_s"]))
+    for name, barrier in sorted(status["barriers"].items()):
+        print("  %-24s %d/%d upstream jobs done, %s" % (
+            name, barrier["upstream_done"], barrier["upstream"],
+            barrier["state"] if barrier["state"] != "waiting"
+            else "can start in %s" % hours(barrier["eta_s"])))
+
+    print("\n  %-28s %8s %8s %8s %8s %8s" % ("node", "finished", "running",
+                                            "ready", "waiting", "failed"))
+    for name in status["node_order"]:
+        counts = status["nodes"][name]
+        print("  %-28s %8d %8d %8d %8d %8d" % (
+            name, counts["finished"], counts["running"], counts["ready"],
+            counts["waiting"], counts["failed"] + counts["skipped"]))
+
+    if list_subjects:
+        print("\n  F finished, R running, Q ready, W waiting, X failed, "
+              "S skipped")
+        for k, name in enumerate(status["node_order"]):
+            print("  %s%s" % (" " * 12 + "| " * k, name))
+        for subject, row in status["subjects"].items():
+            print("  %-12s%s" % (subject, " ".join(row)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Progress of running "
+                                     "workflows")
+    parser.add_argument("source", help="Status file, directory of status "
+                        "files (<deriv_dir>/status) or "
+                        "http://127.0.0.1:<port>/")
+    parser.add_argument("--subjects", action="store_true",
+                        help="List every subject's node states")
+    parser.add_argument("--watch", type=float, metavar="SECONDS",
+                        help="Show again every SECONDS")
+    args = parser.parse_args()
+
+    while True:
+        if args.watch:
+            print("\033[2J\033[H", end="")
+        for status in load_status(args.source):
+            show(status, args.subjects)
+            print()
+        if not args.watch:
+            break
+        time.sleep(args.watch)
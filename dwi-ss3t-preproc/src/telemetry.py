@@ -0,0 +1,248 @@
+import os
+import os.path as op
+import json
+import time
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from nipype import JoinNode
+from nipype.pipeline.plugins.multiproc import MultiProcPlugin
+from .profiling import subject_of, descendants, rss_bytes
+
+
+### TELEMETRY ###
+# Publishes a running workflow's progress: the state of every job, counted
+# per node and listed per subject, how much of the work feeding each
+# JoinNode (the group responses) is done, the cores and memory booked by
+# running jobs against what is in use, and an ETA. The status is built from
+# the scheduler's own arrays in its loop, at most every status_interval
+# seconds, and written to status_file (replaced whole, so readers never see
+# half a file) and/or served as JSON on 127.0.0.1:status_port. Building it
+# takes about 0.1 s for 20000 jobs, within the loop's 2 s poll sleep.
+#
+# ETAs take the node runtimes of the critical path layer (observed means,
+# updated as jobs finish) and are the larger of the longest chain of
+# remaining jobs and the remaining work spread over all the cores.
+#
+# src/status.py shows it:
+#
+#   python3 src/status.py <deriv_dir>/status
+#   python3 src/status.py http://127.0.0.1:8765/ --subjects
+
+
+# One letter per job state in the per subject table
+state_letters = {"finished": "F", "running": "R", "ready": "Q",
+                 "waiting": "W", "failed": "X", "skipped": "S"}
+
+
+class TelemetryMultiProcPlugin(MultiProcPlugin):
+    """MultiProc publishing its progress.
+
+    Extra plugin_args:
+
+    - status_file: json file the status is written to (None to disable)
+    - status_port: serve the status on http://127.0.0.1:<port>/ (None to
+      disable)
+    - status_interval: seconds between updates (default 10)
+    - status_phase: phase reported in the status
+    """
+
+    def __init__(self, plugin_args=None):
+        super().__init__(plugin_args=plugin_args)
+        self.status_file = self.plugin_args.get("status_file")
+        self.status_port = self.plugin_args.get("status_port")
+        self.status_interval = self.plugin_args.get("status_interval", 10)
+        self.status_phase = self.plugin_args.get("status_phase", "all")
+        self._status_json = b"{}"
+        self._status_time = 0
+        self._server = None
+        self._run_start = time.time()
+        self._submitted = {}
+        self._finished = set()
+        self._failed = set()
+
+    @property
+    def _status_enabled(self):
+        return bool(self.status_file or self.status_port)
+
+    def _prerun_check(self, graph):
+        super()._prerun_check(graph)
+        self._run_start = time.time()
+        if self.status_port:
+            plugin = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.end_headers()
+                    self.wfile.write(plugin._status_json)
+
+                def log_message(self, *args):
+                    pass
+
+            # Local only, also reachable from inside the container
+            self._server = ThreadingHTTPServer(("127.0.0.1",
+                                                self.status_port), Handler)
+            threading.Thread(target=self._server.serve_forever,
+                             daemon=True).start()
+
+    def _generate_dependency_list(self, graph):
+        super()._generate_dependency_list(graph)
+        if not self._status_enabled:
+            return
+        # depidx is cleared as jobs finish, keep the full graph
+        rows = self.depidx.tocsr()
+        self._job_successors = np.split(rows.indices, rows.indptr[1:-1])
+        self._job_predecessors = [[] for _ in self.procs]
+        for i, successors in enumerate(self._job_successors):
+            for j in successors:
+                self._job_predecessors[j].append(i)
+        self._job_subjects = [subject_of(node) for node in self.procs]
+        self._node_names = list(dict.fromkeys(n.name for n in self.procs))
+        # Jobs upstream of each JoinNode, procs are in topological order
+        self._barriers = {}
+        for i in reversed(range(len(self.procs))):
+            if isinstance(self.procs[i], JoinNode):
+                upstream, todo = set(), [i]
+                while todo:
+                    for j in self._job_predecessors[todo.pop()]:
+                        if j not in upstream:
+                            upstream.add(j)
+                            todo.append(j)
+                self._barriers[i] = np.array(sorted(upstream), dtype=int)
+
+    def _task_finished_cb(self, jobid, cached=False):
+        self._finished.add(jobid)
+        self._submitted.pop(jobid, None)
+        super()._task_finished_cb(jobid, cached=cached)
+
+    def _clean_queue(self, jobid, graph, result=None):
+        self._failed.add(jobid)
+        self._submitted.pop(jobid, None)
+        return super()._clean_queue(jobid, graph, result=result)
+
+    def _send_procs_to_workers(self, updatehash=False, graph=None):
+        if (self._status_enabled
+                and time.time() - self._status_time >= self.status_interval):
+            self._publish("running")
+        super()._send_procs_to_workers(updatehash=updatehash, graph=graph)
+        # Start times of the jobs just submitted, for the ETA
+        now = time.time()
+        for _, jobid in self.pending_tasks:
+            self._submitted.setdefault(jobid, now)
+
+    def _postrun_check(self):
+        if self._status_enabled and hasattr(self, "_job_successors"):
+            self._publish("failed" if self._failed else "finished"
+                          if np.all(self.proc_done) else "stopped")
+        super()._postrun_check()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _states(self):
+        """State of each job."""
+        done, pending = self.proc_done, self.proc_pending
+        no_deps = np.asarray(self.depidx.sum(axis=0) == 0).ravel()
+        states = np.full(len(self.procs), "waiting", dtype=object)
+        states[~done & no_deps] = "ready"
+        states[done & ~pending] = "skipped"
+        states[done & pending] = "running"
+        states[list(self._finished)] = "finished"
+        states[list(self._failed)] = "failed"
+        return states
+
+    def _eta(self, states, now):
+        """Seconds left overall, and until each JoinNode can start."""
+        runtime = getattr(self, "runtime", lambda name: 60)
+        left = np.zeros(len(self.procs))
+        for i, state in enumerate(states):
+            if state in ["waiting", "ready"]:
+                left[i] = runtime(self.procs[i].name)
+            elif state == "running":
+                left[i] = max(runtime(self.procs[i].name)
+                              - (now - self._submitted.get(i, now)), 0)
+        threads = np.array([min(n.n_procs, self.processors)
+                            for n in self.procs])
+        # Longest chain of remaining jobs ending at each job
+        finish = np.zeros(len(self.procs))
+        for i in range(len(self.procs)):
+            before = self._job_predecessors[i]
+            finish[i] = left[i] + (finish[before].max() if before else 0)
+
+        def bound(jobs, chain):
+            return max(chain, (left[jobs] * threads[jobs]).sum()
+                       / self.processors)
+
+        barriers = {i: bound(jobs, finish[i] - left[i])
+                    for i, jobs in self._barriers.items()}
+        return bound(np.arange(len(self.procs)), finish.max()), barriers
+
+    def status(self, state="running"):
+        """The run's progress as a dict."""
+        now = time.time()
+        states = self._states()
+        free_gb, free_procs = self._check_resources(self.pending_tasks)
+        node_index = {name: k for k, name in enumerate(self._node_names)}
+
+        nodes = {name: dict.fromkeys(state_letters, 0)
+                 for name in self._node_names}
+        subjects = {}
+        for i, job_state in enumerate(states):
+            name = self.procs[i].name
+            nodes[name][job_state] += 1
+            subject = self._job_subjects[i]
+            if subject:
+                row = subjects.setdefault(subject,
+                                          ["-"] * len(self._node_names))
+                row[node_index[name]] = state_letters[job_state]
+
+        eta, barrier_eta = self._eta(states, now)
+        barriers = {}
+        for i, upstream in self._barriers.items():
+            done = int(np.isin(states[upstream],
+                               ["finished", "failed", "skipped"]).sum())
+            barriers[self.procs[i].name] = dict(
+                upstream_done=done, upstream=len(upstream),
+                state=states[i], eta_s=barrier_eta[i])
+
+        pid = os.getpid()
+        rss = sum(rss_bytes(p) for p in descendants(pid) | {pid})
+        counts = {s: int((states == s).sum()) for s in state_letters}
+        return {
+            "state": state, "phase": self.status_phase,
+            "host": socket.gethostname(),
+            "job_id": os.environ.get("PBS_JOBID", ""),
+            "started": self._run_start, "updated": now,
+            "jobs": dict(counts, total=len(states)),
+            "cpus": {"total": self.processors,
+                     "booked": self.processors - free_procs,
+                     "load": os.getloadavg()[0]},
+            "memory_gb": {"total": self.memory_gb,
+                          "booked": self.memory_gb - free_gb,
+                          "rss": rss / 1024 ** 3},
+            "eta_s": eta if state == "running" else 0,
+            "barriers": barriers,
+            "nodes": nodes,
+            "node_order": self._node_names,
+            "subjects": {s: "".join(row) for s, row in
+                         sorted(subjects.items())},
+        }
+
+    def _publish(self, state):
+        self._status_time = time.time()
+        try:
+            self._status_json = json.dumps(self.status(state)).encode()
+            if self.status_file:
+                os.makedirs(op.dirname(self.status_file) or ".",
+                            exist_ok=True)
+                tmp = "%s.%d" % (self.status_file, os.getpid())
+                with open(tmp, "wb") as f:
+                    f.write(self._status_json)
+                os.replace(tmp, self.status_file)
+        except OSError:
+            # A full disk or a gone directory should not stop the run
+            pass
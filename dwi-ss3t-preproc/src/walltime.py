@@ -0,0 +1,167 @@
+import os
+import signal
+import time
+from concurrent.futures.process import BrokenProcessPool
+from nipype import logging
+from .scheduling import CriticalPathMultiProcPlugin
+from .profiling import descendants
+
+logger = logging.getLogger("nipype.workflow")
+
+
+### WALLTIME ###
+# Jobs are only started if their expected runtime (the critical path
+# layer's runtimes, i.e. the observed means kept in runtime_file) fits in
+# the walltime left, less a margin for shutting down. Once nothing running
+# is left and no ready job fits, or when PBS signals the end of the
+# walltime (SIGTERM), the run stops with WalltimeExceeded. Running jobs are
+# killed on a signal; their node directories are left unfinished and nipype
+# reruns them, everything finished is kept. run.py then exits with
+# resubmit_exit_code and the job script submits a continuation job
+# (src/pbs.py --continuation), which picks up from the working tree.
+#
+# WALLTIME_CLOCK_SCALE makes the walltime run out that many times faster,
+# to try the whole cycle with stub tools and dev/fake_qsub.py.
+
+
+# EX_TEMPFAIL from sysexits.h
+resubmit_exit_code = 75
+
+
+class WalltimeExceeded(Exception):
+    """The run stopped before the walltime ran out."""
+
+
+def parse_walltime(value):
+    """Seconds from [[HH:]MM:]SS, as PBS writes walltimes."""
+    seconds = 0
+    for part in str(value).strip().split(":"):
+        seconds = seconds * 60 + int(part)
+    return seconds
+
+
+class Walltime:
+    """Clock for the time left in the job.
+
+    limit is the job's walltime in seconds, start when the job started
+    (default now). The clock runs scale times faster than real time.
+    """
+
+    def __init__(self, limit, start=None, scale=1.0):
+        self.limit = limit
+        self.start = time.time() if start is None else start
+        self.scale = scale
+
+    @classmethod
+    def from_environ(cls, environ=os.environ):
+        """From WALLTIME (as in PBS -l walltime=), WALLTIME_START (epoch
+        seconds) and WALLTIME_CLOCK_SCALE. None outside a job with WALLTIME
+        set."""
+        if not environ.get("WALLTIME"):
+            return None
+        start = environ.get("WALLTIME_START")
+        return cls(parse_walltime(environ["WALLTIME"]),
+                   float(start) if start else None,
+                   float(environ.get("WALLTIME_CLOCK_SCALE", 1)))
+
+    def remaining(self):
+        """Real seconds left, at the clock's speed."""
+        return self.limit / self.scale - (time.time() - self.start)
+
+
+class WalltimeMultiProcPlugin(CriticalPathMultiProcPlugin):
+    """MultiProc stopping cleanly before the job's walltime runs out.
+
+    Extra plugin_args:
+
+    - walltime: Walltime of the job (None to disable)
+    - walltime_margin: seconds kept free at the end of the job, for syncing
+      the working tree back from scratch (default 600)
+    - walltime_safety: factor on expected runtimes (default 1.2)
+    """
+
+    def __init__(self, plugin_args=None):
+        super().__init__(plugin_args=plugin_args)
+        self.walltime = self.plugin_args.get("walltime")
+        self.walltime_margin = self.plugin_args.get("walltime_margin", 600)
+        self.walltime_safety = self.plugin_args.get("walltime_safety", 1.2)
+        self._signalled = None
+        self._old_handler = None
+        self._held = 0
+
+    def _prerun_check(self, graph):
+        super()._prerun_check(graph)
+        if self.walltime:
+            self._old_handler = signal.signal(signal.SIGTERM, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        # Acted on in the scheduling loop, not in the middle of a callback
+        self._signalled = signum
+
+    def _fits(self, node):
+        """Whether a job can finish in the time left, or never could."""
+        expected = self.runtime(node.name) * self.walltime_safety
+        left = self.walltime.remaining() - self.walltime_margin
+        whole_job = (self.walltime.limit / self.walltime.scale
+                     - self.walltime_margin)
+        # A job that would not fit in any job's walltime runs anyway
+        return expected <= left or expected > whole_job
+
+    def _sort_jobs(self, jobids, scheduler="tsort"):
+        jobids = super()._sort_jobs(jobids, scheduler=scheduler)
+        if not self.walltime:
+            return jobids
+        held = [j for j in jobids if not self._fits(self.procs[j])]
+        if held:
+            jobids = [j for j in jobids if j not in held]
+            if not jobids and not self.pending_tasks:
+                self._stop("%d ready jobs do not fit in the %.0f s of "
+                           "walltime left" % (len(held),
+                                              self.walltime.remaining()))
+            if len(held) != self._held:
+                logger.info("[Walltime] Not starting %d jobs that would not "
+                            "finish in the %.0f s left", len(held),
+                            self.walltime.remaining())
+        self._held = len(held)
+        return jobids
+
+    def _send_procs_to_workers(self, updatehash=False, graph=None):
+        if self._signalled:
+            self._kill_running()
+            self._stop("Received signal %d, stopped %d running jobs"
+                       % (self._signalled, len(self.pending_tasks)))
+        return super()._send_procs_to_workers(updatehash=updatehash,
+                                              graph=graph)
+
+    def _async_callback(self, args):
+        # Jobs whose workers were killed by _kill_running
+        if self._signalled and (args.cancelled() or isinstance(
+                args.exception(), BrokenProcessPool)):
+            return
+        super()._async_callback(args)
+
+    def _kill_running(self):
+        """Kill the workers and the tools they are running."""
+        for future in self._task_obj.values():
+            future.cancel()
+        workers = list(getattr(self.pool, "_processes", {}).values())
+        for worker in workers:
+            for pid in descendants(worker.pid):
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            worker.kill()
+
+    def _stop(self, reason):
+        logger.warning("[Walltime] %s, stopping the run to continue in a "
+                       "new job", reason)
+        self._postrun_check()
+        raise WalltimeExceeded(reason)
+
+    def _postrun_check(self):
+        super()._postrun_check()
+        if self._old_handler is not None:
+            signal.signal(signal.SIGTERM, self._old_handler)
+            self._old_handler = None
+
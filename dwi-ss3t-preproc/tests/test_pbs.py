@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import importlib
+import threading
+import os.path as op
+import pytest
+
+package_dir = op.join(op.dirname(op.abspath(__file__)), "..")
+sys.path.insert(0, package_dir)
+from src.pbs import submit_continuation, submit_sharded  # noqa: E402
+
+fake_qsub = op.join(package_dir, "dev", "fake_qsub.py")
+
+# qstat -f and qalter -W depend= over a directory of <job>.<kind> files, one
+# job id per line. qstat is slow to answer, so updates that are not
+# serialised lose each other's continuations.
+fake_qstat = """#!%s
+import os, sys, time
+pbs_dir = os.environ["FAKE_PBS_DIR"]
+job = sys.argv[-1]
+time.sleep(0.1)
+depend = []
+for kind in ["afterok", "beforeok"]:
+    path = os.path.join(pbs_dir, "%%s.%%s" %% (job, kind))
+    if os.path.exists(path):
+        with open(path) as f:
+            depend.append(":".join([kind] + f.read().split()))
+print("Job Id: %%s" %% job)
+print("    depend = %%s" %% ",".join(depend))
+""" % sys.executable
+
+fake_qalter = """#!%s
+import os, sys
+pbs_dir = os.environ["FAKE_PBS_DIR"]
+kind, *jobs = sys.argv[2][len("depend="):].split(":")
+path = os.path.join(pbs_dir, "%%s.%%s" %% (sys.argv[3], kind))
+with open(path + ".tmp", "w") as f:
+    f.write("\\n".join(jobs))
+os.replace(path + ".tmp", path)
+""" % sys.executable
+
+
+@pytest.fixture
+def pbs(tmp_path, monkeypatch):
+    """Job script and fake PBS commands, jobs run in tmp_path."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("FAKE_QSUB_STATE", str(tmp_path / "qsub_state.json"))
+    monkeypatch.setenv("FAKE_QSUB_LOG", str(tmp_path / "qsub_log.jsonl"))
+    monkeypatch.setenv("FAKE_PBS_DIR", str(tmp_path))
+    script = tmp_path / "job.sh"
+    script.write_text("exit 0\n")
+    commands = {}
+    for name, source in [("qstat", fake_qstat), ("qalter", fake_qalter)]:
+        commands[name] = tmp_path / name
+        commands[name].write_text(source)
+        commands[name].chmod(0o755)
+    return str(script), commands
+
+
+def submissions(tmp_path):
+    """{PHASE: fake_qsub log entry} of the jobs submitted."""
+    jobs = {}
+    with open(tmp_path / "qsub_log.jsonl") as f:
+        for line in f:
+            job = json.loads(line)
+            argv = job["argv"]
+            variables = dict(v.split("=", 1) for v in
+                             argv[argv.index("-v") + 1].split(","))
+            jobs[variables["PHASE"]] = dict(job, variables=variables)
+    return jobs
+
+
+def option(job, flag):
+    argv = job["argv"]
+    return argv[argv.index(flag) + 1] if flag in argv else None
+
+
+def test_sharded_chain(pbs, tmp_path):
+    script, _ = pbs
+    ids = submit_sharded(script, 3, fake_qsub)
+    jobs = submissions(tmp_path)
+    assert sorted(jobs) == ["fod", "group", "preproc"]
+    assert option(jobs["preproc"], "-J") == "0-2"
+    assert option(jobs["preproc"], "-W") is None
+    assert option(jobs["group"], "-J") is None
+    assert option(jobs["group"], "-W") == "depend=afterok:%s" % ids["preproc"]
+    assert option(jobs["fod"], "-J") == "0-2"
+    assert option(jobs["fod"], "-W") == "depend=afterok:%s" % ids["group"]
+    for phase, job in jobs.items():
+        assert job["job_id"] == ids[phase]
+        assert job["variables"]["N_SHARDS"] == "3"
+        assert job["variables"]["SUBMIT_SCRIPT"] == script
+    # Every array task ran
+    assert len(jobs["preproc"]["returncodes"]) == 3
+    assert len(jobs["group"]["returncodes"]) == 1
+
+
+def test_sharded_response_subset(pbs, tmp_path):
+    script, _ = pbs
+    ids = submit_sharded(script, 2, fake_qsub, response_subset=True)
+    jobs = submissions(tmp_path)
+    # The rest of the cohort is preprocessed alongside the group job
+    assert option(jobs["group"], "-W") is None
+    assert option(jobs["preproc"], "-W") is None
+    assert option(jobs["preproc"], "-J") == "0-1"
+    assert option(jobs["fod"], "-W") == ("depend=afterok:%s:%s"
+                                         % (ids["group"], ids["preproc"]))
+    assert not jobs["fod"]["skipped"]
+
+
+def test_sharded_frozen_response(pbs, tmp_path):
+    script, _ = pbs
+    submit_sharded(script, 4, fake_qsub, frozen_response=True)
+    jobs = submissions(tmp_path)
+    assert sorted(jobs) == ["fod"]
+    assert option(jobs["fod"], "-J") == "0-3"
+    assert option(jobs["fod"], "-W") is None
+
+
+def test_continuations_of_array_tasks_all_extend_the_dependent(pbs,
+                                                               tmp_path):
+    script, commands = pbs
+    (tmp_path / "1[].fake.beforeok").write_text("2.fake")
+    (tmp_path / "2.fake.afterok").write_text("1[].fake")
+
+    continuations = []
+
+    def stop(index):
+        # Every array task stops at the same time
+        continuations.append(submit_continuation(
+            script, {"PHASE": "preproc", "SHARD_INDEX": index},
+            "1[%d].fake" % index, fake_qsub, str(commands["qstat"]),
+            str(commands["qalter"])))
+
+    threads = [threading.Thread(target=stop, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(set(continuations)) == 4
+    afterok = (tmp_path / "2.fake.afterok").read_text().split()
+    assert sorted(afterok) == sorted(["1[].fake"] + continuations)
+
+
+@pytest.fixture(scope="module")
+def run(tmp_path_factory):
+    """run.py imported against an empty input directory."""
+    base_dir = tmp_path_factory.mktemp("base")
+    (base_dir / "imaging_data" / "input").mkdir(parents=True)
+    old = os.environ.get("BASE_DIR")
+    os.environ["BASE_DIR"] = str(base_dir)
+    try:
+        return importlib.import_module("run")
+    finally:
+        if old is None:
+            del os.environ["BASE_DIR"]
+        else:
+            os.environ["BASE_DIR"] = old
+
+
+subjects = ["sub-%02d" % i for i in range(11)]
+
+
+@pytest.mark.parametrize("n_shards", [1, 2, 3, 4, 11, 12])
+def test_each_subject_in_one_shard(run, n_shards):
+    shards = [run.shard(subjects, i, n_shards) for i in range(n_shards)]
+    assert sorted(s for shard in shards for s in shard) == subjects
+    with pytest.raises(ValueError):
+        run.shard(subjects, n_shards, n_shards)
+
+
+def test_response_subset(run, monkeypatch):
+    monkeypatch.setattr(run, "response_subjects", None)
+    assert run.response_subset(subjects) == subjects
+    monkeypatch.setattr(run, "response_subjects", 4)
+    subset = run.response_subset(subjects)
+    assert len(set(subset)) == 4 and set(subset) <= set(subjects)
+    monkeypatch.setattr(run, "response_subjects", 20)
+    assert run.response_subset(subjects) == subjects
+    monkeypatch.setattr(run, "response_subjects", ["sub-03", "sub-01"])
+    assert run.response_subset(subjects) == ["sub-01", "sub-03"]
+    monkeypatch.setattr(run, "response_subjects", ["sub-99"])
+    with pytest.raises(ValueError):
+        run.response_subset(subjects)
+
+
+@pytest.mark.parametrize("n_shards", [1, 3])
+def test_subset_and_preproc_shards_split_the_cohort(run, monkeypatch,
+                                                    n_shards):
+    # With --response-subset, the group job preprocesses the subset and the
+    # preproc array the rest
+    monkeypatch.setattr(run, "response_subjects", 3)
+    subset = run.response_subset(subjects)
+    rest = [s for s in subjects if s not in subset]
+    shards = [run.shard(rest, i, n_shards) for i in range(n_shards)]
+    assigned = subset + [s for shard in shards for s in shard]
+    assert sorted(assigned) == subjects
@@ -0,0 +1,56 @@
+import sys
+import os.path as op
+from nipype import JoinNode, Node, IdentityInterface, Merge
+
+sys.path.insert(0, op.join(op.dirname(op.abspath(__file__)), ".."))
+import src.planning as planning  # noqa: E402
+
+
+def graph():
+    """source -> prep -> response -> mean (JoinNode) -> fod, prep -> fod"""
+    source = Node(IdentityInterface(fields=["subject_id"]), name="source")
+    prep, response, fod = [Node(Merge(1), name=name)
+                           for name in ["prep", "response", "fod"]]
+    mean = JoinNode(Merge(1), joinsource="source", joinfield=["in1"],
+                    name="mean")
+    return source, [(source, prep, [("subject_id", "in1")]),
+                    (prep, response, [("out", "in1")]),
+                    (response, mean, [("out", "in1")]),
+                    (mean, fod, [("out", "in1")]),
+                    (prep, fod, [("out", "in1")])]
+
+
+def test_cached_expansion_matches_expand(tmp_path):
+    source, connections = graph()
+    subjects = ["sub-%02d" % i for i in range(6)]
+    # sub-00 is preprocessed already
+    finished_dir = tmp_path / "_subject_id_sub-00" / "prep"
+    finished_dir.mkdir(parents=True)
+    (finished_dir / "_0xabc.json").write_text("{}")
+    estimates = planning.Estimates(runtimes={"prep": 100})
+    planner = planning.Planner(str(tmp_path), source, estimates, [2], 4,
+                               3600)
+
+    done = {("sub-01", "prep"), ("sub-01", "response")}
+    for subject_list, done in [(subjects, ()), (subjects, done),
+                               (subjects[::2], ()), (subjects[1:4], done)]:
+        assert (planner.expand(connections, subject_list, done)
+                == planning.expand(connections, source, subject_list,
+                                   str(tmp_path), estimates, done))
+
+
+def test_plans_glob_each_node_directory_once(tmp_path, monkeypatch):
+    source, connections = graph()
+    subjects = ["sub-%02d" % i for i in range(8)]
+    planner = planning.Planner(str(tmp_path), source,
+                               planning.Estimates(), [2, 4], 4, 86400)
+    checked = []
+    finished = planning.finished
+    monkeypatch.setattr(planning, "finished",
+                        lambda d: checked.append(d) or finished(d))
+
+    plans = planner.plans([(connections, subjects)],
+                          [("fod", connections, None)], subjects)
+    # The single job, and 1, 2, 3, 4 and 8 shards
+    assert len(plans) == 6
+    assert len(checked) == len(set(checked))
@@ -0,0 +1,53 @@
+import sys
+import os.path as op
+from types import SimpleNamespace
+import networkx as nx
+
+sys.path.insert(0, op.join(op.dirname(op.abspath(__file__)), ".."))
+from src.qc import QCGateMultiProcPlugin  # noqa: E402
+
+
+class FakeNode:
+    """Just what the plugin reads from a node."""
+
+    def __init__(self, name, subject=None, passed=True):
+        self.name = self.fullname = name
+        self.parameterization = ["_subject_id_%s" % subject] if subject else []
+        self.n_procs = 1
+        self.mem_gb = 0.1
+        self.result = SimpleNamespace(outputs=SimpleNamespace(
+            passed=passed, failures=[] if passed else ["outlier_pct"]))
+
+
+def test_drop_releases_successors_outside_the_subject():
+    qc = FakeNode("dwi_qc", "sub-01", passed=False)
+    upsample = FakeNode("upsample", "sub-01")
+    ss3t = FakeNode("ss3t", "sub-01")
+    other = FakeNode("upsample", "sub-02")
+    # A group level job after jobs of both subjects
+    group = FakeNode("group_mean")
+    graph = nx.DiGraph([(qc, upsample), (upsample, ss3t), (upsample, group),
+                        (other, group)])
+
+    plugin = QCGateMultiProcPlugin(plugin_args={"qc_node": "dwi_qc",
+                                                "n_procs": 1,
+                                                "memory_gb": 1})
+    try:
+        plugin._prerun_check(graph)
+        plugin._generate_dependency_list(graph)
+        # Set up by run() otherwise
+        plugin.mapnodes, plugin.mapnodesubids = [], {}
+        index = {n: i for i, n in enumerate(plugin.procs)}
+        for node in [qc, other]:
+            plugin.proc_done[index[node]] = True
+            plugin.proc_pending[index[node]] = True
+            plugin._task_finished_cb(index[node])
+
+        assert plugin.qc_failed == {"sub-01": ["outlier_pct"]}
+        assert plugin.proc_done[index[upsample]]
+        assert plugin.proc_done[index[ss3t]]
+        # The group job is kept and no longer waits on the dropped jobs
+        assert not plugin.proc_done[index[group]]
+        assert plugin.depidx[:, index[group]].sum() == 0
+    finally:
+        plugin.pool.shutdown()
@@ -0,0 +1,48 @@
+import sys
+import os.path as op
+import numpy as np
+
+sys.path.insert(0, op.join(op.dirname(op.abspath(__file__)), ".."))
+from src.custom_classes import MeanResponse  # noqa: E402
+from src.response_store import (  # noqa: E402
+    ResponseStore,
+    read_response,
+    response_mean
+)
+
+
+def write_responses(tmp_path):
+    """gm responses of three subjects, two shells each."""
+    paths = []
+    for k, subject in enumerate(["sub-01", "sub-02", "sub-03"]):
+        path = tmp_path / ("%s_gm.txt" % subject)
+        path.write_text("# Shells: 0,1000\n%g\n%g\n"
+                        % (1000 + 300 * k, 500 + 50 * k))
+        paths.append(str(path))
+    return paths
+
+
+def store_mean(tmp_path, in_files, qc_passed, out_file):
+    MeanResponse(in_files=in_files, out_file=str(tmp_path / out_file),
+                 store_dir=str(tmp_path / "store"), tissue="gm",
+                 subject_ids=["sub-01", "sub-02", "sub-03"],
+                 qc_passed=qc_passed).run()
+    return read_response(str(tmp_path / out_file))[1]
+
+
+def test_subject_failing_qc_leaves_the_store(tmp_path):
+    in_files = write_responses(tmp_path)
+    responses = [read_response(f)[1] for f in in_files]
+
+    mean = store_mean(tmp_path, in_files, [True, True, True], "mean_1.txt")
+    assert np.allclose(mean, response_mean(responses))
+
+    # sub-03 now fails QC
+    mean = store_mean(tmp_path, in_files, [True, True, False], "mean_2.txt")
+    assert np.allclose(mean, response_mean(responses[:2]))
+    with ResponseStore(tmp_path / "store").open() as store:
+        assert store.subjects("gm") == ["sub-01", "sub-02"]
+
+    # and passes again
+    mean = store_mean(tmp_path, in_files, [True, True, True], "mean_3.txt")
+    assert np.allclose(mean, response_mean(responses))
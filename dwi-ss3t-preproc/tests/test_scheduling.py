@@ -0,0 +1,174 @@
+import sys
+import json
+import time
+import random
+import os.path as op
+import networkx as nx
+import numpy as np
+import pytest
+
+sys.path.insert(0, op.join(op.dirname(op.abspath(__file__)), ".."))
+import src.scheduling as scheduling  # noqa: E402
+from src.scheduling import CriticalPathMultiProcPlugin  # noqa: E402
+
+
+class FakeNode:
+    """Just what the scheduler reads from a node."""
+
+    def __init__(self, name, n_procs=1, mem_gb=1):
+        self.name = self.fullname = self.itername = name
+        self.parameterization = []
+        self.n_procs = n_procs
+        self.mem_gb = mem_gb
+
+
+@pytest.fixture
+def plugin():
+    plugin = CriticalPathMultiProcPlugin(plugin_args={
+        "n_procs": 4, "memory_gb": 8, "scheduler": "critical_path"})
+    yield plugin
+    plugin.pool.shutdown()
+
+
+def test_ready_jobs_in_critical_path_order(plugin):
+    nodes = {name: FakeNode(name) for name in
+             ["synb0", "dwipreproc", "response", "mask", "sink", "qc"]}
+    graph = nx.DiGraph([(nodes["synb0"], nodes["dwipreproc"]),
+                        (nodes["dwipreproc"], nodes["response"]),
+                        (nodes["mask"], nodes["sink"])])
+    graph.add_node(nodes["qc"])
+    plugin.runtimes = {"synb0": 30, "dwipreproc": 300, "response": 20,
+                       "mask": 100, "sink": 5, "qc": 60}
+    plugin._prerun_check(graph)
+    plugin._generate_dependency_list(graph)
+    plugin.mapnodes, plugin.mapnodesubids = [], {}
+
+    ready = np.flatnonzero(~plugin.proc_done
+                           & (plugin.depidx.sum(axis=0) == 0).__array__())
+    order = [plugin.procs[j].name
+             for j in plugin._sort_jobs(ready, scheduler="critical_path")]
+    # 350 s to the end after synb0, 105 s after mask, 60 s after qc
+    assert order == ["synb0", "mask", "qc"]
+
+    # Observed runtimes replace the estimates
+    plugin.observed["qc"] = (500.0, 3)
+    plugin._critical_path = None
+    order = [plugin.procs[j].name
+             for j in plugin._sort_jobs(ready, scheduler="critical_path")]
+    assert order == ["qc", "synb0", "mask"]
+
+
+def head_start(now, total_procs, total_gb, jobs, procs, gb):
+    """Earliest time a job of procs and gb fits beside jobs (finish, procs,
+    gb) running until they finish."""
+    for t in [now] + sorted(finish for finish, _, _ in jobs):
+        used_procs = sum(p for finish, p, _ in jobs if finish > t)
+        used_gb = sum(g for finish, _, g in jobs if finish > t)
+        if (procs <= total_procs - used_procs
+                and gb <= total_gb - used_gb):
+            return t
+    return np.inf
+
+
+def backfill(plugin, now, running, ready):
+    """_backfill over running jobs [(node, seconds, elapsed seconds)] and
+    ready jobs [(node, seconds)], in that rank."""
+    procs, runtimes = [], {}
+    for node, seconds, elapsed in running:
+        plugin._started_at[node.itername] = now - elapsed
+        runtimes[node.name] = seconds
+        procs.append(node)
+    for node, seconds in ready:
+        runtimes[node.name] = seconds
+        procs.append(node)
+    plugin.procs = procs
+    plugin.runtimes = runtimes
+    plugin.pending_tasks = [(i, i) for i in range(len(running))]
+    return plugin._backfill(list(range(len(running), len(procs))))
+
+
+def test_backfill_counts_jobs_started_ahead_of_the_head(plugin):
+    now = time.time()
+    # 2 of 4 threads free until 100 s and 200 s
+    running = [(FakeNode("running0"), 100, 0),
+               (FakeNode("running1"), 200, 0)]
+    ahead = FakeNode("ahead")
+    head = FakeNode("head", n_procs=2)
+    short = FakeNode("short")
+    kept = backfill(plugin, now, running,
+                    [(ahead, 10), (head, 500), (short, 50)])
+    # The head can start when "ahead" finishes at 10 s, "short" would hold
+    # it back until 50 s
+    assert [plugin.procs[j].name for j in kept] == ["ahead", "head"]
+
+
+def test_backfill_never_delays_the_head_job(plugin):
+    rng = random.Random(0)
+    checked = 0
+    for _ in range(2000):
+        now = time.time()
+        running = [(FakeNode("running%d" % i, rng.randint(1, 2),
+                             rng.randint(1, 3)),
+                    rng.randint(1, 200), rng.randint(0, 50))
+                   for i in range(rng.randint(0, 3))]
+        ready = [(FakeNode("ready%d" % i, rng.randint(1, 4),
+                           rng.randint(1, 6)), rng.randint(1, 200))
+                 for i in range(rng.randint(1, 6))]
+        if (sum(n.n_procs for n, _, _ in running) > plugin.processors
+                or sum(n.mem_gb for n, _, _ in running) > plugin.memory_gb):
+            continue
+
+        kept = backfill(plugin, now, running, ready)
+        procs, runtimes = plugin.procs, plugin.runtimes
+        running = list(range(len(running)))
+
+        # Start the kept jobs as MultiProc does, in order while they fit
+        def finish(j):
+            started = plugin._started_at.get(procs[j].itername, now)
+            return (started + runtimes[procs[j].name], procs[j].n_procs,
+                    procs[j].mem_gb)
+
+        jobs = [finish(j) for j in running]
+        free_procs = plugin.processors - sum(p for _, p, _ in jobs)
+        free_gb = plugin.memory_gb - sum(g for _, _, g in jobs)
+        head, before, backfilled = None, [], []
+        for j in kept:
+            fits = (procs[j].n_procs <= free_procs
+                    and procs[j].mem_gb <= free_gb)
+            if head is None and not fits:
+                head = j
+                continue
+            assert fits
+            free_procs -= procs[j].n_procs
+            free_gb -= procs[j].mem_gb
+            (before if head is None else backfilled).append(finish(j))
+        if head is None or not backfilled:
+            continue
+        checked += 1
+        args = (now, plugin.processors, plugin.memory_gb)
+        need = (procs[head].n_procs, procs[head].mem_gb)
+        assert (head_start(*args, jobs + before + backfilled, *need)
+                <= head_start(*args, jobs + before, *need))
+    # Enough draws actually backfilled around a reservation
+    assert checked > 20
+
+
+def test_runtime_file_replaced_atomically(plugin, tmp_path, monkeypatch):
+    runtime_file = tmp_path / "node_runtimes.json"
+    runtime_file.write_text(json.dumps({"synb0": [100.0, 2]}))
+    plugin.runtime_file = str(runtime_file)
+    plugin.observed = {"synb0": (110.0, 3)}
+
+    def interrupted(obj, f, **kwargs):
+        f.write('{"synb0": [')
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(scheduling.json, "dump", interrupted)
+    with pytest.raises(OSError):
+        plugin._postrun_check()
+    # Readers still see the previous runtimes in full
+    assert json.loads(runtime_file.read_text()) == {"synb0": [100.0, 2]}
+
+    monkeypatch.undo()
+    plugin._postrun_check()
+    assert json.loads(runtime_file.read_text()) == {"synb0": [110.0, 3]}
@@ -0,0 +1,91 @@
+import sys
+import time
+import subprocess
+import os.path as op
+from types import SimpleNamespace
+
+sys.path.insert(0, op.join(op.dirname(op.abspath(__file__)), ".."))
+from src.walltime import (  # noqa: E402
+    Walltime,
+    WalltimeMultiProcPlugin,
+    parse_walltime,
+    resubmit_exit_code
+)
+
+package_dir = op.join(op.dirname(op.abspath(__file__)), "..")
+
+# Two jobs sleeping long enough to be running when the script signals itself
+# with SIGTERM, as PBS does at the end of the walltime. Exits as run.py does.
+signalled_run = """
+import os, sys, signal, threading
+sys.path.insert(0, %r)
+from nipype import Node, Workflow, Function
+from src.walltime import (Walltime, WalltimeMultiProcPlugin,
+                          WalltimeExceeded, resubmit_exit_code)
+
+def nap(x):
+    import time
+    time.sleep(60)
+    return x
+
+wf = Workflow(name="wf", base_dir=sys.argv[1])
+for i in range(2):
+    node = Node(Function(input_names=["x"], output_names=["y"],
+                         function=nap), name="nap%%d" %% i)
+    node.inputs.x = i
+    wf.add_nodes([node])
+plugin = WalltimeMultiProcPlugin(plugin_args={
+    "n_procs": 2, "memory_gb": 1, "walltime": Walltime(3600)})
+threading.Timer(3, os.kill, (os.getpid(), signal.SIGTERM)).start()
+try:
+    wf.run(plugin=plugin)
+except WalltimeExceeded:
+    raise SystemExit(resubmit_exit_code)
+""" % package_dir
+
+
+def test_parse_walltime():
+    assert parse_walltime("01:30:00") == 5400
+    assert parse_walltime("90:00") == 5400
+    assert parse_walltime("45") == 45
+    assert parse_walltime(3600) == 3600
+
+
+def test_fits_against_the_simulated_clock():
+    # A 10 h walltime on a clock 10 times faster: 1 h of real time, of
+    # which 2000 s have gone, 1600 s left less the 600 s margin
+    walltime = Walltime.from_environ({
+        "WALLTIME": "10:00:00",
+        "WALLTIME_START": str(time.time() - 2000),
+        "WALLTIME_CLOCK_SCALE": "10"})
+    assert 1590 < walltime.remaining() <= 1600
+    plugin = WalltimeMultiProcPlugin(plugin_args={
+        "n_procs": 1, "memory_gb": 1, "walltime": walltime,
+        "walltime_margin": 600, "walltime_safety": 1.2,
+        "runtimes": {"short": 800, "long": 900, "endless": 5000}})
+    try:
+        # 960 s expected, 1000 s left
+        assert plugin._fits(SimpleNamespace(name="short"))
+        # 1080 s expected
+        assert not plugin._fits(SimpleNamespace(name="long"))
+        # Would not fit in any job, runs anyway
+        assert plugin._fits(SimpleNamespace(name="endless"))
+    finally:
+        plugin.pool.shutdown()
+
+
+def test_sigterm_stops_with_resubmit_exit_code(tmp_path):
+    # nipype's Function nodes need their function in a file
+    script = tmp_path / "signalled_run.py"
+    script.write_text(signalled_run)
+    start = time.time()
+    run = subprocess.run([sys.executable, str(script),
+                          str(tmp_path)], stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT, universal_newlines=True,
+                         timeout=120)
+    assert run.returncode == resubmit_exit_code == 75
+    assert "[Walltime] Received signal 15" in run.stdout
+    # The killed jobs are not reported as crashes
+    assert "Traceback" not in run.stdout
+    # Running jobs were killed, not waited for
+    assert time.time() - start < 60